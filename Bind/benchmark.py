@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import time
+from typing import Dict, List
+
+from responder import A, AAAA, MX, NS, SOA, Responder, make_query
+from server import CONFIG, DnsServer
+from zone import parse_zone
+
+
+def bench_zone(hosts: int) -> str:
+    lines = ['$TTL 300', '@ IN SOA ns.bench.test. admin.bench.test. 1 3600 600 86400 60', '@ NS ns', 'ns A 10.0.0.1']
+    lines += [f'host{i} A 10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(hosts)]
+    return '\n'.join(lines)
+
+
+def make_responder(hosts: int) -> Responder:
+    responder = Responder.from_config(CONFIG)
+    responder.add_zone('bench.test.', parse_zone(bench_zone(hosts), 'bench.test.'))
+    return responder
+
+
+def make_queries(hosts: int, count: int) -> List[bytes]:
+    # Mostly hits, with apex, NODATA and NXDOMAIN answers mixed in; every other query carries EDNS.
+    others = [('prosto.name', SOA), ('prosto.name', NS), ('ns.prosto.name', AAAA)]
+    queries = []
+    for i in range(count):
+        choice = random.random()
+        if choice < 0.7:
+            name, qtype = f'host{random.randrange(hosts)}.bench.test', A
+        elif choice < 0.9:
+            name, qtype = random.choice(others)
+        else:
+            name, qtype = f'missing{i}.bench.test', MX
+        queries.append(make_query(name, qtype, ident=i & 0xFFFF, edns=bool(i & 1)))
+    return queries
+
+
+def bench_responder(responder: Responder, queries: List[bytes]) -> Dict[str, float]:
+    respond = responder.respond
+    start = time.perf_counter()
+    for query in queries:
+        respond(query)
+    elapsed = time.perf_counter() - start
+    return {'answers_per_second': round(len(queries) / elapsed)}
+
+
+def serve(hosts: int, port: int, batch: int, ready) -> None:
+    async def main():
+        server = DnsServer(make_responder(hosts), '127.0.0.1', port, batch)
+        await server.start()
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+def bench_udp(port: int, queries: List[bytes], window: int, duration: float) -> Dict[str, float]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(('127.0.0.1', port))
+    sock.settimeout(0.2)
+    answered = timeouts = sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        # Keep a window of queries in flight; a timeout counts as loss and refills the window.
+        while sent - answered - timeouts < window:
+            sock.send(queries[sent % len(queries)])
+            sent += 1
+        try:
+            sock.recv(4096)
+            answered += 1
+        except socket.timeout:
+            timeouts += sent - answered - timeouts
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return {'queries_per_second': round(answered / elapsed), 'lost': timeouts}
+
+
+def bench_tcp(port: int, queries: List[bytes], window: int, duration: float) -> Dict[str, float]:
+    sock = socket.create_connection(('127.0.0.1', port))
+    file = sock.makefile('rb')
+    answered = sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        batch = b''.join(len(query).to_bytes(2, 'big') + query
+                         for query in queries[sent % len(queries):sent % len(queries) + window - (sent - answered)])
+        sock.sendall(batch)
+        sent += window - (sent - answered)
+        file.read(int.from_bytes(file.read(2), 'big'))
+        answered += 1
+    elapsed = time.perf_counter() - start
+    file.close()
+    sock.close()
+    return {'queries_per_second': round(answered / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Authoritative DNS benchmark')
+    parser.add_argument('--hosts', type=int, default=100000, help='A records in the generated zone')
+    parser.add_argument('-d', '--duration', type=float, default=3)
+    parser.add_argument('-w', '--window', type=int, default=32, help='Queries in flight')
+    parser.add_argument('--batch', default='1,64', help='Comma separated datagrams per wakeup')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    responder = make_responder(args.hosts)
+    results = {'compile_seconds': round(time.perf_counter() - start, 2), 'templates': len(responder)}
+    queries = make_queries(args.hosts, 100000)
+    results['in_process'] = bench_responder(responder, queries)
+    for batch in map(int, args.batch.split(',')):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=serve, args=(args.hosts, port, batch, ready), daemon=True)
+        process.start()
+        try:
+            ready.wait(60)
+            results[f'udp_batch_{batch}'] = bench_udp(port, queries, args.window, args.duration)
+            if 'tcp' not in results:
+                results['tcp'] = bench_tcp(port, queries, args.window, args.duration)
+        finally:
+            process.terminate()
+            process.join()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
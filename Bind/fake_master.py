@@ -0,0 +1,226 @@
+import argparse
+import socket
+import struct
+import time
+from itertools import islice
+from threading import Lock, Thread
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from responder import AA, HEADER, IN, NOTIMP, QR, QUESTION, REFUSED, SOA, question_end, read_record
+from sync import AXFR, IXFR, NOTIFY, RR, encode_record, serial_of
+from zone import to_wire
+
+MESSAGE_SIZE = 16384
+
+
+def synthetic(origin: str, count: int, ttl: int = 300) -> Iterator[RR]:
+    # host<N>.<origin> A 10.x.y.z, computed from N, so a million records cost no memory.
+    apex = to_wire(origin).lower()
+    for index in range(count):
+        label = b'host%d' % index
+        yield bytes([len(label)]) + label + apex, 1, ttl, bytes((10, index >> 16 & 255, index >> 8 & 255, index & 255))
+
+
+class FakeMaster:
+    # A stand-in master for sync.py: SOA over UDP, AXFR and IXFR over TCP, NOTIFY on request.
+    _udp: socket.socket
+    _tcp: socket.socket
+    _lock: Lock
+    _count: int
+    _added: Dict[RR, None]
+    _deleted: Set[RR]
+    _history: List[Tuple[int, List[RR], int, List[RR]]]
+    origin: str
+    apex: bytes
+    serial: int
+    ixfr: bool
+    queries: List[int]
+    sent: int
+
+    def __init__(self, origin: str = 'example.test.', count: int = 1000, host: str = '127.0.0.1', port: int = 0,
+                 serial: int = 1):
+        self._lock = Lock()
+        self._count = count
+        self._added, self._deleted, self._history = {}, set(), []
+        self.origin = origin if origin.endswith('.') else f'{origin}.'
+        self.apex = to_wire(self.origin).lower()
+        self.serial = serial
+        self.ixfr = True
+        self.queries = []
+        self.sent = 0
+        self._udp, self._tcp = self._bind(host, port)
+        Thread(target=self._serve_udp, daemon=True).start()
+        Thread(target=self._serve_tcp, daemon=True).start()
+
+    @staticmethod
+    def _bind(host: str, port: int, attempts: int = 20) -> Tuple[socket.socket, socket.socket]:
+        # An ephemeral UDP port may be taken for TCP: pick another one until both are free.
+        while True:
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                udp.bind((host, port))
+                return udp, socket.create_server((host, udp.getsockname()[1]))
+            except OSError:
+                udp.close()
+                attempts -= 1
+                if port or not attempts:
+                    raise
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._udp.getsockname()
+
+    def close(self) -> None:
+        self._udp.close()
+        self._tcp.close()
+
+    def soa(self, serial: int = None) -> RR:
+        rdata = to_wire(f'ns1.{self.origin}') + to_wire(f'hostmaster.{self.origin}')
+        return self.apex, SOA, 3600, rdata + struct.pack('!IIIII', self.serial if serial is None else serial,
+                                                         3600, 600, 86400, 300)
+
+    def records(self) -> Iterator[RR]:
+        yield self.apex, 2, 3600, to_wire(f'ns1.{self.origin}')
+        for record in synthetic(self.origin, self._count):
+            if record not in self._deleted:
+                yield record
+        yield from list(self._added)
+
+    def change(self, added: List[RR], deleted: List[RR]) -> int:
+        with self._lock:
+            for record in deleted:
+                if record in self._added:
+                    del self._added[record]
+                else:
+                    self._deleted.add(record)
+            for record in added:
+                if record in self._deleted:
+                    self._deleted.discard(record)
+                else:
+                    self._added[record] = None
+            self._history.append((self.serial, deleted, self.serial + 1, added))
+            self.serial += 1
+            return self.serial
+
+    def forget(self) -> None:
+        # Without history every IXFR is answered with the whole zone.
+        self._history = []
+
+    def notify(self, address: Tuple[str, int], timeout: float = 2) -> bool:
+        query = HEADER.pack(0x4E4F, NOTIFY << 11 | AA, 1, 0, 0, 0) + self.apex + QUESTION.pack(SOA, IN)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((self.address[0], 0))
+            sock.settimeout(timeout)
+            sock.sendto(query, address)
+            try:
+                reply = sock.recv(512)
+            except OSError:
+                return False
+        return reply[:2] == query[:2] and bool(reply[2] & 0x80) and reply[3] & 0xF == 0
+
+    def _answer(self, query: bytes) -> Tuple[int, List[RR]]:
+        end = question_end(query) if len(query) >= 12 else -1
+        if end < 0 or len(query) < end + 4:
+            return 1, []
+        qtype = QUESTION.unpack_from(query, end)[0]
+        self.queries.append(qtype)
+        if query[12:end].lower() != self.apex:
+            return REFUSED, []
+        if qtype == SOA:
+            return 0, [self.soa()]
+        if qtype not in (AXFR, IXFR):
+            return NOTIMP, []
+        with self._lock:
+            serial = self.serial
+            history = self._history
+            if qtype == IXFR and self.ixfr and HEADER.unpack_from(query)[4]:
+                client = serial_of(read_record(query, end + 4)[0])
+                if client == serial:
+                    return 0, [self.soa()]
+                starts = [old for old, _, _, _ in history]
+                if client in starts:
+                    records = [self.soa()]
+                    for old, deleted, new, added in history[starts.index(client):]:
+                        records += [self.soa(old), *deleted, self.soa(new), *added]
+                    return 0, records + [self.soa()]
+            return 0, [self.soa(), *self.records(), self.soa()]
+
+    def _serve_udp(self) -> None:
+        while True:
+            try:
+                query, address = self._udp.recvfrom(4096)
+            except OSError:
+                return
+            if len(query) < 12 or query[2] & 0x80:
+                continue
+            rcode, records = self._answer(query)
+            self._udp.sendto(self._message(query, rcode, records), address)
+
+    def _serve_tcp(self) -> None:
+        while True:
+            try:
+                connection, _ = self._tcp.accept()
+            except OSError:
+                return
+            Thread(target=self._transfer, args=(connection,), daemon=True).start()
+
+    def _transfer(self, connection: socket.socket) -> None:
+        with connection, connection.makefile('rb') as file:
+            length = file.read(2)
+            query = file.read(int.from_bytes(length, 'big')) if len(length) == 2 else b''
+            if len(query) < 12:
+                return
+            rcode, records = self._answer(query)
+            batch: List[RR] = []
+            size = 0
+            try:
+                for record in records:
+                    batch.append(record)
+                    size += len(record[0]) + len(record[3]) + 10
+                    if size >= MESSAGE_SIZE:
+                        self._send(connection, self._message(query, rcode, batch))
+                        batch, size = [], 0
+                if batch or not records:
+                    self._send(connection, self._message(query, rcode, batch))
+            except OSError:
+                pass
+
+    def _send(self, connection: socket.socket, message: bytes) -> None:
+        connection.sendall(len(message).to_bytes(2, 'big') + message)
+        self.sent += len(message) + 2
+
+    @staticmethod
+    def _message(query: bytes, rcode: int, records: List[RR]) -> bytes:
+        end = question_end(query)
+        question = query[12:end + 4] if 0 <= end <= len(query) - 4 else b''
+        flags = QR | AA | (query[2] & 0x01) << 8 | rcode
+        return b''.join((HEADER.pack(HEADER.unpack_from(query)[0], flags, int(bool(question)), len(records), 0, 0),
+                         question, *map(encode_record, records)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='fake_master.py', description='Stand-in master with a synthetic zone')
+    parser.add_argument('-z', '--zone', default='urgu.org.')
+    parser.add_argument('-n', '--records', type=int, default=1000000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5300)
+    parser.add_argument('--change-every', type=float, default=10, help='Seconds between changes of one record')
+    parser.add_argument('--notify', help='HOST:PORT of the slave to notify after each change')
+    args = parser.parse_args()
+    master = FakeMaster(args.zone, args.records, args.host, args.port)
+    notify: Optional[Tuple[str, int]] = None
+    if args.notify:
+        host, _, port = args.notify.rpartition(':')
+        notify = (host, int(port))
+    print(f'Serving {master.origin} ({args.records} records) on {args.host}:{master.address[1]}')
+    try:
+        for step in range(args.records):
+            time.sleep(args.change_every)
+            old = next(islice(synthetic(master.origin, step + 1), step, None))
+            new = (old[0], old[1], old[2], bytes((192, 0, 2, step & 255)))
+            serial = master.change([new], [old])
+            print(f'Serial {serial}' + (f', notify acked: {master.notify(notify)}' if notify else ''))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        master.close()
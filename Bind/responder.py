@@ -0,0 +1,330 @@
+import struct
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from zone import Name, Record, ZoneException, load_config, read_zone, to_wire
+
+A, NS, CNAME, SOA, PTR, MX, TXT, AAAA, SRV, OPT, ANY = 1, 2, 5, 6, 12, 15, 16, 28, 33, 41, 255
+IN = 1
+QR, AA, TC, RD = 0x8000, 0x0400, 0x0200, 0x0100
+NOERROR, FORMERR, NXDOMAIN, NOTIMP, REFUSED = 0, 1, 3, 4, 5
+# Names inside these rdata may be compressed (RFC 3597, section 4).
+COMPRESSIBLE = {NS, CNAME, SOA, PTR, MX}
+GLUE = {NS: 0, MX: 1, SRV: 1}
+EDNS_PAYLOAD = 1232
+OPT_RECORD = b'\x00' + struct.pack('!HHIH', OPT, EDNS_PAYLOAD, 0, 0)
+HEADER = struct.Struct('!HHHHHH')
+COUNTS = struct.Struct('!HHHHH')
+QUESTION = struct.Struct('!HH')
+
+
+@dataclass
+class Answer:
+    flags: int
+    answers: int
+    authority: int
+    additional: int
+    tail: bytes
+    # Flags and counts after the ID, indexed by [has EDNS][RD set].
+    headers: List[List[bytes]] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.headers = [[COUNTS.pack(self.flags | rd, 1, self.answers, self.authority, self.additional + edns)
+                         for rd in (0, RD)] for edns in (0, 1)]
+
+
+class Writer:
+    _data: bytearray
+    _offsets: Dict[bytes, int]
+    _base: int
+    _compress: bool
+
+    def __init__(self, question: bytes = None):
+        # With a known question every suffix of its name, at offset 12, can be pointed to.
+        # Without one the template is shared by many names and only the 0xC00C owner pointer is safe.
+        self._data = bytearray()
+        self._offsets = {}
+        self._compress = question is not None
+        if question is not None:
+            self._base = 12 + len(question)
+            position = 0
+            while question[position]:
+                self._offsets[question[position:question.index(b'\x00', position) + 1].lower()] = 12 + position
+                position += question[position] + 1
+
+    def __bytes__(self) -> bytes:
+        return bytes(self._data)
+
+    def name(self, wire: bytes, compress: bool = True) -> None:
+        if not (self._compress and compress):
+            self._data += wire
+            return
+        position = 0
+        while wire[position]:
+            suffix = wire[position:].lower()
+            pointer = self._offsets.get(suffix)
+            if pointer is not None:
+                self._data += struct.pack('!H', 0xC000 | pointer)
+                return
+            offset = self._base + len(self._data)
+            if offset < 0x4000:
+                self._offsets[suffix] = offset
+            self._data += wire[position:position + wire[position] + 1]
+            position += wire[position] + 1
+        self._data.append(0)
+
+    def record(self, record: Record, owner: bytes = None, ttl: int = None) -> None:
+        if owner is None:
+            self.name(record.name)
+        else:
+            self._data += owner
+        self._data += struct.pack('!HHIH', record.type, IN, record.ttl if ttl is None else ttl, 0)
+        start = len(self._data)
+        for part in record.rdata:
+            if isinstance(part, Name):
+                self.name(part, record.type in COMPRESSIBLE)
+            else:
+                self._data += part
+        struct.pack_into('!H', self._data, start - 2, len(self._data) - start)
+
+
+def question_end(message: bytes) -> int:
+    # Offset just past the QNAME at 12, or -1 when it is malformed (a question never needs pointers).
+    position = 12
+    while position < len(message) and message[position]:
+        if message[position] > 63:
+            return -1
+        position += message[position] + 1
+    return position + 1 if position < len(message) and position - 12 < 255 else -1
+
+
+class Responder:
+    _answers: Dict[Tuple[bytes, int], Answer]
+    _other_types: Dict[bytes, Answer]
+    _wildcards: Dict[Tuple[bytes, int], Answer]
+    _referrals: Dict[bytes, Answer]
+    _existing: Dict[bytes, Answer]
+    _refused: Answer
+    records: int
+    zones: List[str]
+
+    def __init__(self):
+        self._answers = {}
+        self._other_types = {}
+        self._wildcards = {}
+        self._referrals = {}
+        self._existing = {}
+        self._refused = Answer(QR | REFUSED, 0, 0, 0, b'')
+        self.records = 0
+        self.zones = []
+
+    @classmethod
+    def from_config(cls, path: str) -> 'Responder':
+        responder = cls()
+        for origin, zone_path in load_config(path).items():
+            responder.add_zone(origin, read_zone(zone_path, origin))
+        return responder
+
+    def __len__(self):
+        return len(self._answers)
+
+    def add_zone(self, origin: str, records: List[Record]) -> None:
+        apex = to_wire(origin).lower()
+        rrsets: Dict[bytes, Dict[int, List[Record]]] = {}
+        for record in records:
+            if not self._below(record.name, apex):
+                raise ZoneException(f'{origin}: record out of zone')
+            rrsets.setdefault(record.name, {}).setdefault(record.type, []).append(record)
+        if SOA not in rrsets.get(apex, {}):
+            raise ZoneException(f'{origin}: no SOA record')
+        soa = rrsets[apex][SOA][0]
+        # Negative answers are cached for the smaller of the SOA TTL and its MINIMUM field (RFC 2308).
+        negative_ttl = min(soa.ttl, struct.unpack('!I', soa.rdata[2][-4:])[0])
+        cuts = {name for name, sets in rrsets.items() if NS in sets and name != apex}
+        names = set()
+        for name in rrsets:
+            while name != apex:
+                names.add(name)
+                name = name[name[0] + 1:]
+        names.add(apex)
+        writer = Writer()
+        writer.record(soa, ttl=negative_ttl)
+        nxdomain = Answer(QR | AA | NXDOMAIN, 0, 1, 0, bytes(writer))
+        for name in names:
+            if name in cuts:
+                self._referrals[name] = self._referral(name, rrsets)
+                continue
+            if cuts and self._occluded(name, apex, cuts):
+                continue
+            self._existing[name] = nxdomain
+            sets = rrsets.get(name, {})
+            for rtype, rrset in sets.items():
+                self._answers[name, rtype] = self._positive(name, rtype, rrset, rrsets)
+            if sets:
+                self._answers[name, ANY] = self._positive(name, ANY, [r for s in sets.values() for r in s], rrsets)
+            if CNAME in sets:
+                target = sets[CNAME][0].rdata[0].lower()
+                for rtype, rrset in rrsets.get(target, {}).items():
+                    if rtype not in sets:
+                        self._answers[name, rtype] = self._positive(name, rtype, sets[CNAME] + rrset, rrsets)
+                self._other_types[name] = self._positive(name, CNAME, sets[CNAME], rrsets)
+            else:
+                writer = Writer(name + b'\x00\x00\x00\x00')
+                writer.record(soa, ttl=negative_ttl)
+                self._other_types[name] = Answer(QR | AA, 0, 1, 0, bytes(writer))
+            if name.startswith(b'\x01*'):
+                self._add_wildcard(name, sets, soa, negative_ttl)
+        self.records += len(records)
+        self.zones.append(origin)
+
+    @staticmethod
+    def _below(name: bytes, apex: bytes) -> bool:
+        # Label-aligned suffix test on lower-cased wire names.
+        while len(name) > len(apex):
+            name = name[name[0] + 1:]
+        return name == apex
+
+    @staticmethod
+    def _occluded(name: bytes, apex: bytes, cuts: set) -> bool:
+        # Below a delegation the data is only glue, never an answer.
+        while name != apex:
+            name = name[name[0] + 1:]
+            if name in cuts:
+                return True
+        return False
+
+    def _glue(self, writer: Writer, rrset: List[Record], rrsets: Dict[bytes, Dict[int, List[Record]]]) -> int:
+        count = 0
+        for record in rrset:
+            if record.type not in GLUE:
+                continue
+            target = record.rdata[GLUE[record.type]].lower()
+            for rtype in (A, AAAA):
+                for glue in rrsets.get(target, {}).get(rtype, []):
+                    writer.record(glue)
+                    count += 1
+        return count
+
+    def _positive(self, name: bytes, rtype: int, rrset: List[Record],
+                  rrsets: Dict[bytes, Dict[int, List[Record]]]) -> Answer:
+        writer = Writer(name + struct.pack('!HH', rtype, IN))
+        for record in rrset:
+            writer.record(record)
+        additional = self._glue(writer, rrset, rrsets)
+        return Answer(QR | AA, len(rrset), 0, additional, bytes(writer))
+
+    def _referral(self, cut: bytes, rrsets: Dict[bytes, Dict[int, List[Record]]]) -> Answer:
+        # Shared by every name under the cut, so written without compression.
+        writer = Writer()
+        for record in rrsets[cut][NS]:
+            writer.record(record)
+        additional = self._glue(writer, rrsets[cut][NS], rrsets)
+        return Answer(QR, 0, len(rrsets[cut][NS]), additional, bytes(writer))
+
+    def _add_wildcard(self, name: bytes, sets: Dict[int, List[Record]], soa: Record, negative_ttl: int) -> None:
+        # The owner of a synthesized record is the query name, always at offset 12.
+        for rtype, rrset in list(sets.items()) + [(ANY, [r for s in sets.values() for r in s])]:
+            writer = Writer()
+            for record in rrset:
+                writer.record(record, owner=b'\xc0\x0c')
+            self._wildcards[name, rtype] = Answer(QR | AA, len(rrset), 0, 0, bytes(writer))
+        writer = Writer()
+        writer.record(soa, ttl=negative_ttl)
+        self._wildcards[name, -1] = Answer(QR | AA, 0, 1, 0, bytes(writer))
+
+    def lookup(self, qname: bytes, qtype: int) -> Answer:
+        answer = self._answers.get((qname, qtype)) or self._other_types.get(qname)
+        if answer is not None:
+            return answer
+        position = 0
+        while qname[position]:
+            suffix = qname[position:]
+            if suffix in self._referrals:
+                return self._referrals[suffix]
+            if position and suffix in self._existing:
+                # The closest encloser: a wildcard below it answers, otherwise the name does not exist.
+                wildcard = b'\x01*' + suffix
+                if wildcard in self._existing:
+                    return self._wildcards.get((wildcard, qtype)) or self._wildcards[wildcard, -1]
+                return self._existing[suffix]
+            position += qname[position] + 1
+        return self._refused
+
+    def respond(self, query: bytes, limit: int = 512) -> Optional[bytes]:
+        if len(query) < 12:
+            return None
+        _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(query)
+        if flags & QR:
+            return None
+        rd = flags & RD
+        end = question_end(query)
+        if qdcount != 1 or end < 0 or end + 4 > len(query):
+            return query[:2] + COUNTS.pack(QR | rd | FORMERR, 0, 0, 0, 0)
+        question = query[12:end + 4]
+        if flags & 0x7800:
+            return query[:2] + COUNTS.pack(QR | rd | NOTIMP, 1, 0, 0, 0) + question
+        qtype, qclass = QUESTION.unpack_from(query, end)
+        edns = 0
+        if arcount == 1 and not ancount and not nscount and query[end + 4:end + 7] == b'\x00\x00\x29':
+            edns = 1
+            limit = max(limit, min(EDNS_PAYLOAD, struct.unpack_from('!H', query, end + 7)[0]))
+        answer = self.lookup(query[12:end].lower(), qtype) if qclass == IN else self._refused
+        response = b''.join((query[:2], answer.headers[edns][rd != 0], question, answer.tail, OPT_RECORD * edns))
+        if len(response) > limit:
+            # Too big for this datagram: the client retries over TCP.
+            return b''.join((query[:2], COUNTS.pack(answer.flags | rd | TC, 1, 0, 0, edns), question,
+                             OPT_RECORD * edns))
+        return response
+
+
+def make_query(name: str, qtype: int, ident: int = 0, edns: bool = False) -> bytes:
+    return b''.join((HEADER.pack(ident, RD, 1, 0, 0, int(edns)), to_wire(name), QUESTION.pack(qtype, IN),
+                     OPT_RECORD if edns else b''))
+
+
+def read_name(message: bytes, position: int) -> Tuple[bytes, int]:
+    labels, end = [], None
+    while message[position]:
+        if message[position] >= 0xC0:
+            end = end or position + 2
+            target = struct.unpack_from('!H', message, position)[0] & 0x3FFF
+            # Only backward pointers, so a crafted message cannot loop.
+            if target >= position:
+                raise ValueError('Bad compression pointer')
+            position = target
+            continue
+        labels.append(message[position:position + message[position] + 1])
+        position += message[position] + 1
+    return b''.join(labels) + b'\x00', end or position + 1
+
+
+def read_record(message: bytes, position: int) -> Tuple[Tuple[bytes, int, int, bytes], int]:
+    name, position = read_name(message, position)
+    rtype, _, ttl, length = struct.unpack_from('!HHIH', message, position)
+    position += 10
+    rdata = message[position:position + length]
+    if len(rdata) != length:
+        raise ValueError('Truncated record')
+    if rtype in COMPRESSIBLE or rtype == SRV:
+        # Expand compressed names, so rdata compares equal to the zone's.
+        prefix = {MX: 2, SRV: 6}.get(rtype, 0)
+        target, after = read_name(message, position + prefix)
+        rdata = rdata[:prefix] + target
+        if rtype == SOA:
+            rname, after = read_name(message, after)
+            rdata += rname + message[after:after + 20]
+    return (name, rtype, ttl, rdata), position + length
+
+
+def parse_response(message: bytes) -> Dict[str, object]:
+    ident, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(message)
+    position = question_end(message) + 4 if qdcount else 12
+    sections = []
+    for count in (ancount, nscount, arcount):
+        records = []
+        for _ in range(count):
+            record, position = read_record(message, position)
+            records.append(record)
+        sections.append(records)
+    return {'id': ident, 'rcode': flags & 0xF, 'aa': bool(flags & AA), 'tc': bool(flags & TC),
+            'answers': sections[0], 'authority': sections[1], 'additional': sections[2]}
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+from typing import List, Optional
+
+from responder import Responder
+from zone import ZoneException, read_zone
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'named.conf.local')
+
+
+class DnsServer:
+    _responder: Responder
+    _udp: Optional[socket.socket] = None
+    _tcp: Optional[asyncio.AbstractServer] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    host: str
+    port: int
+    batch: int
+    tcp_timeout: float
+    queries: int
+    dropped: int
+
+    def __init__(self, responder: Responder, host: str = '127.0.0.1', port: int = 53, batch: int = 64,
+                 tcp_timeout: float = 10):
+        self._responder = responder
+        self.host, self.port = host, port
+        self.batch, self.tcp_timeout = batch, tcp_timeout
+        self.queries = self.dropped = 0
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self._udp = socket.socket(family, socket.SOCK_DGRAM)
+        self._udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self._udp.bind((self.host, self.port))
+        self._udp.setblocking(False)
+        self.port = self._udp.getsockname()[1]
+        # A reader callback on the raw socket instead of a DatagramProtocol: one wakeup drains a whole batch.
+        self._loop.add_reader(self._udp.fileno(), self._read_udp)
+        self._tcp = await asyncio.start_server(self._serve_tcp, self.host, self.port, reuse_address=True)
+
+    def _read_udp(self) -> None:
+        recvfrom, sendto, respond = self._udp.recvfrom, self._udp.sendto, self._responder.respond
+        for _ in range(self.batch):
+            try:
+                query, address = recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            response = respond(query)
+            if response is None:
+                continue
+            self.queries += 1
+            try:
+                sendto(response, address)
+            except OSError:
+                # The send buffer is full: like any lost datagram, the client asks again.
+                self.dropped += 1
+
+    async def _serve_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                length = await asyncio.wait_for(reader.readexactly(2), self.tcp_timeout)
+                query = await asyncio.wait_for(reader.readexactly(int.from_bytes(length, 'big')), self.tcp_timeout)
+                response = self._responder.respond(query, 65535)
+                if response is None:
+                    break
+                self.queries += 1
+                writer.write(len(response).to_bytes(2, 'big') + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await self._tcp.serve_forever()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._udp is not None:
+            self._loop.remove_reader(self._udp.fileno())
+            self._udp.close()
+            self._udp = None
+        if self._tcp is not None:
+            self._tcp.close()
+            self._tcp = None
+
+
+def load(config: str, zones: List[str]) -> Responder:
+    responder = Responder.from_config(config) if config else Responder()
+    for zone in zones:
+        origin, _, path = zone.partition('=')
+        responder.add_zone(origin, read_zone(path, origin))
+    return responder
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='server.py', description='Authoritative DNS server for the Bind zones')
+    parser.add_argument('-c', '--config', default=CONFIG, help='named.conf with master zones')
+    parser.add_argument('-z', '--zone', action='append', default=[], help='Extra zone as ORIGIN=FILE')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5353)
+    parser.add_argument('--batch', type=int, default=64, help='Datagrams handled per socket wakeup')
+    args = parser.parse_args()
+    try:
+        responder = load(args.config, args.zone)
+    except ZoneException as exc:
+        print(exc.message)
+        sys.exit(1)
+    except OSError as exc:
+        print(exc)
+        sys.exit(1)
+    print(f'Serving {", ".join(responder.zones)} ({responder.records} records) on {args.host}:{args.port}')
+    try:
+        asyncio.run(DnsServer(responder, args.host, args.port, args.batch).serve_forever())
+    except KeyboardInterrupt:
+        pass
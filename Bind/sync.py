@@ -0,0 +1,479 @@
+import argparse
+import os
+import random
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from threading import Event, Lock, Thread
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from responder import AA, HEADER, IN, NOTIMP, QR, QUESTION, REFUSED, SOA, make_query, question_end, read_record
+from zone import ZoneException, load_slaves, rdata_text, to_text, to_wire, type_name
+
+IXFR, AXFR = 251, 252
+NOTIFY = 4
+RCODES = {1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', NOTIMP: 'NOTIMP', REFUSED: 'REFUSED', 9: 'NOTAUTH'}
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'named.conf.local')
+# (owner, type, ttl, rdata), names uncompressed and owners in lower case.
+RR = Tuple[bytes, int, int, bytes]
+
+
+@dataclass
+class SyncException(Exception):
+    message: str
+
+
+@dataclass
+class Diff:
+    serial: int
+    soa: RR
+    deleted: List[RR]
+    added: List[RR]
+
+
+def serial_of(soa: RR) -> int:
+    return struct.unpack_from('!I', soa[3], len(soa[3]) - 20)[0]
+
+
+def serial_newer(serial: int, than: int) -> bool:
+    # Sequence space arithmetic of RFC 1982: serials wrap around at 2**32.
+    return serial != than and (serial - than) % 2 ** 32 < 2 ** 31
+
+
+def encode_record(record: RR) -> bytes:
+    name, rtype, ttl, rdata = record
+    return name + struct.pack('!HHIH', rtype, IN, ttl, len(rdata)) + rdata
+
+
+class ZoneStore:
+    _db: sqlite3.Connection
+    _lock: Lock
+    _path: str
+    _count: int
+    origin: str
+    apex: bytes
+
+    def __init__(self, path: str, origin: str):
+        # The SOA lives in its own table: its serial is what every transfer is checked against.
+        self._path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS records (name BLOB NOT NULL, type INTEGER NOT NULL, '
+                         'rdata BLOB NOT NULL, ttl INTEGER NOT NULL, PRIMARY KEY (name, type, rdata)) WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS soa (ttl INTEGER NOT NULL, rdata BLOB NOT NULL)')
+        self._lock = Lock()
+        self.origin = origin
+        self.apex = to_wire(origin).lower()
+        # Counted once here, then kept up to date by every transfer.
+        self._count = self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def soa(self) -> Optional[RR]:
+        with self._lock:
+            row = self._db.execute('SELECT ttl, rdata FROM soa').fetchone()
+        return (self.apex, SOA, row[0], row[1]) if row else None
+
+    @property
+    def serial(self) -> Optional[int]:
+        soa = self.soa
+        return serial_of(soa) if soa else None
+
+    def records(self) -> Iterator[RR]:
+        # Its own connection and read transaction: a WAL snapshot of the last committed serial, streamed
+        # while transfers go on.
+        with closing(sqlite3.connect(self._path, isolation_level=None)) as db:
+            db.execute('BEGIN')
+            yield from db.execute('SELECT name, type, ttl, rdata FROM records ORDER BY name, type')
+            db.execute('COMMIT')
+
+    def replace(self, soa: RR, records: Iterable[RR]) -> int:
+        # A full transfer; the old zone stays visible until the new one is committed.
+        count = 0
+
+        def rows():
+            nonlocal count
+            for name, rtype, ttl, rdata in records:
+                count += 1
+                yield name.lower(), rtype, rdata, ttl
+
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM records')
+                self._db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', rows())
+                self._db.execute('DELETE FROM soa')
+                self._db.execute('INSERT INTO soa VALUES (?, ?)', (soa[2], soa[3]))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._count = self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        return count
+
+    def apply(self, diffs: List[Diff]) -> None:
+        # All the diffs of one IXFR in one transaction: a reader never sees a zone between two serials.
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                current = self._db.execute('SELECT ttl, rdata FROM soa').fetchone()
+                count = self._count
+                for diff in diffs:
+                    if current is None or serial_of((self.apex, SOA) + tuple(current)) != diff.serial:
+                        raise SyncException(f'Diff from serial {diff.serial} does not follow the stored zone')
+                    for name, rtype, _, rdata in diff.deleted:
+                        deleted = self._db.execute('DELETE FROM records WHERE name = ? AND type = ? AND rdata = ?',
+                                                   (name.lower(), rtype, rdata))
+                        if deleted.rowcount != 1:
+                            raise SyncException(f'Deleted {to_text(name)} {type_name(rtype)} is not in the zone')
+                    added = [(name.lower(), rtype, rdata, ttl) for name, rtype, ttl, rdata in diff.added]
+                    # A record that is already there only has its TTL updated and is not counted again.
+                    count += self._db.executemany('INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?)', added).rowcount
+                    self._db.executemany('UPDATE records SET ttl = ? WHERE name = ? AND type = ? AND rdata = ?',
+                                         [(ttl, name, rtype, rdata) for name, rtype, rdata, ttl in added])
+                    count -= len(diff.deleted)
+                    current = (diff.soa[2], diff.soa[3])
+                self._db.execute('UPDATE soa SET ttl = ?, rdata = ?', current)
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._count = count
+
+    def export(self, path: str) -> None:
+        # Written next to the target and renamed over it, so the zone file is never half written.
+        descriptor, temporary = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+                                                 dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with open(descriptor, 'w') as file, closing(sqlite3.connect(self._path, isolation_level=None)) as db:
+                db.execute('BEGIN')
+                soa = db.execute('SELECT ttl, rdata FROM soa').fetchone()
+                if soa is None:
+                    raise SyncException(f'No data for {self.origin}')
+                file.write(f'$ORIGIN {self.origin}\n{self.origin} {soa[0]} IN SOA {rdata_text(SOA, soa[1])}\n')
+                for name, rtype, ttl, rdata in db.execute(
+                        'SELECT name, type, ttl, rdata FROM records ORDER BY name, type'):
+                    file.write(f'{to_text(name)} {ttl} IN {type_name(rtype)} {rdata_text(rtype, rdata)}\n')
+                db.execute('COMMIT')
+            # mkstemp makes it private; the name server reads it as another user.
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+class ZoneSync:
+    _store: ZoneStore
+    _notified: Event
+    _stopped: Event
+    _notify: Optional[socket.socket] = None
+    _master_addresses: Set[str]
+    _exported: float
+    _unexported: bool
+    origin: str
+    apex: bytes
+    master: Tuple[str, int]
+    zone_file: Optional[str]
+    export_interval: float
+    timeout: float
+    received: int
+    transfers: Dict[str, int]
+
+    def __init__(self, origin: str, master: Tuple[str, int], store: ZoneStore, zone_file: str = None,
+                 timeout: float = 30, export_interval: float = 300):
+        self._store = store
+        self._notified, self._stopped = Event(), Event()
+        self._exported, self._unexported = float('-inf'), False
+        self.origin = origin if origin.endswith('.') else f'{origin}.'
+        self.apex = to_wire(self.origin).lower()
+        self.master, self.zone_file, self.timeout = master, zone_file, timeout
+        self.export_interval = export_interval
+        self.received = 0
+        self.transfers = {'current': 0, 'ixfr': 0, 'axfr': 0}
+
+    def master_serial(self) -> int:
+        ident = random.getrandbits(16)
+        query = make_query(self.origin, SOA, ident)
+        with socket.socket(socket.AF_INET6 if ':' in self.master[0] else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(min(self.timeout, 5))
+            sock.connect(self.master)
+            sock.send(query)
+            deadline = time.monotonic() + sock.gettimeout()
+            while True:
+                sock.settimeout(max(0.01, deadline - time.monotonic()))
+                response = sock.recv(4096)
+                if len(response) >= 12 and HEADER.unpack_from(response)[0] == ident:
+                    break
+        self.received += len(response)
+        for record in self._answers(response, ident):
+            if record[1] == SOA and record[0].lower() == self.apex:
+                return serial_of(record)
+        raise SyncException(f'No SOA for {self.origin} from {self.master[0]}')
+
+    def refresh(self) -> str:
+        # 'current', 'ixfr' or 'axfr', whichever brought the store up to the master.
+        local = self._store.serial
+        if local is not None and not serial_newer(self.master_serial(), local):
+            result = 'current'
+        elif local is None:
+            result = self.axfr()
+        else:
+            try:
+                result = self.ixfr()
+            except SyncException as exc:
+                # A diff that does not match the store, or a master that cannot do IXFR.
+                print(f'{self.origin} IXFR failed, falling back to AXFR: {exc.message}', file=sys.stderr)
+                result = self.axfr()
+        self.transfers[result] += 1
+        # Rewriting the whole file after every IXFR costs more than the IXFR, so it is written at most once per
+        # export_interval; an AXFR replaces the zone and is written straight away.
+        self._unexported = self._unexported or result != 'current'
+        if result == 'axfr' or self.export_due() == 0:
+            self.export()
+        return result
+
+    def export_due(self) -> Optional[float]:
+        # Seconds until the zone file is to be written again, None when it is up to date or not kept.
+        if not self.zone_file or not self._unexported:
+            return None
+        return max(0.0, self._exported + self.export_interval - time.monotonic())
+
+    def export(self) -> bool:
+        if not self.zone_file or not self._unexported:
+            return False
+        # Timed from the attempt, so a failing write is not retried in a loop either.
+        self._exported = time.monotonic()
+        self._store.export(self.zone_file)
+        self._unexported = False
+        return True
+
+    def ixfr(self) -> str:
+        local = self._store.soa
+        query = self._query(IXFR, encode_record(local))
+        with closing(self._exchange(query)) as records:
+            try:
+                first = next(records)
+                if first[1] != SOA:
+                    raise SyncException('IXFR does not start with an SOA')
+                serial = serial_of(first)
+                second = next(records, None)
+                if second is None:
+                    # A lone SOA: the zone is current, or the master wants a full transfer.
+                    return 'current' if not serial_newer(serial, serial_of(local)) else self.axfr()
+                if second[1] != SOA or serial_of(second) != serial_of(local):
+                    # The master answered with the whole zone (RFC 1995, section 4).
+                    self._replace(first, second, records)
+                    return 'axfr'
+                self._store.apply(self._diffs(serial, second, records))
+                return 'ixfr'
+            except StopIteration:
+                raise SyncException('IXFR ended early')
+
+    def axfr(self) -> str:
+        with closing(self._exchange(self._query(AXFR))) as records:
+            try:
+                first = next(records)
+                if first[1] != SOA:
+                    raise SyncException('AXFR does not start with an SOA')
+                self._replace(first, next(records), records)
+            except StopIteration:
+                raise SyncException('AXFR ended early')
+        return 'axfr'
+
+    def _replace(self, soa: RR, first: RR, records: Iterator[RR]) -> None:
+        def until_soa():
+            record = first
+            while record[1] != SOA:
+                yield record
+                record = next(records, None)
+                if record is None:
+                    raise SyncException('Transfer ended early')
+            if serial_of(record) != serial_of(soa):
+                raise SyncException('Transfer ends with another serial')
+
+        # Streamed straight into the store, so a large zone is never held in memory.
+        self._store.replace(soa, until_soa())
+
+    @staticmethod
+    def _diffs(serial: int, old: RR, records: Iterator[RR]) -> List[Diff]:
+        # Sequences of: old SOA, deleted records, new SOA, added records; the final SOA closes the answer.
+        diffs = []
+        while True:
+            deleted, record = [], next(records)
+            while record[1] != SOA:
+                deleted.append(record)
+                record = next(records)
+            new, added, record = record, [], next(records)
+            while record[1] != SOA:
+                added.append(record)
+                record = next(records)
+            diffs.append(Diff(serial_of(old), new, deleted, added))
+            if serial_of(record) == serial and serial_of(new) == serial:
+                return diffs
+            old = record
+
+    def _query(self, qtype: int, authority: bytes = b'') -> bytes:
+        return b''.join((HEADER.pack(random.getrandbits(16), 0, 1, 0, int(bool(authority)), 0),
+                         to_wire(self.origin), QUESTION.pack(qtype, IN), authority))
+
+    def _answers(self, message: bytes, ident: int) -> List[RR]:
+        try:
+            ident_, flags, qdcount, ancount, _, _ = HEADER.unpack_from(message)
+            if ident_ != ident or not flags & QR:
+                raise SyncException('Response does not match the query')
+            if flags & 0xF:
+                raise SyncException(f'{RCODES.get(flags & 0xF, flags & 0xF)} from {self.master[0]}')
+            position = question_end(message) + 4 if qdcount else 12
+            records = []
+            for _ in range(ancount):
+                (name, rtype, ttl, rdata), position = read_record(message, position)
+                records.append((name.lower(), rtype, ttl, rdata))
+            return records
+        except (IndexError, ValueError, struct.error):
+            raise SyncException(f'Malformed response from {self.master[0]}')
+
+    def _exchange(self, query: bytes) -> Iterator[RR]:
+        # Records of a TCP answer, read one message at a time as the caller consumes them.
+        ident = HEADER.unpack_from(query)[0]
+        with socket.create_connection(self.master, timeout=self.timeout) as sock:
+            sock.sendall(len(query).to_bytes(2, 'big') + query)
+            with sock.makefile('rb') as file:
+                while True:
+                    length = file.read(2)
+                    message = file.read(int.from_bytes(length, 'big')) if len(length) == 2 else b''
+                    if len(message) < 12 or len(message) != int.from_bytes(length, 'big'):
+                        raise SyncException(f'Connection to {self.master[0]} closed during the transfer')
+                    self.received += len(message) + 2
+                    yield from self._answers(message, ident)
+
+    def listen(self, host: str = '0.0.0.0', port: int = 53) -> int:
+        # NOTIFY (RFC 1996) from the master triggers a refresh without waiting for the SOA refresh interval.
+        self._notify = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+        self._notify.bind((host, port))
+        # Resolved once: a master configured by name is matched against the address NOTIFY comes from.
+        self._master_addresses = {info[4][0] for info in socket.getaddrinfo(*self.master, type=socket.SOCK_DGRAM)}
+        Thread(target=self._serve_notify, args=(self._notify,), daemon=True).start()
+        return self._notify.getsockname()[1]
+
+    def _serve_notify(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                message, address = sock.recvfrom(4096)
+            except OSError:
+                return
+            end = question_end(message) if len(message) >= 12 else -1
+            if end < 0 or len(message) < end + 4 or message[2] & 0x80 or (message[2] >> 3) & 0xF != NOTIFY:
+                continue
+            # Only the master may notify, and only for this zone.
+            known = message[12:end].lower() == self.apex and address[0] in self._master_addresses
+            flags = QR | AA | NOTIFY << 11 | (0 if known else REFUSED)
+            try:
+                sock.sendto(message[:2] + struct.pack('!HHHHH', flags, 1, 0, 0, 0) + message[12:end + 4], address)
+            except OSError:
+                pass
+            if known:
+                self._notified.set()
+
+    def run(self, interval: float = None) -> None:
+        # Polls at the SOA refresh interval, or at its retry interval after a failure.
+        while not self._stopped.is_set():
+            try:
+                result = self.refresh()
+                if result != 'current':
+                    print(f'{self.origin} {result} to serial {self._store.serial}, {len(self._store)} records')
+                failed = False
+            except (OSError, SyncException, ZoneException) as exc:
+                print(f'{self.origin} refresh failed: {getattr(exc, "message", exc)}', file=sys.stderr)
+                failed = True
+            soa, delay = self._store.soa, 60 if interval is None else interval
+            if interval is None and soa:
+                refresh, retry = struct.unpack_from('!II', soa[3], len(soa[3]) - 16)
+                delay = retry if failed else refresh
+            # Woken early by a NOTIFY, or to write a zone file held back by export_interval.
+            deadline = time.monotonic() + delay
+            while True:
+                remaining, due = deadline - time.monotonic(), self.export_due()
+                if remaining <= 0 or self._notified.wait(remaining if due is None else min(due, remaining)):
+                    break
+                if self.export_due() == 0:
+                    self._export_or_report()
+            self._notified.clear()
+        self._export_or_report()
+
+    def _export_or_report(self) -> None:
+        try:
+            self.export()
+        except (OSError, SyncException) as exc:
+            print(f'{self.origin} export failed: {getattr(exc, "message", exc)}', file=sys.stderr)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._notified.set()
+        if self._notify is not None:
+            self._notify.close()
+            self._notify = None
+
+
+def parse_master(text: str) -> Tuple[str, int]:
+    host, _, port = text.rpartition(':') if text.count(':') == 1 else (text, '', '')
+    return host, int(port or 53)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='sync.py', description='Keep a slave zone in sync with its master')
+    parser.add_argument('-c', '--config', default=CONFIG, help='named.conf with slave zones')
+    parser.add_argument('-z', '--zone', help='Origin of the slave zone, the first one in the config by default')
+    parser.add_argument('-m', '--master', type=parse_master, help='HOST[:PORT], the config\'s masters by default')
+    parser.add_argument('-f', '--file', help='Zone file kept up to date, the config\'s one by default')
+    parser.add_argument('--db', help='SQLite store, FILE.db by default')
+    parser.add_argument('--no-export', action='store_true', help='Only keep the SQLite store, not the zone file')
+    parser.add_argument('--export-interval', type=float, default=300,
+                        help='Seconds between zone file writes after IXFR, 300 by default')
+    parser.add_argument('--notify-port', type=int, help='UDP port to accept NOTIFY from the master on')
+    parser.add_argument('-i', '--interval', type=float, help='Poll interval instead of the SOA refresh')
+    parser.add_argument('--once', action='store_true', help='Refresh once and exit')
+    args = parser.parse_args()
+    try:
+        slaves = load_slaves(args.config)
+    except OSError as exc:
+        print(exc)
+        sys.exit(1)
+    origin = args.zone or next(iter(slaves), None)
+    if origin is None:
+        print('No slave zone configured')
+        sys.exit(1)
+    origin = origin if origin.endswith('.') else f'{origin}.'
+    zone_file, masters = slaves.get(origin, (None, []))
+    zone_file = args.file or zone_file
+    master = args.master or (masters[0] if masters else None)
+    if master is None or zone_file is None:
+        print(f'No master or file for {origin}')
+        sys.exit(1)
+    store = ZoneStore(args.db or f'{zone_file}.db', origin)
+    sync = ZoneSync(origin, master, store, None if args.no_export else zone_file,
+                    export_interval=args.export_interval)
+    if args.once:
+        try:
+            print(sync.refresh(), store.serial)
+        except (OSError, SyncException) as exc:
+            print(getattr(exc, 'message', exc))
+            sys.exit(1)
+        sys.exit(0)
+    if args.notify_port is not None:
+        sync.listen(port=args.notify_port)
+    try:
+        sync.run(args.interval)
+    except KeyboardInterrupt:
+        sync.stop()
@@ -0,0 +1,302 @@
+import asyncio
+import os
+import socket
+import struct
+import tempfile
+import time
+import unittest
+from itertools import islice
+from threading import Thread
+from unittest import TestCase
+
+from fake_master import FakeMaster, synthetic
+from responder import A, AAAA, ANY, CNAME, MX, NS, SOA, TXT, Responder, make_query, parse_response
+from server import DnsServer
+from sync import AXFR, IXFR, Diff, SyncException, ZoneStore, ZoneSync
+from zone import ZoneException, load_config, load_slaves, parse_zone, rdata_text, read_zone, to_wire
+
+ZONE = '''
+$ORIGIN example.test.
+$TTL 1h ; default
+@       IN  SOA ns1 hostmaster (
+                2024010101 ; serial
+                3600 600 86400
+                300 )
+        IN  NS  ns1
+        NS      ns1.other.test.
+        MX  10  mail
+ns1     A       192.0.2.1
+mail    300 IN A 192.0.2.25
+        AAAA    2001:db8::25
+www     CNAME   mail
+txt     TXT     "hello world" second
+*.apps  A       192.0.2.80
+deep.er.name A  192.0.2.9
+sub     NS      ns.sub
+ns.sub  A       192.0.2.53
+'''
+
+
+class ZoneTests(TestCase):
+    def test_parse(self):
+        records = parse_zone(ZONE, 'example.test')
+        self.assertEqual(13, len(records))
+        soa = records[0]
+        self.assertEqual((to_wire('example.test.'), SOA, 3600), (soa.name, soa.type, soa.ttl))
+        self.assertEqual([to_wire('ns1.example.test.'), to_wire('hostmaster.example.test.'),
+                          struct.pack('!IIIII', 2024010101, 3600, 600, 86400, 300)], soa.rdata)
+        mail = [record for record in records if record.name == to_wire('mail.example.test.')]
+        self.assertEqual([(A, 300), (AAAA, 3600)], [(record.type, record.ttl) for record in mail])
+        txt = next(record for record in records if record.type == TXT)
+        self.assertEqual([b'\x0bhello world\x06second'], txt.rdata)
+
+    def test_repo_zone(self):
+        zones = load_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'named.conf.local'))
+        self.assertEqual(['prosto.name.'], list(zones))
+        records = read_zone(zones['prosto.name.'], 'prosto.name.')
+        self.assertEqual([SOA, NS, A], [record.type for record in records])
+        self.assertEqual([b'\x7f\x00\x00\x01'], records[2].rdata)
+
+    def test_slaves(self):
+        slaves = load_slaves(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'named.conf.local'))
+        self.assertEqual(['urgu.org.'], list(slaves))
+        self.assertEqual(('urgu.org.txt', [('212.193.68.254', 53)]),
+                         (os.path.basename(slaves['urgu.org.'][0]), slaves['urgu.org.'][1]))
+
+    def test_generic_and_text(self):
+        records = parse_zone('$TTL 60\nx TYPE99 \\# 3 abcdef\nt TXT "a\\"b\\009" c\nm MX 10 a\\.b', 'example.test')
+        self.assertEqual([(99, [b'\xab\xcd\xef']), (TXT, [b'\x04a"b\t\x01c'])],
+                         [(record.type, record.rdata) for record in records[:2]])
+        self.assertEqual(['\\# 3 abcdef', '"a\\034b\\009" "c"', '10 a\\046b.example.test.'],
+                         [rdata_text(record.type, b''.join(record.rdata)) for record in records])
+        self.assertEqual(records[2].rdata[1], to_wire(rdata_text(MX, b''.join(records[2].rdata))[3:]))
+
+    def test_errors(self):
+        for text in ('@ SOA ns (1 2 3', 'a A 1.2.3', '$INCLUDE other', 'a CH A 1.2.3.4', 'a IN WKS 1'):
+            with self.assertRaises(ZoneException):
+                parse_zone('$TTL 60\n' + text, 'example.test')
+        with self.assertRaises(ZoneException):
+            parse_zone('a A 1.2.3.4', 'example.test')
+
+
+class ResponderTests(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.responder = Responder()
+        cls.responder.add_zone('example.test.', parse_zone(ZONE, 'example.test.'))
+
+    def _ask(self, name: str, qtype: int, **kwargs) -> dict:
+        query = make_query(name, qtype, ident=4321, **kwargs)
+        response = self.responder.respond(query)
+        # The question is echoed as sent, case included.
+        self.assertEqual(query[12:12 + len(to_wire(name)) + 4], response[12:12 + len(to_wire(name)) + 4])
+        result = parse_response(response)
+        self.assertEqual(4321, result['id'])
+        return result
+
+    def test_answer_with_glue(self):
+        result = self._ask('Example.TEST', MX)
+        self.assertEqual((0, True), (result['rcode'], result['aa']))
+        self.assertEqual([(b'\x07Example\x04TEST\x00', MX, 3600)], [record[:3] for record in result['answers']])
+        # The exchange is compressed against the question, so it comes back in the question's case.
+        self.assertEqual(b'\x00\x0a' + to_wire('mail.example.test.'), result['answers'][0][3].lower())
+        self.assertEqual([A, AAAA], [record[1] for record in result['additional']])
+        self.assertEqual(2, len(self._ask('example.test', NS)['answers']))
+        self.assertEqual(4, len(self._ask('example.test', ANY)['answers']))
+
+    def test_cname(self):
+        answers = self._ask('www.example.test', A)['answers']
+        self.assertEqual([CNAME, A], [record[1] for record in answers])
+        self.assertEqual(b'\xc0\x00\x02\x19', answers[1][3])
+        self.assertEqual([CNAME], [record[1] for record in self._ask('www.example.test', TXT)['answers']])
+
+    def test_negative(self):
+        nxdomain = self._ask('nothing.example.test', A)
+        self.assertEqual((3, []), (nxdomain['rcode'], nxdomain['answers']))
+        # Negative TTL is the smaller of the SOA TTL and MINIMUM.
+        self.assertEqual([(to_wire('example.test.'), SOA, 300)], [record[:3] for record in nxdomain['authority']])
+        nodata = self._ask('mail.example.test', MX)
+        self.assertEqual((0, [], SOA), (nodata['rcode'], nodata['answers'], nodata['authority'][0][1]))
+        # An empty non-terminal exists, so it is NODATA rather than NXDOMAIN.
+        self.assertEqual(0, self._ask('er.name.example.test', A)['rcode'])
+        self.assertEqual(5, self._ask('example.org', A)['rcode'])
+
+    def test_wildcard(self):
+        result = self._ask('Web.apps.example.test', A)
+        self.assertEqual([(b'\x03Web\x04apps\x07example\x04test\x00', A, 3600, b'\xc0\x00\x02\x50')],
+                         result['answers'])
+        self.assertEqual(SOA, self._ask('web.apps.example.test', MX)['authority'][0][1])
+        # Any depth below the closest encloser matches (RFC 4592).
+        self.assertEqual(1, len(self._ask('a.b.apps.example.test', A)['answers']))
+
+    def test_delegation(self):
+        for name in ('sub.example.test', 'host.sub.example.test', 'ns.sub.example.test'):
+            result = self._ask(name, A)
+            self.assertEqual((0, False, []), (result['rcode'], result['aa'], result['answers']))
+            self.assertEqual([(to_wire('sub.example.test.'), NS)], [record[:2] for record in result['authority']])
+            self.assertEqual([b'\xc0\x00\x02\x35'], [record[3] for record in result['additional']])
+
+    def test_edns_and_truncation(self):
+        responder = Responder()
+        text = '$TTL 60\n@ SOA ns admin 1 2 3 4 5\n' + '\n'.join(f'big TXT "{i:0>200}"' for i in range(4))
+        responder.add_zone('big.test.', parse_zone(text, 'big.test.'))
+        plain = parse_response(responder.respond(make_query('big.big.test', TXT)))
+        self.assertEqual((True, []), (plain['tc'], plain['answers']))
+        result = parse_response(responder.respond(make_query('big.big.test', TXT, edns=True)))
+        self.assertEqual((False, 4), (result['tc'], len(result['answers'])))
+        self.assertEqual(41, result['additional'][-1][1])
+        self.assertEqual(4, len(parse_response(responder.respond(make_query('big.big.test', TXT), 65535))['answers']))
+
+    def test_malformed(self):
+        self.assertIsNone(self.responder.respond(b'\x00' * 5))
+        query = make_query('example.test', A)
+        self.assertIsNone(self.responder.respond(query[:2] + b'\x80' + query[3:]))
+        self.assertEqual(1, parse_response(self.responder.respond(query[:-3]))['rcode'])
+        self.assertEqual(4, parse_response(self.responder.respond(query[:2] + b'\x29' + query[3:]))['rcode'])
+
+
+class ServerTests(TestCase):
+    def setUp(self) -> None:
+        responder = Responder()
+        responder.add_zone('example.test.', parse_zone(ZONE, 'example.test.'))
+        self.server = DnsServer(responder, port=0)
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.server.start())
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.close()
+
+    def test_udp_batch(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(5)
+            for ident in range(200):
+                sock.sendto(make_query(f'n{ident}.apps.example.test', A, ident), ('127.0.0.1', self.server.port))
+            replies = [parse_response(sock.recv(512)) for _ in range(200)]
+        self.assertEqual(set(range(200)), {reply['id'] for reply in replies})
+        self.assertEqual(200, self.server.queries)
+
+    def test_tcp(self):
+        with socket.create_connection(('127.0.0.1', self.server.port), timeout=5) as sock:
+            queries = [make_query('mail.example.test', ANY, 1), make_query('example.test', SOA, 2)]
+            sock.sendall(b''.join(len(query).to_bytes(2, 'big') + query for query in queries))
+            file = sock.makefile('rb')
+            replies = [parse_response(file.read(int.from_bytes(file.read(2), 'big'))) for _ in queries]
+            file.close()
+        self.assertEqual([(1, 2), (2, 1)], [(reply['id'], len(reply['answers'])) for reply in replies])
+
+
+class SyncTests(TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def _start(self, count: int) -> None:
+        self.master = FakeMaster('example.test.', count)
+        self.addCleanup(self.master.close)
+        self.store = ZoneStore(os.path.join(self.directory, 'zone.db'), 'example.test.')
+        self.addCleanup(self.store.close)
+        self.zone_file = os.path.join(self.directory, 'example.test.txt')
+        self.sync = ZoneSync('example.test.', self.master.address, self.store, self.zone_file)
+        self.addCleanup(self.sync.stop)
+
+    def _change(self, index: int, last: int) -> None:
+        old = next(islice(synthetic('example.test.', index + 1), index, None))
+        self.master.change([(old[0], A, 60, bytes((192, 0, 2, last)))], [old])
+
+    def assertInSync(self) -> None:
+        self.assertEqual(self.master.serial, self.store.serial)
+        self.assertEqual(sorted(self.master.records()), sorted(self.store.records()))
+
+    def test_axfr_then_ixfr(self):
+        self._start(1000)
+        self.assertEqual('axfr', self.sync.refresh())
+        self.assertInSync()
+        count = len(self.store)
+        self.assertEqual(count, len(list(self.master.records())))
+        self.assertEqual('current', self.sync.refresh())
+        exported = read_zone(self.zone_file, 'example.test.')
+        for index in (5, 6, 500):
+            self._change(index, index & 255)
+        self.master.change([(to_wire('new.example.test.'), TXT, 60, b'\x03new')], [])
+        self.master.queries.clear()
+        self.assertEqual('ixfr', self.sync.refresh())
+        self.assertEqual([SOA, IXFR], self.master.queries)
+        self.assertInSync()
+        self.assertEqual(count + 1, len(self.store))
+        # Written again only once export_interval has passed since the AXFR's export.
+        self.assertEqual(exported, read_zone(self.zone_file, 'example.test.'))
+        self.assertGreater(self.sync.export_due(), 0)
+        self.sync.export_interval = 0
+        self.assertEqual('current', self.sync.refresh())
+        self.assertIsNone(self.sync.export_due())
+        # The exported file is a zone file again, with the same records.
+        records = read_zone(self.zone_file, 'example.test.')
+        self.assertEqual((SOA, self.master.serial), (records[0].type, struct.unpack('!I', records[0].rdata[2][:4])[0]))
+        self.assertEqual(sorted(self.master.records()),
+                         sorted((record.name, record.type, record.ttl, b''.join(record.rdata)) for record in records[1:]))
+
+    def test_fallback_to_axfr(self):
+        self._start(200)
+        self.sync.refresh()
+        # The master lost its history, so IXFR is answered with the whole zone.
+        self._change(1, 1)
+        self.master.forget()
+        self.assertEqual('axfr', self.sync.refresh())
+        self.assertInSync()
+        # A diff that deletes a record the store does not have is rolled back, then AXFR is used.
+        serial = self.store.serial
+        added = (to_wire('new.example.test.'), A, 60, b'\x7f\x00\x00\x01')
+        with self.assertRaises(SyncException):
+            self.store.apply([Diff(serial, self.master.soa(serial + 1), [(b'\x01x\x00', A, 1, b'')], [added])])
+        self.assertEqual((serial, 201), (self.store.serial, len(self.store)))
+        self.master.queries.clear()
+        os.unlink(self.zone_file)
+        self._change(3, 3)
+        with self.store._lock:
+            self.store._db.execute('DELETE FROM records WHERE name = ?', (to_wire('host3.example.test.'),))
+        self.assertEqual('axfr', self.sync.refresh())
+        self.assertEqual([SOA, IXFR, AXFR], self.master.queries)
+        self.assertInSync()
+        self.assertTrue(os.path.exists(self.zone_file))
+
+    def test_notify(self):
+        self._start(100)
+        # Configured by name, the master is still recognised by the address its NOTIFY comes from.
+        self.sync.master = ('localhost', self.master.address[1])
+        self.sync.refresh()
+        port = self.sync.listen('127.0.0.1', 0)
+        thread = Thread(target=self.sync.run, args=(3600,), daemon=True)
+        thread.start()
+        self._change(7, 7)
+        self.assertTrue(self.master.notify(('127.0.0.1', port)))
+        deadline = time.monotonic() + 5
+        while self.store.serial != self.master.serial and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertInSync()
+        self.sync.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith('.tmp')])
+
+    def test_million_records(self):
+        self._start(1000000)
+        # Seeded as if by an earlier AXFR; the test is what one IXFR costs against a zone this size.
+        self.store.replace(self.master.soa(), self.master.records())
+        self.sync.zone_file = None
+        for index in (10, 500000, 999999):
+            self._change(index, 1)
+        self.assertEqual('ixfr', self.sync.refresh())
+        self.assertEqual(self.master.serial, self.store.serial)
+        self.assertEqual(1000001, len(self.store))
+        self.assertLess(self.master.sent, 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
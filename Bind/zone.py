@@ -0,0 +1,297 @@
+import os
+import re
+import socket
+import struct
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Tuple
+
+TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28, 'SRV': 33}
+TYPE_NAMES = {value: name for name, value in TYPES.items()}
+CLASSES = {'IN', 'CH', 'HS'}
+TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[()]|;.*|[^\s()";]+')
+LABEL = re.compile(r'(?:[^.\\]|\\(?:\d{3}|.))+')
+SAFE_LABEL = re.compile(rb'^[A-Za-z0-9_*-]+$')
+GENERIC_TYPE = re.compile(r'^TYPE\d{1,5}$')
+ZONE = re.compile(r'zone\s+"([^"]+)"\s*(?:IN\s+)?\{', re.I)
+
+
+@dataclass
+class ZoneException(Exception):
+    message: str
+
+
+class Name(bytes):
+    # A wire-format name inside rdata, kept apart from plain bytes so it can be compressed.
+    pass
+
+
+@dataclass
+class Record:
+    name: bytes
+    type: int
+    ttl: int
+    rdata: List[bytes]
+
+
+def _unescape(text: str) -> bytes:
+    return re.sub(rb'\\(\d{3}|.)', lambda match: bytes([int(match.group(1))]) if len(match.group(1)) == 3
+                  else match.group(1), text.encode(), flags=re.S)
+
+
+def to_wire(name: str) -> bytes:
+    if '\\' in name:
+        labels = [_unescape(label) for label in LABEL.findall(name)]
+    else:
+        try:
+            labels = [label.encode('ascii') for label in name.rstrip('.').split('.')] if name.strip('.') else []
+        except UnicodeEncodeError:
+            raise ZoneException(f'Non-ASCII name {name}')
+    wire = b''
+    for label in labels:
+        if not 0 < len(label) < 64:
+            raise ZoneException(f'Bad label in {name}')
+        wire += bytes([len(label)]) + label
+    if len(wire) > 254:
+        raise ZoneException(f'Name too long: {name}')
+    return wire + b'\x00'
+
+
+def _label_text(label: bytes) -> str:
+    if SAFE_LABEL.match(label):
+        return label.decode()
+    return ''.join(chr(byte) if SAFE_LABEL.match(bytes([byte])) else f'\\{byte:03d}' for byte in label)
+
+
+def to_text(wire: bytes) -> str:
+    labels, position = [], 0
+    while wire[position]:
+        labels.append(_label_text(wire[position + 1:position + 1 + wire[position]]))
+        position += wire[position] + 1
+    return '.'.join(labels) + '.'
+
+
+def type_name(rtype: int) -> str:
+    return TYPE_NAMES.get(rtype, f'TYPE{rtype}')
+
+
+def _type(token: str) -> int:
+    # Mnemonics, or the TYPEnnn form of RFC 3597 for everything else; 0 when the token is no type.
+    token = token.upper()
+    if token in TYPES:
+        return TYPES[token]
+    return int(token[4:]) if GENERIC_TYPE.match(token) else 0
+
+
+def _absolute(name: str, origin: str) -> str:
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return name
+    return f'{name}.' if origin == '.' else f'{name}.{origin}'
+
+
+def _ttl(token: str) -> int:
+    if token.isdigit():
+        return int(token)
+    parts = re.findall(r'(\d+)([smhdw])', token.lower())
+    if not parts or ''.join(number + unit for number, unit in parts) != token.lower():
+        raise ZoneException(f'Bad TTL or unknown type: {token}')
+    return sum(int(number) * TTL_UNITS[unit] for number, unit in parts)
+
+
+def _lines(text: str) -> Iterator[Tuple[bool, List[str]]]:
+    # Logical lines: parentheses join physical ones; a leading blank means "same owner as before".
+    tokens: List[str] = []
+    depth, blank = 0, False
+    for number, line in enumerate(text.splitlines(), 1):
+        if depth == 0 and not tokens:
+            blank = line[:1] in (' ', '\t')
+        for token in TOKEN.findall(line):
+            if token.startswith(';'):
+                break
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth < 0:
+                    raise ZoneException(f'Unbalanced ")" on line {number}')
+            else:
+                tokens.append(token)
+        if depth == 0 and tokens:
+            yield blank, tokens
+            tokens = []
+    if depth:
+        raise ZoneException('Unbalanced "("')
+
+
+def _character_strings(tokens: List[str]) -> bytes:
+    data = b''
+    for token in tokens:
+        raw = _unescape(token[1:-1] if token.startswith('"') else token)
+        for start in range(0, max(len(raw), 1), 255):
+            chunk = raw[start:start + 255]
+            data += bytes([len(chunk)]) + chunk
+    return data
+
+
+def _rdata(rtype: int, tokens: List[str], origin: str) -> List[bytes]:
+    def name(token: str) -> Name:
+        return Name(to_wire(_absolute(token, origin)))
+
+    if tokens[:1] == ['\\#']:
+        # RFC 3597 generic rdata: \# length hex.
+        try:
+            data = bytes.fromhex(''.join(tokens[2:]))
+            if len(data) == int(tokens[1]):
+                return [data]
+        except (IndexError, ValueError):
+            pass
+        raise ZoneException(f'Bad {type_name(rtype)} record: {" ".join(tokens)}')
+    counts = {1: 1, 2: 1, 5: 1, 6: 7, 12: 1, 15: 2, 28: 1, 33: 4}
+    if rtype in counts and len(tokens) != counts[rtype] or not tokens or rtype not in TYPE_NAMES:
+        raise ZoneException(f'Bad {type_name(rtype)} record: {" ".join(tokens)}')
+    try:
+        if rtype == 1:
+            return [socket.inet_pton(socket.AF_INET, tokens[0])]
+        if rtype == 28:
+            return [socket.inet_pton(socket.AF_INET6, tokens[0])]
+        if rtype in (2, 5, 12):
+            return [name(tokens[0])]
+        if rtype == 6:
+            return [name(tokens[0]), name(tokens[1]), struct.pack('!IIIII', *map(_ttl, tokens[2:]))]
+        if rtype == 15:
+            return [struct.pack('!H', int(tokens[0])), name(tokens[1])]
+        if rtype == 33:
+            return [struct.pack('!HHH', *map(int, tokens[:3])), name(tokens[3])]
+        return [_character_strings(tokens)]
+    except (OSError, ValueError, struct.error):
+        raise ZoneException(f'Bad {type_name(rtype)} record: {" ".join(tokens)}')
+
+
+def _name_end(rdata: bytes, position: int) -> int:
+    while rdata[position]:
+        position += rdata[position] + 1
+    return position + 1
+
+
+def _quoted(data: bytes) -> str:
+    return '"' + ''.join(chr(byte) if 32 <= byte < 127 and byte not in (34, 92) else f'\\{byte:03d}'
+                         for byte in data) + '"'
+
+
+def rdata_text(rtype: int, rdata: bytes) -> str:
+    # Presentation format of uncompressed rdata; anything unusual is written in the generic form.
+    try:
+        if rtype == 1 and len(rdata) == 4:
+            return socket.inet_ntop(socket.AF_INET, rdata)
+        if rtype == 28 and len(rdata) == 16:
+            return socket.inet_ntop(socket.AF_INET6, rdata)
+        if rtype in (2, 5, 12) and _name_end(rdata, 0) == len(rdata):
+            return to_text(rdata)
+        if rtype == 15 and _name_end(rdata, 2) == len(rdata):
+            return f'{struct.unpack_from("!H", rdata)[0]} {to_text(rdata[2:])}'
+        if rtype == 33 and _name_end(rdata, 6) == len(rdata):
+            return '{} {} {} '.format(*struct.unpack_from('!HHH', rdata)) + to_text(rdata[6:])
+        if rtype == 6:
+            middle = _name_end(rdata, 0)
+            if _name_end(rdata, middle) + 20 == len(rdata):
+                return ' '.join([to_text(rdata), to_text(rdata[middle:]),
+                                 *map(str, struct.unpack('!IIIII', rdata[-20:]))])
+        if rtype == 16 and rdata:
+            strings, position = [], 0
+            while position < len(rdata):
+                strings.append(_quoted(rdata[position + 1:position + 1 + rdata[position]]))
+                position += rdata[position] + 1
+            if position == len(rdata):
+                return ' '.join(strings)
+    except (IndexError, struct.error):
+        pass
+    return f'\\# {len(rdata)} {rdata.hex()}'.rstrip()
+
+
+def parse_zone(text: str, origin: str, default_ttl: int = None) -> List[Record]:
+    origin = _absolute(origin, '.')
+    records: List[Record] = []
+    owner, ttl, last_ttl = None, default_ttl, None
+    for blank, tokens in _lines(text):
+        if tokens[0].startswith('$'):
+            directive = tokens[0].upper()
+            if directive == '$ORIGIN' and len(tokens) == 2:
+                origin = _absolute(tokens[1], origin)
+            elif directive == '$TTL' and len(tokens) == 2:
+                ttl = _ttl(tokens[1])
+            else:
+                raise ZoneException(f'Unsupported directive: {" ".join(tokens)}')
+            continue
+        if not blank:
+            owner = _absolute(tokens.pop(0), origin)
+        if owner is None:
+            raise ZoneException('Record without owner')
+        record_ttl = None
+        while tokens and not _type(tokens[0]):
+            token = tokens.pop(0)
+            if token.upper() in CLASSES:
+                if token.upper() != 'IN':
+                    raise ZoneException(f'Only class IN is served: {owner}')
+                continue
+            record_ttl = _ttl(token)
+        if not tokens:
+            raise ZoneException(f'No record type for {owner}')
+        rtype = _type(tokens.pop(0))
+        # Without $TTL or an explicit TTL the previous record's one applies, as in RFC 1035.
+        record_ttl = record_ttl if record_ttl is not None else ttl if ttl is not None else last_ttl
+        if record_ttl is None:
+            raise ZoneException(f'No TTL for {owner}')
+        last_ttl = record_ttl
+        records.append(Record(to_wire(owner).lower(), rtype, record_ttl, _rdata(rtype, tokens, origin)))
+    return records
+
+
+def read_zone(path: str, origin: str) -> List[Record]:
+    with open(path) as file:
+        return parse_zone(file.read(), origin)
+
+
+def _zones(path: str) -> Iterator[Tuple[str, str, str, str]]:
+    # (origin, type, file, body) of each zone statement; absolute paths missing here are looked up next to the config.
+    with open(path) as file:
+        text = file.read()
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'(//|#).*', '', text)
+    directory = os.path.dirname(os.path.abspath(path))
+    for match in ZONE.finditer(text):
+        depth, position = 1, match.end()
+        while depth and position < len(text):
+            depth += {'{': 1, '}': -1}.get(text[position], 0)
+            position += 1
+        body = text[match.end():position - 1]
+        kind = re.search(r'\btype\s+(\w+)\s*;', body)
+        zone_file = re.search(r'\bfile\s+"([^"]+)"', body)
+        if not kind or not zone_file:
+            continue
+        zone_path = zone_file.group(1)
+        if not os.path.isabs(zone_path):
+            zone_path = os.path.join(directory, zone_path)
+        elif not os.path.exists(zone_path):
+            zone_path = os.path.join(directory, os.path.basename(zone_path))
+        yield _absolute(match.group(1), '.'), kind.group(1).lower(), zone_path, body
+
+
+def load_config(path: str) -> Dict[str, str]:
+    return {origin: zone_path for origin, kind, zone_path, _ in _zones(path) if kind in ('master', 'primary')}
+
+
+def load_slaves(path: str) -> Dict[str, Tuple[str, List[Tuple[str, int]]]]:
+    slaves = {}
+    for origin, kind, zone_path, body in _zones(path):
+        block = re.search(r'\b(?:masters|primaries)\s*(?:port\s+(\d+)\s*)?\{([^}]*)\}', body)
+        if kind not in ('slave', 'secondary') or not block:
+            continue
+        default_port = int(block.group(1) or 53)
+        masters = []
+        for entry in filter(None, (item.split() for item in block.group(2).split(';'))):
+            port = int(entry[entry.index('port') + 1]) if 'port' in entry else default_port
+            masters.append((entry[0], port))
+        slaves[origin] = (zone_path, masters)
+    return slaves
@@ -0,0 +1,38 @@
+import argparse
+import json
+import time
+from typing import Dict
+
+from stub_server import StubServer
+from weather import WeatherClient, batch
+
+
+def bench(server: StubServer, cities: int, workers: int) -> Dict[str, float]:
+    url = server.url
+    client = WeatherClient('key', None, weather_url=f'{url}/weather', onecall_url=f'{url}/onecall', pool_size=workers)
+    start = time.perf_counter()
+    with client:
+        counts = batch(client, [f'City{i}' for i in range(cities)], 7, workers)
+    elapsed = time.perf_counter() - start
+    return {'seconds': round(elapsed, 3), 'cities_per_second': round(cities / elapsed, 1), **counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Weather batch benchmark')
+    parser.add_argument('-n', '--cities', type=int, default=300)
+    parser.add_argument('-l', '--latency', type=float, default=0.05, help='Stub server delay per request')
+    parser.add_argument('-w', '--workers', default='1,8,32,64', help='Comma separated pool sizes')
+    args = parser.parse_args()
+    results = {}
+    for workers in map(int, args.workers.split(',')):
+        # A fresh server each run, so no forecast or connection is shared between runs.
+        server = StubServer(latency=args.latency)
+        try:
+            results[workers] = bench(server, args.cities, workers)
+        finally:
+            server.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
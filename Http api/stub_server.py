@@ -0,0 +1,85 @@
+import json
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+DAILY = [{'temp': {'morn': i, 'day': i + 10, 'night': i - 5}, 'humidity': 50 + i} for i in range(8)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; with Nagle on, keep-alive requests stall on delayed ACKs.
+    disable_nagle_algorithm = True
+    server: 'StubServer'
+
+    def _reply(self, status: int, body: dict = None, headers: Dict[str, str] = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.peak = max(self.server.peak, self.server.active)
+        try:
+            self._get()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def _get(self) -> None:
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, query, dict(self.headers)))
+        self.server.clients.add(self.client_address)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if query.get('appid') != 'key':
+            return self._reply(401, {'cod': 401, 'message': 'Invalid API key'})
+        if url.path.endswith('/weather'):
+            if query['q'] == 'Nowhere':
+                return self._reply(404, {'cod': '404', 'message': 'city not found'})
+            # Every city gets its own stable coordinates, so forecasts are not shared between cities.
+            checksum = zlib.crc32(query['q'].encode())
+            coord = {'lat': checksum % 18000 / 100 - 90, 'lon': checksum % 36000 / 100 - 180}
+            return self._reply(200, {'coord': coord, 'name': query['q']})
+        if self.headers.get('If-None-Match') == '"v1"':
+            return self._reply(304, headers={'ETag': '"v1"', 'Cache-Control': self.server.cache_control})
+        self._reply(200, {'daily': DAILY}, {'ETag': '"v1"', 'Cache-Control': self.server.cache_control})
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    requests: List[tuple]
+    clients: set
+    latency: float
+    active: int
+    peak: int
+    lock: Lock
+    cache_control: str = 'max-age=60'
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.requests, self.clients = [], set()
+        self.latency = latency
+        self.active = self.peak = 0
+        self.lock = Lock()
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/data/2.5'
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,136 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from typing import List
+from unittest import TestCase, mock
+
+from stub_server import StubServer
+from weather import ApiException, TokenBucket, WeatherClient, batch, max_age, read_cities
+
+
+class WeatherTests(TestCase):
+    def setUp(self) -> None:
+        self.server = StubServer()
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory, 'geocode.json')
+
+    def tearDown(self) -> None:
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _client(self, api_key: str = 'key') -> WeatherClient:
+        return WeatherClient(api_key, self.cache, weather_url=f'{self.server.url}/weather',
+                             onecall_url=f'{self.server.url}/onecall')
+
+    def _paths(self) -> List[str]:
+        return [path.rsplit('/', 1)[1] for path, _, _ in self.server.requests]
+
+    def test_format(self):
+        with self._client() as client:
+            result = client.get_weather('Ekaterinburg', 2)
+        self.assertEqual(['morn: 0 °C\nday: 10 °C\nnight: -5 °C\nhumidity: 50\r\n',
+                          'morn: 1 °C\nday: 11 °C\nnight: -4 °C\nhumidity: 51\r\n'], result)
+        self.assertEqual(['Invalid days count'], self._client().get_weather('Ekaterinburg', 8))
+
+    def test_keep_alive_and_ttl(self):
+        with self._client() as client:
+            for _ in range(3):
+                client.get_weather('Ekaterinburg', 1)
+        self.assertEqual(['weather', 'onecall'], self._paths())
+        self.assertEqual(1, len(self.server.clients))
+
+    def test_geocode_cache_on_disk(self):
+        with self._client() as client:
+            client.get_weather('Ekaterinburg', 1)
+            coordinates = client.coordinates('Ekaterinburg')
+        with self._client() as client:
+            self.assertEqual(coordinates, client.coordinates('ekaterinburg '))
+        self.assertEqual(['weather', 'onecall'], self._paths())
+
+    def test_geocode_cache_written_once(self):
+        with self._client() as client, mock.patch('weather.os.replace', wraps=os.replace) as replace:
+            counts = batch(client, [f'City{i}' for i in range(20)], 1, workers=4)
+            self.assertEqual(20, counts['ok'])
+            self.assertEqual(1, replace.call_count)
+        with open(self.cache) as file:
+            self.assertEqual(20, len(json.load(file)))
+
+    def test_revalidation(self):
+        self.server.cache_control = 'no-cache'
+        with self._client() as client:
+            first = client.forecast('Ekaterinburg')
+            second = client.forecast('Ekaterinburg')
+        self.assertEqual(first, second)
+        self.assertEqual(['weather', 'onecall', 'onecall'], self._paths())
+        self.assertEqual('"v1"', self.server.requests[-1][2].get('If-None-Match'))
+
+    def test_no_store(self):
+        self.server.cache_control = 'no-store'
+        with self._client() as client:
+            client.forecast('Ekaterinburg')
+            client.forecast('Ekaterinburg')
+        self.assertNotIn('If-None-Match', self.server.requests[-1][2])
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_errors(self):
+        with self.assertRaises(ApiException) as context:
+            self._client().get_weather('Nowhere', 1)
+        self.assertEqual('city not found', context.exception.message)
+        with self.assertRaises(ApiException) as context:
+            self._client('wrong').get_weather('Ekaterinburg', 1)
+        self.assertEqual('Invalid API key', context.exception.message)
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_max_age(self):
+        self.assertEqual(60, max_age({'Cache-Control': 'public, max-age=60'}))
+        self.assertEqual(0, max_age({'Cache-Control': 'no-cache'}))
+        self.assertIsNone(max_age({'Cache-Control': 'no-store, max-age=60'}))
+        self.assertEqual(-1, max_age({}))
+
+
+class BatchTests(TestCase):
+    def setUp(self) -> None:
+        self.server = StubServer(latency=0.02)
+        self.url = self.server.url
+
+    def tearDown(self) -> None:
+        self.server.close()
+
+    def _client(self, **kwargs) -> WeatherClient:
+        return WeatherClient('key', None, weather_url=f'{self.url}/weather', onecall_url=f'{self.url}/onecall',
+                             **kwargs)
+
+    def test_partial_failures_streamed(self):
+        cities = list(read_cities(io.StringIO('# dashboard\nMoscow\n\nNowhere\nKazan\nMoscow\n')))
+        output = io.StringIO()
+        with self._client() as client:
+            counts = batch(client, cities, 2, workers=4, output=output)
+        self.assertEqual({'ok': 2, 'failed': 1}, counts)
+        records = {record['city']: record for record in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual({'Moscow', 'Nowhere', 'Kazan'}, set(records))
+        self.assertEqual('city not found', records['Nowhere']['error'])
+        self.assertEqual({'morn': 1, 'day': 11, 'night': -4, 'humidity': 51}, records['Kazan']['days'][1])
+
+    def test_concurrency_capped(self):
+        start = time.perf_counter()
+        with self._client(pool_size=5) as client:
+            counts = batch(client, [f'City{i}' for i in range(40)], 1, workers=5)
+        self.assertEqual(40, counts['ok'])
+        self.assertLessEqual(self.server.peak, 5)
+        self.assertLessEqual(len(self.server.clients), 5)
+        # 80 requests at 20ms each: serially that is at least 1.6s.
+        self.assertLess(time.perf_counter() - start, 1.2)
+
+    def test_rate_limited(self):
+        start = time.perf_counter()
+        with self._client(bucket=TokenBucket(rate=50, burst=1)) as client:
+            batch(client, [f'City{i}' for i in range(10)], 1, workers=10)
+        self.assertGreaterEqual(time.perf_counter() - start, 19 / 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,17 @@
+import json
+import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import List
+from threading import Lock
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
 import requests
 import argparse
+from requests.adapters import HTTPAdapter
+
+WEATHER_URL = 'http://api.openweathermap.org/data/2.5/weather'
+ONECALL_URL = 'https://api.openweathermap.org/data/2.5/onecall'
 
 
 @dataclass
@@ -10,37 +19,260 @@ class ApiException(Exception):
     message: str
 
 
-def get_weather(city: str, days_count: int, api_key: str) -> List[str]:
-    if days_count > 7 or days_count < 1:
-        return ['Invalid days count']
-    response: requests.Response = None
+@dataclass
+class CachedResponse:
+    data: dict
+    expires: float
+    etag: Optional[str] = None
+
+
+def max_age(headers) -> Optional[float]:
+    # None means "not cacheable", 0 means "cache but revalidate every time".
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0.0
     try:
-        response = requests.get(f'http://api.openweathermap.org/data/2.5/weather?q={city}&units=metric&APPID={api_key}')
-        lon = response.json()['coord']['lon']
-        lat = response.json()['coord']['lat']
-        url = f'https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&units=metric&appid={api_key}'
-        response = requests.get(url)
+        return float(directives['max-age'])
+    except (KeyError, ValueError):
+        return -1.0
+
+
+class TokenBucket:
+    _rate: float
+    _capacity: float
+    _tokens: float
+    _updated: float
+    _lock: Lock
+
+    def __init__(self, rate: float, burst: float = None):
+        self._rate = rate
+        self._capacity = burst or max(1.0, rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self._rate
+            time.sleep(delay)
+
+
+class WeatherClient:
+    _api_key: str
+    _session: requests.Session
+    _cache_path: Optional[str]
+    _coordinates: Dict[str, Tuple[float, float]]
+    _unsaved: int
+    _responses: Dict[str, CachedResponse]
+    _lock: Lock
+    _bucket: Optional[TokenBucket]
+    weather_url: str
+    onecall_url: str
+    default_ttl: float
+    timeout: float = 10
+
+    def __init__(self, api_key: str, cache_path: Optional[str] = 'geocode_cache.json', default_ttl: float = 600,
+                 weather_url: str = WEATHER_URL, onecall_url: str = ONECALL_URL, session: requests.Session = None,
+                 pool_size: int = 10, bucket: TokenBucket = None):
+        self._api_key = api_key
+        if session is None:
+            # One kept-alive connection per worker thread, instead of requests' default of 10.
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self._session = session
+        self._bucket = bucket
+        self._cache_path = cache_path
+        self._coordinates = self._load_coordinates()
+        self._unsaved = 0
+        self._responses = {}
+        self._lock = Lock()
+        self.default_ttl = default_ttl
+        self.weather_url, self.onecall_url = weather_url, onecall_url
+
+    def _load_coordinates(self) -> Dict[str, Tuple[float, float]]:
+        if not self._cache_path:
+            return {}
+        try:
+            with open(self._cache_path) as file:
+                return {city: tuple(coordinates) for city, coordinates in json.load(file).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def save_coordinates(self) -> None:
+        # New cities are kept in memory and written once, at the end of a batch or on close.
+        with self._lock:
+            if not self._cache_path or not self._unsaved:
+                return
+            temporary = f'{self._cache_path}.{os.getpid()}.tmp'
+            with open(temporary, 'w') as file:
+                json.dump(self._coordinates, file, ensure_ascii=False)
+            os.replace(temporary, self._cache_path)
+            self._unsaved = 0
+
+    def _request(self, url: str, params: Dict[str, object], headers: Dict[str, str] = None) -> requests.Response:
+        if self._bucket:
+            self._bucket.acquire()
+        try:
+            return self._session.get(url, params={**params, 'appid': self._api_key}, headers=headers,
+                                     timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise ApiException(str(exc))
+
+    @staticmethod
+    def _parse(response: requests.Response) -> dict:
+        try:
+            data = response.json()
+        except ValueError:
+            raise ApiException(f'{response.status_code} {response.reason}')
+        if response.status_code != 200:
+            raise ApiException(str(data.get('message', response.reason)))
+        return data
+
+    def _get_cached(self, url: str, params: Dict[str, object]) -> dict:
+        key = requests.Request('GET', url, params=params).prepare().url
+        with self._lock:
+            cached = self._responses.get(key)
+        if cached and cached.expires > time.time():
+            return cached.data
+        response = self._request(url, params, {'If-None-Match': cached.etag} if cached and cached.etag else None)
+        data = cached.data if response.status_code == 304 and cached else self._parse(response)
+        ttl = max_age(response.headers)
+        if ttl is None:
+            with self._lock:
+                self._responses.pop(key, None)
+            return data
+        expires = time.time() + (self.default_ttl if ttl < 0 else ttl)
+        etag = response.headers.get('ETag') or (cached.etag if cached else None)
+        with self._lock:
+            self._responses[key] = CachedResponse(data, expires, etag)
+        return data
+
+    def coordinates(self, city: str) -> Tuple[float, float]:
+        key = city.strip().lower()
+        with self._lock:
+            if key in self._coordinates:
+                return self._coordinates[key]
+        data = self._parse(self._request(self.weather_url, {'q': city, 'units': 'metric'}))
+        try:
+            coordinates = (data['coord']['lat'], data['coord']['lon'])
+        except KeyError:
+            raise ApiException(str(data.get('message', 'No coordinates in response')))
+        with self._lock:
+            self._coordinates[key] = coordinates
+            self._unsaved += 1
+        return coordinates
+
+    def forecast(self, city: str) -> dict:
+        lat, lon = self.coordinates(city)
+        return self._get_cached(self.onecall_url, {'lat': lat, 'lon': lon, 'units': 'metric'})
+
+    def days(self, city: str, days_count: int) -> List[Dict[str, float]]:
+        forecast = self.forecast(city)
+        try:
+            return [{**{value: day['temp'][value] for value in ['morn', 'day', 'night']}, 'humidity': day['humidity']}
+                    for day in forecast['daily'][:days_count]]
+        except (KeyError, TypeError):
+            raise ApiException(str(forecast.get('message', 'Malformed forecast')))
+
+    def get_weather(self, city: str, days_count: int) -> List[str]:
+        if days_count > 7 or days_count < 1:
+            return ['Invalid days count']
         result = []
-        for i in range(days_count):
-            string = '\n'.join([f"{value}: {response.json()['daily'][i]['temp'][value]} °C" for value in ['morn', 'day', 'night']])
-            string += f"\nhumidity: {response.json()['daily'][i]['humidity']}\r\n"
+        for day in self.days(city, days_count):
+            string = '\n'.join([f"{value}: {day[value]} °C" for value in ['morn', 'day', 'night']])
+            string += f"\nhumidity: {day['humidity']}\r\n"
             result.append(string)
         return result
-    except KeyError:
-        raise ApiException(response.json()['message'])
+
+    def close(self) -> None:
+        try:
+            self.save_coordinates()
+        finally:
+            self._session.close()
+
+    def __enter__(self) -> 'WeatherClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def get_weather(city: str, days_count: int, api_key: str) -> List[str]:
+    with WeatherClient(api_key) as client:
+        return client.get_weather(city, days_count)
+
+
+def read_cities(file: IO[str]) -> Iterator[str]:
+    for line in file:
+        city = line.strip()
+        if city and not city.startswith('#'):
+            yield city
+
+
+def fetch_city(client: WeatherClient, city: str, days_count: int) -> Dict[str, object]:
+    try:
+        return {'city': city, 'days': client.days(city, days_count)}
+    except ApiException as exc:
+        return {'city': city, 'error': exc.message}
+
+
+def batch(client: WeatherClient, cities: Iterable[str], days_count: int, workers: int = 16,
+          output: IO[str] = None) -> Dict[str, int]:
+    # Each worker has at most one request in flight, so workers caps the concurrency.
+    counts = {'ok': 0, 'failed': 0}
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(fetch_city, client, city, days_count) for city in dict.fromkeys(cities)]
+        for future in as_completed(futures):
+            record = future.result()
+            counts['failed' if 'error' in record else 'ok'] += 1
+            if output:
+                print(json.dumps(record, ensure_ascii=False), file=output, flush=True)
+    client.save_coordinates()
+    return counts
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='weather.py', description='Http-api weather')
     parser.add_argument('-c', '--city', type=str, default='Ekaterinburg')
     parser.add_argument('-r', '--range', type=int, default=1)
+    parser.add_argument('--cache', default='geocode_cache.json', help='City coordinates cache file')
+    parser.add_argument('-b', '--batch', help='File with one city per line ("-" for stdin), prints JSON lines')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Requests in flight in batch mode')
+    parser.add_argument('--rate', type=float, default=0, help='Requests per second, 0 for unlimited')
     args = parser.parse_args()
     try:
         api_key = ''
         with open('api_key.txt') as file:   # create this file with your api key
             api_key = file.read().strip()
-        for string in get_weather(args.city, args.range, api_key):
-            print(string)
+        if args.batch:
+            if args.range > 7 or args.range < 1:
+                print('Invalid days count')
+                sys.exit(1)
+            bucket = TokenBucket(args.rate) if args.rate else None
+            with WeatherClient(api_key, args.cache, pool_size=args.workers, bucket=bucket) as client, \
+                    (sys.stdin if args.batch == '-' else open(args.batch)) as cities:
+                counts = batch(client, read_cities(cities), args.range, args.workers, sys.stdout)
+            print(json.dumps(counts), file=sys.stderr)
+            sys.exit(1 if counts['failed'] else 0)
+        with WeatherClient(api_key, args.cache) as client:
+            for string in client.get_weather(args.city, args.range):
+                print(string)
     except ApiException as exc:
         print(exc.message)
         sys.exit(1)
@@ -0,0 +1,100 @@
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Dict, List
+
+from fake_server import FakeImapServer
+from imap import SCRIPT, Command, ImapRunner, ResponseParser, parse_script
+
+
+def timed_run(server: FakeImapServer, commands: List[Command], window: int, parser: ResponseParser = None,
+              memory: bool = False) -> Dict[str, float]:
+    counts = {'events': 0, 'bytes': 0}
+
+    def emit(event: dict) -> None:
+        # Serialized like the command line tool would, but not kept.
+        counts['events'] += 1
+        counts['bytes'] += len(json.dumps(event))
+
+    runner = ImapRunner('127.0.0.1', server.port, emit, 'user', 'password', window, parser=parser)
+    reads = server.reads
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        summary = runner.run(commands)
+    finally:
+        runner.close()
+    elapsed = time.perf_counter() - start
+    result = {'seconds': round(elapsed, 3), 'round_trips': summary['round_trips'], 'server_reads': server.reads - reads,
+              'ok': summary['OK'], 'events': counts['events'], 'json_mb': round(counts['bytes'] / 1024 / 1024, 1)}
+    if memory:
+        result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+    return result
+
+
+def bench_script(args) -> Dict[str, object]:
+    # commands.txt against a mailbox of args.messages, lock-step against pipelined, over a simulated round trip.
+    with open(args.script) as file:
+        commands, _ = parse_script(file.read())
+    results = {}
+    for name, window in (('lockstep', 1), ('pipelined', args.window)):
+        server = FakeImapServer(args.messages, latency=args.latency / 1000, sasl_ir=window > 1).start()
+        try:
+            results[name] = timed_run(server, commands, window)
+        finally:
+            server.close()
+    return results
+
+
+def bench_pipeline(args) -> Dict[str, object]:
+    # Many small independent commands: where pipelining pays off most.
+    commands, _ = parse_script('LOGIN user password\nEXAMINE INBOX\n' + '\n'.join(
+        f'FETCH {number} (FLAGS UID)' for number in range(1, args.commands + 1)) + '\nLOGOUT')
+    results = {}
+    for name, window in (('lockstep', 1), ('pipelined', args.window)):
+        server = FakeImapServer(args.commands, latency=args.latency / 1000).start()
+        try:
+            results[name] = timed_run(server, commands, window)
+        finally:
+            server.close()
+    return results
+
+
+def bench_bodies(args) -> Dict[str, object]:
+    # FETCH BODY[] of every message: literals under the limit are kept, larger ones only hashed as they stream by.
+    commands, _ = parse_script('LOGIN user password\nEXAMINE INBOX\nFETCH 1:* BODY.PEEK[]\nLOGOUT')
+    server = FakeImapServer(args.bodies, body_size=args.body_size).start()
+    try:
+        results = {}
+        for name, limit in (('kept', args.body_size * 2), ('streamed', 1024)):
+            result = timed_run(server, commands, args.window, ResponseParser(limit), memory=True)
+            result['mb_per_second'] = round(args.bodies * args.body_size / result['seconds'] / 1024 / 1024, 1)
+            results[name] = result
+        return results
+    finally:
+        server.close()
+
+
+BENCHES = {'script': bench_script, 'pipeline': bench_pipeline, 'bodies': bench_bodies}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='IMAP script runner benchmarks')
+    parser.add_argument('-b', '--bench', choices=[*BENCHES, 'all'], default='all')
+    parser.add_argument('--script', default=SCRIPT)
+    parser.add_argument('-n', '--messages', type=int, default=100000, help='Messages in INBOX for the script')
+    parser.add_argument('-c', '--commands', type=int, default=500, help='Single-message FETCHes')
+    parser.add_argument('--latency', type=float, default=20, help='Simulated round trip, ms')
+    parser.add_argument('-w', '--window', type=int, default=64)
+    parser.add_argument('--bodies', type=int, default=2000)
+    parser.add_argument('--body-size', type=int, default=256 * 1024)
+    args = parser.parse_args()
+    benches = BENCHES if args.bench == 'all' else {args.bench: BENCHES[args.bench]}
+    print(json.dumps({name: bench(args) for name, bench in benches.items()}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
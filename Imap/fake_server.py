@@ -0,0 +1,416 @@
+import base64
+import bisect
+import fnmatch
+import socket
+import time
+from threading import Lock, Thread
+from typing import Dict, FrozenSet, List, Optional
+
+from imap import STAR, ImapException, parse_arguments, parse_set
+
+SYSTEM_FLAGS = ('\\Answered', '\\Flagged', '\\Deleted', '\\Seen', '\\Draft')
+# Every message with the same flags shares one frozenset, so 100k messages cost little more than their UIDs.
+_FLAGS: Dict[FrozenSet[str], FrozenSet[str]] = {}
+
+
+def _interned(flags) -> FrozenSet[str]:
+    flags = frozenset(flags)
+    return _FLAGS.setdefault(flags, flags)
+
+
+def message_body(uid: int, size: int = 512) -> bytes:
+    header = (f'From: sender{uid % 97}@example.test\r\nTo: user@example.test\r\nSubject: Message {uid}\r\n'
+              f'Message-ID: <{uid}@example.test>\r\n\r\n').encode()
+    line = f'Line of message {uid}.\r\n'.encode()
+    return header + line * max(1, (size - len(header)) // len(line))
+
+
+class Mailbox:
+    uids: List[int]
+    flags: List[FrozenSet[str]]
+    uid_next: int
+    uid_validity: int
+    body_size: int
+
+    def __init__(self, count: int = 0, uid_validity: int = 1, body_size: int = 512):
+        self.uids = list(range(1, count + 1))
+        self.flags = [_interned(())] * count
+        self.uid_next = count + 1
+        self.uid_validity = uid_validity
+        self.body_size = body_size
+
+    def append(self, flags: FrozenSet[str]) -> None:
+        self.uids.append(self.uid_next)
+        self.flags.append(flags)
+        self.uid_next += 1
+
+    def body(self, index: int) -> bytes:
+        return message_body(self.uids[index], self.body_size)
+
+
+class FakeImapServer:
+    _server: socket.socket
+    _thread: Optional[Thread] = None
+    lock: Lock
+    mailboxes: Dict[str, Mailbox]
+    users: Dict[str, str]
+    sasl_ir: bool
+    latency: float
+    commands: List[bytes]
+    reads: int
+    connections: int
+
+    def __init__(self, messages: int = 100, users: Dict[str, str] = None, host: str = '127.0.0.1', port: int = 0,
+                 sasl_ir: bool = True, latency: float = 0, body_size: int = 512):
+        # latency is slept once per read from the client: a stand-in for the round trip a network adds.
+        self.mailboxes = {'INBOX': Mailbox(messages, body_size=body_size)}
+        self.users = users or {'user': 'password'}
+        self.sasl_ir, self.latency = sasl_ir, latency
+        self.commands = []
+        self.reads = self.connections = 0
+        self.lock = Lock()
+        self._server = socket.create_server((host, port))
+
+    @property
+    def port(self) -> int:
+        return self._server.getsockname()[1]
+
+    def start(self) -> 'FakeImapServer':
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        if self._thread:
+            self._thread.join()
+
+    def _serve(self) -> None:
+        try:
+            while True:
+                conn, _ = self._server.accept()
+                self.connections += 1
+                Thread(target=self._handle, args=(conn,), daemon=True).start()
+        except OSError:
+            pass
+
+    def _handle(self, conn: socket.socket) -> None:
+        try:
+            _Session(self, conn).run()
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+class _Session:
+    _server: FakeImapServer
+    _conn: socket.socket
+    _input: bytearray
+    _output: bytearray
+    _user: Optional[str] = None
+    _selected: Optional[str] = None
+    _read_only: bool = False
+
+    def __init__(self, server: FakeImapServer, conn: socket.socket):
+        self._server = server
+        self._conn = conn
+        self._input, self._output = bytearray(), bytearray()
+
+    def run(self) -> None:
+        capabilities = self._capabilities()
+        self._write(f'* OK [CAPABILITY {capabilities}] Fake IMAP ready')
+        while True:
+            line = self._readline()
+            if line is None:
+                return
+            self._server.commands.append(line)
+            tag, _, rest = line.partition(b' ')
+            verb, _, arguments = rest.partition(b' ')
+            verb = verb.upper().decode(errors='replace')
+            if verb == 'UID':
+                sub, _, arguments = arguments.partition(b' ')
+                verb = f'UID {sub.upper().decode(errors="replace")}'
+            tag = tag.decode(errors='replace')
+            try:
+                result = self._command(verb, arguments)
+            except (ImapException, ValueError, LookupError, TypeError) as exc:
+                result = f'BAD {getattr(exc, "message", None) or "Bad arguments"}'
+            self._write(f'{tag} {result}')
+            if verb == 'LOGOUT':
+                self._flush()
+                return
+
+    def _capabilities(self) -> str:
+        return 'IMAP4rev1 AUTH=PLAIN ' + ('SASL-IR ' if self._server.sasl_ir else '') + 'MOVE UNSELECT'
+
+    def _readline(self) -> Optional[bytes]:
+        while b'\n' not in self._input:
+            # Replies are written out only when the client has nothing more queued, like a real server.
+            self._flush()
+            data = self._conn.recv(65536)
+            if not data:
+                return None
+            self._server.reads += 1
+            if self._server.latency:
+                time.sleep(self._server.latency)
+            self._input += data
+        end = self._input.index(b'\n')
+        line = bytes(self._input[:end]).rstrip(b'\r')
+        del self._input[:end + 1]
+        return line
+
+    def _write(self, line) -> None:
+        self._output += line.encode() if isinstance(line, str) else line
+        self._output += b'\r\n'
+        if len(self._output) > 256 * 1024:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._output:
+            self._conn.sendall(self._output)
+            self._output.clear()
+
+    @staticmethod
+    def _mailbox(name) -> str:
+        name = str(name)
+        return 'INBOX' if name.upper() == 'INBOX' else name
+
+    def _command(self, verb: str, arguments: bytes) -> str:
+        if verb == 'CAPABILITY':
+            self._write(f'* CAPABILITY {self._capabilities()}')
+            return 'OK CAPABILITY completed'
+        if verb == 'NOOP':
+            return 'OK NOOP completed'
+        if verb == 'LOGOUT':
+            self._write('* BYE Logging out')
+            return 'OK LOGOUT completed'
+        if verb in ('AUTHENTICATE', 'LOGIN'):
+            return self._authenticate(verb, arguments)
+        if self._user is None:
+            return 'BAD Authenticate first'
+        if verb in ('SELECT', 'EXAMINE'):
+            return self._select(verb, parse_arguments(arguments)[0])
+        if verb in ('CREATE', 'DELETE', 'RENAME', 'LIST', 'LSUB', 'STATUS'):
+            with self._server.lock:
+                return getattr(self, f'_{verb.lower()}')(*parse_arguments(arguments))
+        if self._selected is None:
+            return 'BAD No mailbox selected'
+        if verb in ('CLOSE', 'UNSELECT'):
+            if verb == 'CLOSE' and not self._read_only:
+                self._expunge(quiet=True)
+            self._selected = None
+            return f'OK {verb} completed'
+        with self._server.lock:
+            if self._selected not in self._server.mailboxes:
+                return 'NO Mailbox was deleted'
+            if verb == 'EXPUNGE':
+                self._expunge()
+                return 'OK EXPUNGE completed'
+            if verb in ('SEARCH', 'UID SEARCH'):
+                return self._search(verb.startswith('UID'), parse_arguments(arguments))
+            uid = verb.startswith('UID ')
+            text, _, rest = arguments.partition(b' ')
+            indexes = self._indexes(text.decode(), uid)
+            if verb.endswith('FETCH'):
+                return self._fetch(indexes, parse_arguments(rest), uid)
+            if verb.endswith('STORE'):
+                return self._store(indexes, parse_arguments(rest), uid)
+            if verb.endswith('COPY') or verb.endswith('MOVE'):
+                return self._copy(indexes, parse_arguments(rest)[0], verb.endswith('MOVE'))
+        return f'BAD Unknown command {verb}'
+
+    def _authenticate(self, verb: str, arguments: bytes) -> str:
+        words = arguments.split()
+        if self._user is not None:
+            return 'BAD Already authenticated'
+        if verb == 'LOGIN':
+            user, password = (str(word) for word in parse_arguments(arguments)[:2])
+        else:
+            if not words or words[0].upper() != b'PLAIN':
+                return 'NO Unsupported mechanism'
+            if len(words) > 1 and self._server.sasl_ir:
+                response = words[1]
+            else:
+                self._write('+ ')
+                response = self._readline() or b'*'
+            if response == b'*':
+                return 'BAD Authentication cancelled'
+            try:
+                _, user, password = base64.b64decode(response, validate=True).decode().split('\0')
+            except ValueError:
+                return 'BAD Malformed PLAIN response'
+        if self._server.users.get(user) != password:
+            return 'NO [AUTHENTICATIONFAILED] Invalid credentials'
+        self._user = user
+        return f'OK [CAPABILITY {self._capabilities()}] Logged in'
+
+    def _select(self, verb: str, name) -> str:
+        name = self._mailbox(name)
+        self._selected = None
+        with self._server.lock:
+            mailbox = self._server.mailboxes.get(name)
+            if mailbox is None:
+                return 'NO [NONEXISTENT] No such mailbox'
+            self._write(f'* FLAGS ({" ".join(SYSTEM_FLAGS)})')
+            self._write(f'* {len(mailbox.uids)} EXISTS')
+            self._write('* 0 RECENT')
+            self._write(f'* OK [UIDVALIDITY {mailbox.uid_validity}] UIDs valid')
+            self._write(f'* OK [UIDNEXT {mailbox.uid_next}] Predicted next UID')
+            self._write(f'* OK [PERMANENTFLAGS ({" ".join(SYSTEM_FLAGS)} \\*)] Limited')
+        self._selected, self._read_only = name, verb == 'EXAMINE'
+        return f'OK [{"READ-ONLY" if self._read_only else "READ-WRITE"}] {verb} completed'
+
+    def _create(self, name) -> str:
+        name = self._mailbox(name)
+        if name in self._server.mailboxes:
+            return 'NO [ALREADYEXISTS] Mailbox exists'
+        self._server.mailboxes[name] = Mailbox(uid_validity=int(time.time()) + len(self._server.mailboxes),
+                                               body_size=self._server.mailboxes['INBOX'].body_size)
+        return 'OK CREATE completed'
+
+    def _delete(self, name) -> str:
+        name = self._mailbox(name)
+        if name == 'INBOX' or name not in self._server.mailboxes:
+            return 'NO [NONEXISTENT] Cannot delete'
+        del self._server.mailboxes[name]
+        return 'OK DELETE completed'
+
+    def _rename(self, old, new) -> str:
+        old, new = self._mailbox(old), self._mailbox(new)
+        if old == 'INBOX' or old not in self._server.mailboxes:
+            return 'NO [NONEXISTENT] No such mailbox'
+        if new in self._server.mailboxes:
+            return 'NO [ALREADYEXISTS] Mailbox exists'
+        self._server.mailboxes[new] = self._server.mailboxes.pop(old)
+        return 'OK RENAME completed'
+
+    def _list(self, reference, pattern, subscribed: bool = False) -> str:
+        pattern = str(reference or '') + str(pattern)
+        for name in sorted(self._server.mailboxes):
+            if fnmatch.fnmatchcase(name, pattern.replace('%', '*')) and ('%' not in pattern or '/' not in name):
+                self._write(f'* {"LSUB" if subscribed else "LIST"} (\\HasNoChildren) "/" "{name}"')
+        return f'OK {"LSUB" if subscribed else "LIST"} completed'
+
+    def _lsub(self, reference, pattern) -> str:
+        return self._list(reference, pattern, True)
+
+    def _status(self, name, items) -> str:
+        name = self._mailbox(name)
+        mailbox = self._server.mailboxes.get(name)
+        if mailbox is None:
+            return 'NO [NONEXISTENT] No such mailbox'
+        values = {'MESSAGES': len(mailbox.uids), 'RECENT': 0, 'UIDNEXT': mailbox.uid_next,
+                  'UIDVALIDITY': mailbox.uid_validity,
+                  'UNSEEN': sum(1 for flags in mailbox.flags if '\\Seen' not in flags)}
+        result = ' '.join(f'{str(item).upper()} {values[str(item).upper()]}' for item in items)
+        self._write(f'* STATUS "{name}" ({result})')
+        return 'OK STATUS completed'
+
+    def _indexes(self, text: str, uid: bool) -> List[int]:
+        mailbox = self._server.mailboxes[self._selected]
+        uids = mailbox.uids
+        indexes = []
+        for low, high in parse_set(text):
+            if uid:
+                last = uids[-1] if uids else 0
+                low, high = sorted((last if low == STAR else low, last if high == STAR else high))
+                indexes.extend(range(bisect.bisect_left(uids, low), bisect.bisect_right(uids, high)))
+                continue
+            low, high = sorted((len(uids) if low == STAR else low, len(uids) if high == STAR else high))
+            if not 1 <= low <= high <= len(uids):
+                raise ImapException('Invalid message sequence number')
+            indexes.extend(range(low - 1, high))
+        return sorted(set(indexes))
+
+    def _fetch(self, indexes: List[int], items: list, uid: bool) -> str:
+        items = items[0] if items and isinstance(items[0], list) else items
+        names = [str(item).upper() for item in items]
+        macros = {'ALL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'], 'FAST': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']}
+        names = [name for item in names for name in macros.get(item, [item])]
+        if uid and 'UID' not in names:
+            names.insert(0, 'UID')
+        mailbox = self._server.mailboxes[self._selected]
+        marks_seen = not self._read_only and any(name in ('RFC822', 'BODY[]', 'BODY[TEXT]') for name in names)
+        for index in indexes:
+            if marks_seen and '\\Seen' not in mailbox.flags[index]:
+                mailbox.flags[index] = _interned(mailbox.flags[index] | {'\\Seen'})
+                if 'FLAGS' not in names:
+                    names.append('FLAGS')
+            parts: List[bytes] = []
+            for name in names:
+                if name == 'FLAGS':
+                    parts.append(f'FLAGS ({" ".join(sorted(mailbox.flags[index]))})'.encode())
+                elif name == 'UID':
+                    parts.append(b'UID %d' % mailbox.uids[index])
+                elif name == 'RFC822.SIZE':
+                    parts.append(b'RFC822.SIZE %d' % len(mailbox.body(index)))
+                elif name == 'INTERNALDATE':
+                    parts.append(b'INTERNALDATE "01-Jan-2024 00:00:00 +0000"')
+                elif name in ('RFC822', 'BODY[]', 'BODY.PEEK[]', 'BODY[HEADER]', 'BODY.PEEK[HEADER]', 'BODY[TEXT]',
+                              'BODY.PEEK[TEXT]'):
+                    body = mailbox.body(index)
+                    header, _, text = body.partition(b'\r\n\r\n')
+                    data = header + b'\r\n\r\n' if 'HEADER' in name else text if 'TEXT' in name else body
+                    parts.append(b'%s {%d}\r\n%s' % (name.replace('.PEEK', '').encode(), len(data), data))
+                else:
+                    raise ImapException(f'Unknown fetch item {name}')
+            self._write(b'* %d FETCH (%s)' % (index + 1, b' '.join(parts)))
+        return f'OK {"UID " if uid else ""}FETCH completed'
+
+    def _store(self, indexes: List[int], arguments: list, uid: bool) -> str:
+        operation, flags = str(arguments[0]).upper(), arguments[1] if isinstance(arguments[1], list) else arguments[1:]
+        if self._read_only:
+            return 'NO Mailbox is read-only'
+        mailbox = self._server.mailboxes[self._selected]
+        flags = {str(flag) for flag in flags}
+        for index in indexes:
+            current = mailbox.flags[index]
+            if operation.startswith('+'):
+                new = current | flags
+            elif operation.startswith('-'):
+                new = current - flags
+            else:
+                new = flags
+            mailbox.flags[index] = _interned(new)
+            if not operation.endswith('.SILENT'):
+                uid_part = f'UID {mailbox.uids[index]} ' if uid else ''
+                self._write(f'* {index + 1} FETCH ({uid_part}FLAGS ({" ".join(sorted(new))}))')
+        return f'OK {"UID " if uid else ""}STORE completed'
+
+    def _copy(self, indexes: List[int], target, move: bool) -> str:
+        target = self._mailbox(target)
+        destination = self._server.mailboxes.get(target)
+        if destination is None:
+            return 'NO [TRYCREATE] No such mailbox'
+        source = self._server.mailboxes[self._selected]
+        for index in indexes:
+            destination.append(source.flags[index])
+        if move:
+            for index in reversed(indexes):
+                del source.uids[index], source.flags[index]
+                self._write(f'* {index + 1} EXPUNGE')
+        return f'OK {"MOVE" if move else "COPY"} completed'
+
+    def _expunge(self, quiet: bool = False) -> None:
+        mailbox = self._server.mailboxes[self._selected]
+        for index in reversed(range(len(mailbox.uids))):
+            if '\\Deleted' in mailbox.flags[index]:
+                del mailbox.uids[index], mailbox.flags[index]
+                if not quiet:
+                    self._write(f'* {index + 1} EXPUNGE')
+
+    def _search(self, uid: bool, criteria: list) -> str:
+        mailbox = self._server.mailboxes[self._selected]
+        keys = {'ALL': lambda flags: True, 'SEEN': lambda flags: '\\Seen' in flags,
+                'UNSEEN': lambda flags: '\\Seen' not in flags, 'FLAGGED': lambda flags: '\\Flagged' in flags,
+                'UNFLAGGED': lambda flags: '\\Flagged' not in flags, 'DELETED': lambda flags: '\\Deleted' in flags}
+        tests = [keys[str(criterion).upper()] for criterion in criteria]
+        found = [mailbox.uids[index] if uid else index + 1 for index, flags in enumerate(mailbox.flags)
+                 if all(test(flags) for test in tests)]
+        self._write('* SEARCH' + ''.join(f' {number}' for number in found))
+        return 'OK SEARCH completed'
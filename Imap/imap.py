@@ -0,0 +1,516 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+import socket
+import ssl
+import sys
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import IO, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'commands.txt')
+COMMANDS = {'CAPABILITY', 'NOOP', 'LOGOUT', 'AUTHENTICATE', 'LOGIN', 'SELECT', 'EXAMINE', 'CREATE', 'DELETE', 'RENAME',
+            'SUBSCRIBE', 'UNSUBSCRIBE', 'LIST', 'LSUB', 'STATUS', 'CHECK', 'CLOSE', 'UNSELECT', 'EXPUNGE', 'SEARCH',
+            'FETCH', 'STORE', 'COPY', 'MOVE', 'UID', 'NAMESPACE', 'ENABLE'}
+# They change the connection's state or renumber messages: nothing is pipelined across them.
+BARRIERS = {'AUTHENTICATE', 'LOGIN', 'SELECT', 'EXAMINE', 'CLOSE', 'UNSELECT', 'EXPUNGE', 'MOVE', 'UID EXPUNGE',
+            'UID MOVE', 'ENABLE', 'LOGOUT'}
+WITH_SET = {'FETCH', 'STORE', 'COPY', 'MOVE', 'UID FETCH', 'UID STORE', 'UID COPY', 'UID MOVE'}
+# Adjacent commands that differ only in their set run as one; COPY only when the sets do not overlap.
+MERGEABLE = {'STORE', 'UID STORE', 'COPY', 'UID COPY'}
+STATUS = {'OK', 'NO', 'BAD', 'BYE', 'PREAUTH'}
+# Above any message number or UID, so "n:*" sorts and merges like a range.
+STAR = 2 ** 32
+TOKEN = re.compile(rb'(\()|(\))|"((?:[^"\\]|\\.)*)"|((?:[^\s()"\[]|\[[^\]]*\])+)')
+QUOTED_ESCAPE = re.compile(rb'\\(.)')
+LITERAL = re.compile(rb'~?\{(\d+)\+?\}$')
+WORD = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+EventCallback = Callable[[dict], None]
+
+
+@dataclass
+class ImapException(Exception):
+    message: str
+
+
+@dataclass
+class Command:
+    verb: str
+    arguments: List[str]
+    lines: List[int]
+
+    @property
+    def text(self) -> str:
+        return ' '.join([self.verb, *self.arguments])
+
+
+@dataclass
+class Response:
+    tag: str
+    kind: str
+    data: list = field(default_factory=list)
+    number: Optional[int] = None
+    code: str = ''
+    text: str = ''
+
+
+def parse_set(text: str) -> List[Tuple[int, int]]:
+    ranges = []
+    for part in text.split(','):
+        low, _, high = part.partition(':')
+        bounds = [STAR if value == '*' else int(value) for value in (low, high or low)]
+        if min(bounds) < 1:
+            raise ValueError(f'Bad sequence set {text}')
+        ranges.append((min(bounds), max(bounds)))
+    return ranges
+
+
+def sequence_set(ranges: Iterable[Tuple[int, int]]) -> str:
+    # Sorted, overlapping and adjacent ranges joined: "3,1,2,5:6,7" is "1:3,5:7".
+    merged: List[List[int]] = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    bound = {STAR: '*'}
+    return ','.join(bound.get(low, str(low)) if low == high else f'{bound.get(low, low)}:{bound.get(high, high)}'
+                    for low, high in merged)
+
+
+def compress(numbers: Iterable[int]) -> str:
+    return sequence_set((number, number) for number in numbers)
+
+
+def _overlap(first: List[Tuple[int, int]], second: List[Tuple[int, int]]) -> bool:
+    # "*" is whatever the last message is, so a set with it may overlap anything.
+    ranges = sorted(first + second)
+    if ranges[-1][1] >= STAR:
+        return True
+    return any(low <= ranges[index - 1][1] for index, (low, _) in enumerate(ranges) if index)
+
+
+def parse_script(text: str) -> Tuple[List[Command], List[Tuple[int, str]]]:
+    # Commands of a hand-typed session, tags dropped, plus the lines that are not commands.
+    commands: List[Command] = []
+    skipped = []
+    for number, line in enumerate(text.splitlines(), 1):
+        words = WORD.findall(line)
+        if words and words[0].upper() not in COMMANDS:
+            words = words[1:]
+        if not words or words[0].upper() not in COMMANDS:
+            if line.strip():
+                skipped.append((number, line.strip()))
+            continue
+        verb, arguments = words[0].upper(), words[1:]
+        if verb == 'UID' and arguments:
+            verb, arguments = f'UID {arguments[0].upper()}', arguments[1:]
+        try:
+            if verb in WITH_SET and arguments:
+                arguments[0] = sequence_set(parse_set(arguments[0]))
+            previous = commands[-1] if commands else None
+            if previous and verb in MERGEABLE and previous.verb == verb and arguments \
+                    and arguments[1:] == previous.arguments[1:]:
+                ours, theirs = parse_set(arguments[0]), parse_set(previous.arguments[0])
+                if verb.endswith('STORE') or not _overlap(ours, theirs):
+                    previous.arguments[0] = sequence_set(ours + theirs)
+                    previous.lines.append(number)
+                    continue
+        except ValueError:
+            # Sent as typed; the server answers BAD.
+            pass
+        commands.append(Command(verb, arguments, [number]))
+    return commands, skipped
+
+
+def _atom(atom: bytes):
+    if atom.isdigit():
+        return int(atom)
+    if atom.upper() == b'NIL':
+        return None
+    return atom.decode(errors='replace')
+
+
+def _tokens(stack: List[list], line: bytes) -> None:
+    for opening, closing, quoted, atom in TOKEN.findall(line):
+        if opening:
+            stack[-1].append([])
+            stack.append(stack[-1][-1])
+        elif closing:
+            if len(stack) == 1:
+                raise ImapException(f'Unbalanced parenthesis: {line[:80]!r}')
+            stack.pop()
+        elif atom:
+            stack[-1].append(_atom(atom))
+        else:
+            stack[-1].append(QUOTED_ESCAPE.sub(rb'\1', quoted).decode(errors='replace'))
+
+
+def parse_arguments(line: bytes) -> list:
+    stack: List[list] = [[]]
+    _tokens(stack, line)
+    if len(stack) != 1:
+        raise ImapException(f'Unbalanced parenthesis: {line[:80]!r}')
+    return stack[0]
+
+
+def _status(text: bytes) -> Tuple[str, str]:
+    if text.startswith(b'[') and b']' in text:
+        end = text.index(b']')
+        return text[1:end].decode(errors='replace'), text[end + 1:].strip().decode(errors='replace')
+    return '', text.decode(errors='replace')
+
+
+class DigestSink:
+    # Large literals are hashed as they stream by instead of being kept.
+    _hash = None
+    _size: int
+
+    def __init__(self, size: int):
+        self._hash = hashlib.sha256()
+        self._size = size
+
+    def write(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+
+    def close(self) -> dict:
+        return {'size': self._size, 'sha256': self._hash.hexdigest()}
+
+
+class FileSink(DigestSink):
+    _file = None
+    _path: str
+
+    def __init__(self, size: int, directory: str):
+        super().__init__(size)
+        descriptor, self._path = tempfile.mkstemp(suffix='.eml', dir=directory)
+        self._file = os.fdopen(descriptor, 'wb')
+
+    def write(self, chunk: bytes) -> None:
+        super().write(chunk)
+        self._file.write(chunk)
+
+    def close(self) -> dict:
+        self._file.close()
+        return {**super().close(), 'path': self._path}
+
+
+class ResponseParser:
+    _buffer: bytearray
+    _stack: List[list]
+    _head: Optional[Response] = None
+    _remaining: int = 0
+    _literal: bytearray
+    _sink = None
+    literal_limit: int
+    sink_factory: Callable[[int], DigestSink]
+    max_line: int = 1024 * 1024
+
+    def __init__(self, literal_limit: int = 64 * 1024, sink_factory: Callable[[int], DigestSink] = DigestSink):
+        # Literals up to literal_limit become bytes; larger ones go to a sink chunk by chunk, as they arrive.
+        self._buffer = bytearray()
+        self._stack = [[]]
+        self._literal = bytearray()
+        self.literal_limit = literal_limit
+        self.sink_factory = sink_factory
+
+    def feed(self, data: bytes) -> List[Response]:
+        self._buffer += data
+        responses: List[Response] = []
+        position, size = 0, len(self._buffer)
+        while position < size:
+            if self._remaining:
+                take = min(self._remaining, size - position)
+                chunk = bytes(self._buffer[position:position + take])
+                if self._sink is not None:
+                    self._sink.write(chunk)
+                else:
+                    self._literal += chunk
+                position += take
+                self._remaining -= take
+                if not self._remaining:
+                    self._end_literal()
+                continue
+            end = self._buffer.find(b'\n', position)
+            if end < 0:
+                if size - position > self.max_line:
+                    raise ImapException('Response line too long')
+                break
+            line = bytes(self._buffer[position:end]).rstrip(b'\r')
+            position = end + 1
+            response = self._line(line)
+            if response is not None:
+                responses.append(response)
+        del self._buffer[:position]
+        return responses
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._buffer) or self._head is not None
+
+    def _line(self, line: bytes) -> Optional[Response]:
+        if self._head is None:
+            tag, _, rest = line.partition(b' ')
+            if tag == b'+':
+                return Response('+', 'CONTINUE', text=rest.decode(errors='replace'))
+            word = rest.split(b' ', 1)[0].upper().decode(errors='replace')
+            if word in STATUS:
+                code, text = _status(rest[len(word):].lstrip())
+                return Response(tag.decode(errors='replace'), word, code=code, text=text)
+            self._head = Response(tag.decode(errors='replace'), '')
+            self._stack = [[]]
+            line = rest
+        literal = LITERAL.search(line)
+        _tokens(self._stack, line[:literal.start()] if literal else line)
+        if not literal:
+            return self._finish()
+        self._remaining = int(literal.group(1))
+        if self._remaining > self.literal_limit:
+            self._sink = self.sink_factory(self._remaining)
+        elif not self._remaining:
+            self._end_literal()
+        return None
+
+    def _end_literal(self) -> None:
+        self._stack[-1].append(self._sink.close() if self._sink is not None else bytes(self._literal))
+        self._sink = None
+        self._literal = bytearray()
+
+    def _finish(self) -> Response:
+        if len(self._stack) != 1:
+            raise ImapException('Unbalanced parenthesis')
+        response, data = self._head, self._stack[0]
+        if data and isinstance(data[0], int):
+            response.number = data.pop(0)
+        response.kind = str(data.pop(0)).upper() if data else ''
+        response.data = data
+        self._head = None
+        return response
+
+
+def to_json(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode(errors='replace')
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    return value
+
+
+def json_lines(file: IO[str] = None) -> EventCallback:
+    def emit(event: dict) -> None:
+        print(json.dumps(event), file=file or sys.stdout)
+
+    return emit
+
+
+class ImapRunner:
+    _sock: Optional[socket.socket] = None
+    _parser: ResponseParser
+    _responses: Deque[Response]
+    _outstanding: Deque[Tuple[str, Command, float]]
+    _emit: EventCallback
+    _counter: int
+    _credentials: Optional[Tuple[str, str]]
+    host: str
+    port: int
+    tls: bool
+    timeout: float
+    window: int
+    capabilities: Set[str]
+    round_trips: int
+    statuses: Dict[str, int]
+
+    def __init__(self, host: str, port: int, emit: EventCallback, user: str = None, password: str = None,
+                 window: int = 64, tls: bool = False, timeout: float = 30, parser: ResponseParser = None):
+        # window is the number of commands in flight; 1 runs the script in lock-step.
+        self._parser = parser or ResponseParser()
+        self._responses, self._outstanding = deque(), deque()
+        self._emit = emit
+        self._counter = 0
+        self._credentials = (user, password) if user is not None and password is not None else None
+        self.host, self.port, self.tls, self.timeout = host, port, tls, timeout
+        self.window = max(1, window)
+        self.capabilities = set()
+        self.round_trips = 0
+        self.statuses = {'OK': 0, 'NO': 0, 'BAD': 0}
+
+    def connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.tls:
+            self._sock = ssl.create_default_context().wrap_socket(self._sock, server_hostname=self.host)
+        greeting = self._read()
+        if greeting.tag != '*' or greeting.kind not in ('OK', 'PREAUTH'):
+            raise ImapException(f'Server refused the connection: {greeting.kind} {greeting.text}')
+        self._capability(greeting)
+        self._emit({'event': 'greeting', 'status': greeting.kind, 'code': greeting.code, 'text': greeting.text})
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def run(self, commands: List[Command]) -> dict:
+        started = time.perf_counter()
+        if self._credentials is None and any(command.verb == 'AUTHENTICATE' for command in commands):
+            raise ImapException('AUTHENTICATE needs a user and a password')
+        if self._sock is None:
+            self.connect()
+        index = 0
+        while index < len(commands):
+            command = commands[index]
+            if command.verb in BARRIERS:
+                self._wait(0)
+                self._send([command])
+                self._wait(0)
+                index += 1
+                if command.verb == 'LOGOUT':
+                    break
+                continue
+            group = []
+            while index < len(commands) and commands[index].verb not in BARRIERS \
+                    and len(self._outstanding) + len(group) < self.window:
+                group.append(commands[index])
+                index += 1
+            if group:
+                self._send(group)
+                continue
+            self._wait(self.window - 1)
+            # Everything already received frees its slot too, so the next write fills the window again.
+            while self._responses:
+                self._dispatch(self._responses.popleft())
+        self._wait(0)
+        for command in commands[index:]:
+            self._emit({'event': 'skipped', 'lines': command.lines, 'command': command.text,
+                        'reason': 'after LOGOUT'})
+        summary = {'event': 'summary', 'commands': sum(self.statuses.values()), **self.statuses,
+                   'round_trips': self.round_trips, 'ms': round((time.perf_counter() - started) * 1000, 3)}
+        self._emit(summary)
+        return summary
+
+    def _send(self, commands: List[Command]) -> None:
+        # One write per group: a pipelined group costs one round trip, not one per command.
+        lines = []
+        now = time.perf_counter()
+        for command in commands:
+            self._counter += 1
+            tag = f'A{self._counter:04d}'
+            text = command.text
+            if command.verb == 'AUTHENTICATE' and command.arguments[:1] == ['PLAIN'] \
+                    and 'SASL-IR' in self.capabilities and len(command.arguments) == 1:
+                # The initial response rides with the command (RFC 4959), saving the continuation round trip.
+                text += ' ' + self._plain()
+            lines.append(f'{tag} {text}\r\n')
+            self._outstanding.append((tag, command, now))
+        self._sock.sendall(''.join(lines).encode())
+        self.round_trips += 1
+
+    def _plain(self) -> str:
+        user, password = self._credentials
+        return base64.b64encode(f'\0{user}\0{password}'.encode()).decode()
+
+    def _wait(self, limit: int) -> None:
+        while len(self._outstanding) > limit:
+            self._dispatch(self._read())
+
+    def _read(self) -> Response:
+        while not self._responses:
+            try:
+                data = self._sock.recv(256 * 1024)
+            except socket.timeout:
+                raise ImapException('Timed out waiting for the server')
+            if not data:
+                raise ImapException('Connection closed by server')
+            self._responses.extend(self._parser.feed(data))
+        return self._responses.popleft()
+
+    def _dispatch(self, response: Response) -> None:
+        current = self._outstanding[0] if self._outstanding else None
+        if response.tag == '+':
+            if current and current[1].verb == 'AUTHENTICATE' and current[1].arguments[:1] == ['PLAIN']:
+                self._sock.sendall(self._plain().encode() + b'\r\n')
+            else:
+                # Nothing in a script can answer a continuation; cancel it.
+                self._sock.sendall(b'*\r\n')
+            self.round_trips += 1
+            return
+        if response.tag == '*':
+            self._capability(response)
+            # The server runs commands in order, so untagged data belongs to the oldest one still running.
+            self._emit(self._untagged(response, current))
+            return
+        for position, (tag, command, started) in enumerate(self._outstanding):
+            if tag == response.tag:
+                del self._outstanding[position]
+                break
+        else:
+            raise ImapException(f'Unexpected tag {response.tag}')
+        self.statuses[response.kind] = self.statuses.get(response.kind, 0) + 1
+        self._emit({'event': 'done', 'tag': tag, 'lines': command.lines, 'command': command.text,
+                    'status': response.kind, 'code': response.code, 'text': response.text,
+                    'ms': round((time.perf_counter() - started) * 1000, 3)})
+
+    def _capability(self, response: Response) -> None:
+        if response.kind == 'CAPABILITY':
+            self.capabilities = {str(item).upper() for item in response.data}
+        elif response.code.upper().startswith('CAPABILITY '):
+            self.capabilities = set(response.code.upper().split()[1:])
+
+    @staticmethod
+    def _untagged(response: Response, current: Optional[Tuple[str, Command, float]]) -> dict:
+        event = {'event': 'untagged', 'tag': current[0] if current else None,
+                 'lines': current[1].lines if current else [], 'type': response.kind}
+        if response.number is not None:
+            event['number'] = response.number
+        if response.kind in STATUS:
+            event.update(code=response.code, text=response.text)
+        elif response.kind == 'FETCH' and response.data and isinstance(response.data[0], list):
+            items = response.data[0]
+            event['data'] = {str(key).upper(): to_json(value) for key, value in zip(items[::2], items[1::2])}
+        elif response.kind == 'SEARCH':
+            event['set'] = compress(number for number in response.data if isinstance(number, int))
+        else:
+            event['data'] = to_json(response.data)
+        return event
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='imap.py', description='Run an IMAP session script, pipelined')
+    parser.add_argument('script', nargs='?', default=SCRIPT, help='One command per line, tags optional')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, help='143, or 993 with --tls')
+    parser.add_argument('--tls', action='store_true', help='Implicit TLS')
+    parser.add_argument('-u', '--user')
+    parser.add_argument('--password', default=os.environ.get('IMAP_PASSWORD'), help='Default: $IMAP_PASSWORD')
+    parser.add_argument('-w', '--window', type=int, default=64, help='Commands in flight, 1 for lock-step')
+    parser.add_argument('--literal-limit', type=int, default=64 * 1024, help='Larger literals are streamed')
+    parser.add_argument('--save-literals', help='Directory to stream large literals to, instead of hashing them')
+    parser.add_argument('-o', '--output', help='JSON lines file, stdout by default')
+    args = parser.parse_args()
+    with open(args.script) as file:
+        commands, skipped = parse_script(file.read())
+    sink = DigestSink if not args.save_literals else lambda size: FileSink(size, args.save_literals)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    emit = json_lines(output)
+    for number, text in skipped:
+        emit({'event': 'skipped', 'lines': [number], 'command': text, 'reason': 'not a command'})
+    runner = ImapRunner(args.host, args.port or (993 if args.tls else 143), emit, args.user, args.password,
+                        args.window, args.tls, parser=ResponseParser(args.literal_limit, sink))
+    try:
+        summary = runner.run(commands)
+    except (OSError, ImapException) as exc:
+        emit({'event': 'error', 'text': getattr(exc, 'message', str(exc))})
+        sys.exit(1)
+    finally:
+        runner.close()
+        if output is not sys.stdout:
+            output.close()
+    sys.exit(1 if summary['NO'] or summary['BAD'] else 0)
+
+
+if __name__ == '__main__':
+    main()
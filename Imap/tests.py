@@ -0,0 +1,148 @@
+import hashlib
+import unittest
+from typing import List
+from unittest import TestCase
+
+from fake_server import FakeImapServer, message_body
+from imap import SCRIPT, DigestSink, ImapException, ImapRunner, ResponseParser, compress, parse_script, parse_set, \
+    sequence_set
+
+
+class SequenceSetTests(TestCase):
+    def test_compress(self):
+        self.assertEqual('1:3,5:7', sequence_set(parse_set('3,1,2,5:6,7')))
+        self.assertEqual('1:*', sequence_set(parse_set('4:*,1:3,*')))
+        self.assertEqual('2:9', sequence_set(parse_set('9:2')))
+        self.assertEqual('1:3,10,12:13', compress([13, 1, 2, 3, 10, 12]))
+        self.assertEqual('', compress([]))
+        for text in ('0', '1:x', ''):
+            with self.assertRaises(ValueError):
+                parse_set(text)
+
+
+class ScriptTests(TestCase):
+    def test_commands_txt(self):
+        with open(SCRIPT) as file:
+            commands, skipped = parse_script(file.read())
+        self.assertEqual(14, len(commands))
+        self.assertEqual(('CAPABILITY', 'LOGOUT'), (commands[0].text, commands[-1].text))
+        self.assertEqual('FETCH 1:* flags', commands[7].text)
+        self.assertEqual([(15, '4a, 4b')], skipped)
+
+    def test_merge(self):
+        commands, _ = parse_script('\n'.join([
+            'a STORE 1 +FLAGS (\\Seen)', 'STORE 2,3 +FLAGS (\\Seen)', 'STORE 5 +FLAGS (\\Seen)',
+            'COPY 1:2 box', 'COPY 3 box', 'COPY 3 box', 'uid copy 7,8,9 box', 'UID COPY 10 box',
+            'FETCH 5,1,2,3 FLAGS', 'FETCH 6 FLAGS',
+        ]))
+        self.assertEqual(['STORE 1:3,5 +FLAGS (\\Seen)', 'COPY 1:3 box', 'COPY 3 box', 'UID COPY 7:10 box',
+                          'FETCH 1:3,5 FLAGS', 'FETCH 6 FLAGS'], [command.text for command in commands])
+        self.assertEqual([[1, 2, 3], [4, 5], [6], [7, 8], [9], [10]], [command.lines for command in commands])
+
+
+class ParserTests(TestCase):
+    DATA = (b'* OK [CAPABILITY IMAP4rev1] ready\r\n'
+            b'* 1 FETCH (UID 5 FLAGS (\\Seen) BODY[HEADER.FIELDS (FROM)] {7}\r\nFrom: a BODY[] {0}\r\n)\r\n'
+            b'* LIST (\\HasNoChildren) "/" "a \\"b"\r\n'
+            b'* 3 EXISTS\r\n'
+            b'+ ready\r\n'
+            b'A1 NO [TRYCREATE] No such mailbox\r\n')
+
+    def test_incremental(self):
+        whole = ResponseParser().feed(self.DATA)
+        parser = ResponseParser()
+        pieces = [response for offset in range(len(self.DATA))
+                  for response in parser.feed(self.DATA[offset:offset + 1])]
+        self.assertEqual(whole, pieces)
+        self.assertFalse(parser.pending)
+        self.assertEqual(['OK', 'FETCH', 'LIST', 'EXISTS', 'CONTINUE', 'NO'], [response.kind for response in whole])
+        self.assertEqual(1, whole[1].number)
+        self.assertEqual([['UID', 5, 'FLAGS', ['\\Seen'], 'BODY[HEADER.FIELDS (FROM)]', b'From: a', 'BODY[]', b'']],
+                         whole[1].data)
+        self.assertEqual([['\\HasNoChildren'], '/', 'a "b'], whole[2].data)
+        self.assertEqual(('A1', 'TRYCREATE', 'No such mailbox'), (whole[5].tag, whole[5].code, whole[5].text))
+
+    def test_large_literal_is_streamed(self):
+        chunks: List[int] = []
+
+        class Sink(DigestSink):
+            def write(self, chunk: bytes) -> None:
+                chunks.append(len(chunk))
+                super().write(chunk)
+
+        body = bytes(range(256)) * 40000
+        data = b'* 1 FETCH (BODY[] {%d}\r\n%s UID 9)\r\n' % (len(body), body)
+        parser = ResponseParser(literal_limit=1024, sink_factory=Sink)
+        responses = [response for offset in range(0, len(data), 65536) for response in
+                     parser.feed(data[offset:offset + 65536])]
+        self.assertEqual([['BODY[]', {'size': len(body), 'sha256': hashlib.sha256(body).hexdigest()}, 'UID', 9]],
+                         responses[0].data)
+        self.assertLessEqual(max(chunks), 65536)
+        self.assertGreater(len(chunks), 100)
+
+    def test_malformed(self):
+        with self.assertRaises(ImapException):
+            ResponseParser().feed(b'* 1 FETCH (FLAGS ())))\r\n')
+        parser = ResponseParser()
+        parser.max_line = 100
+        with self.assertRaises(ImapException):
+            parser.feed(b'* ' + b'x' * 200)
+
+
+class RunnerTests(TestCase):
+    def _run(self, script: str, messages: int = 100, user: str = 'user', password: str = 'password', window: int = 64,
+             **kwargs):
+        server = FakeImapServer(messages, **kwargs).start()
+        self.addCleanup(server.close)
+        events = []
+        runner = ImapRunner('127.0.0.1', server.port, events.append, user, password, window)
+        self.addCleanup(runner.close)
+        summary = runner.run(parse_script(script)[0])
+        return summary, events, server
+
+    def test_commands_txt_pipelined(self):
+        with open(SCRIPT) as file:
+            script = file.read()
+        summary, events, server = self._run(script)
+        self.assertEqual((14, 14), (summary['commands'], summary['OK']))
+        lockstep, lockstep_events, lockstep_server = self._run(script, window=1, sasl_ir=False)
+        self.assertEqual(14, lockstep['OK'])
+        # The same results, in fewer round trips.
+        done = [(event['command'], event['status']) for event in events if event['event'] == 'done']
+        self.assertEqual(done, [(event['command'], event['status']) for event in lockstep_events
+                                if event['event'] == 'done'])
+        self.assertEqual(15, lockstep['round_trips'])
+        self.assertLess(summary['round_trips'], 10)
+        self.assertLess(server.reads, lockstep_server.reads)
+        fetches = [event for event in events if event['event'] == 'untagged' and event['type'] == 'FETCH']
+        self.assertEqual(209, len(fetches))
+        self.assertEqual({'lines': [13], 'number': 1, 'data': {'FLAGS': ['\\Flagged']}},
+                         {key: fetches[-1][key] for key in ('lines', 'number', 'data')})
+        self.assertEqual(100, len(server.mailboxes['box'].uids))
+
+    def test_authentication(self):
+        summary, events, _ = self._run('AUTHENTICATE PLAIN\nSELECT INBOX', password='wrong', sasl_ir=False)
+        self.assertEqual((0, 1, 1), (summary['OK'], summary['NO'], summary['BAD']))
+        with self.assertRaises(ImapException):
+            self._run('AUTHENTICATE PLAIN', user=None)
+
+    def test_bodies_and_search(self):
+        script = 'LOGIN user password\nEXAMINE INBOX\nFETCH 1:3 (UID BODY.PEEK[])\nUID SEARCH ALL\nLOGOUT\nNOOP'
+        summary, events, _ = self._run(script, messages=1000, body_size=100 * 1024)
+        self.assertEqual(5, summary['OK'])
+        bodies = [event['data']['BODY[]'] for event in events if event.get('type') == 'FETCH']
+        self.assertEqual({'size': len(message_body(2, 100 * 1024)),
+                          'sha256': hashlib.sha256(message_body(2, 100 * 1024)).hexdigest()}, bodies[1])
+        self.assertEqual('1:1000', next(event['set'] for event in events if event.get('type') == 'SEARCH'))
+        self.assertEqual('after LOGOUT', events[-2]['reason'])
+
+    def test_100k_messages(self):
+        with open(SCRIPT) as file:
+            summary, events, server = self._run(file.read(), messages=100000)
+        self.assertEqual(14, summary['OK'])
+        self.assertEqual(200009, sum(1 for event in events if event.get('type') == 'FETCH'))
+        self.assertEqual(100000, len(server.mailboxes['box'].uids))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,24 @@
+import argparse
+import json
+import os
 import socket
-import ssl
+import sys
+import time
 from dataclasses import dataclass
-from typing import Optional, Tuple, List
+from threading import Lock, local
+from typing import Optional, Tuple, List, Dict
 import base64
 
+# Modules this sender has in common with Smtp-mime are imported from there, not copied here.
+SHARED = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Smtp-mime')
+if SHARED not in sys.path:
+    sys.path.append(SHARED)
+
+from bulk import BulkMailer, RetryQueue, print_progress, read_recipients
+from reply import Reply, ReplyException, ReplyReader
+from spool import Spool, SpoolMessage, data_chunks, header_recipients
+from tls import TLSSessionCache
+
 
 @dataclass
 class SenderException(Exception):
@@ -17,25 +32,29 @@ class SMTPSender:
     _from_to: str
     _rcpt_to: str
     _port: int
-    _sock: socket.socket
+    _sock: socket.socket = None
+    _reader: ReplyReader = None
+    _capabilities: Dict[str, str] = None
+    timeout: float = 30
+    tls: TLSSessionCache = TLSSessionCache()
+    tls_resumed: Optional[bool] = None
 
     def __init__(self, host: str, user_name: str,
                  password: str, from_to: str, rcpt_to: str, port):
         self._host, self._port = host, port
         self._user_name, self._password = user_name, password
         self._from_to, self._rcpt_to = from_to, rcpt_to
+        self._capabilities = {}
 
-    def _accept_message(self) -> Optional[bytes]:
-        buffer = []
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def _accept_message(self) -> Reply:
         try:
-            while 1:
-                message = self._sock.recv(1024)
-                if not message:
-                    break
-                buffer.append(message)
-        except socket.timeout:
-            pass
-        return b''.join(buffer)
+            return self._reader.read()
+        except ReplyException as exc:
+            raise SenderException(exc.message)
 
     @staticmethod
     def _get_message_from_file(file_name: str) -> Optional[bytes]:
@@ -43,52 +62,193 @@ class SMTPSender:
             return file.read().encode(encoding="windows-1251")
 
     @staticmethod
-    def _ensure_code_correct(accept: bytes, accept_code: bytes) -> None:
-        accept = accept.strip(b'\r\n').split(b'\r\n')[-1]
-        if not accept.startswith(accept_code):
-            raise SenderException(accept.decode())
+    def _ensure_code_correct(accept: Reply, accept_code: bytes) -> None:
+        # A shorter code is a class: b'2' takes any 2xx reply.
+        expected = accept_code.strip().decode()
+        if str(accept.code)[:len(expected)] != expected:
+            raise SenderException(str(accept))
 
-    def _sender(self, commands: List[Tuple[bytes, bytes]]) -> None:
+    def _sender(self, commands: List[Tuple[bytes, bytes]]) -> Reply:
+        answer = None
         for command, code in commands:
             self._sock.sendall(command)
-            self._ensure_code_correct(self._accept_message(), code)
+            answer = self._accept_message()
+            self._ensure_code_correct(answer, code)
+        return answer
 
-    def send_message(self, message: str) -> Optional[str]:
-        self._sock = ssl.wrap_socket(socket.socket())
-        self._sock.settimeout(1)
+    def connect(self) -> None:
+        self._sock = self.tls.wrap(socket.socket(), self._host)
+        self._sock.settimeout(self.timeout)
         try:
             self._sock.connect((self._host, self._port))
+            self._reader = ReplyReader(self._sock)
             self._ensure_code_correct(self._accept_message(), b'220 ')
+            self._capabilities = self._sender([(f'EHLO {self._host}\r\n'.encode(), b'250 ')]).capabilities
+            self.tls_resumed = self.tls.remember(self._host, self._sock)
             self._sender([
-                (f'EHLO {self._host}\r\n'.encode(), b'250 '),
                 (b'AUTH LOGIN\r\n', b'334 '),
                 (base64.b64encode(self._user_name.encode()) + b'\r\n', b'334 '),
-                (base64.b64encode(self._password.encode()) + b'\r\n', b'235 '),
-                (f'MAIL FROM: {self._from_to}\r\n'.encode(), b'250 '),
-                (f'rcpt TO: {self._rcpt_to}\r\n'.encode(), b'250 '),
-                (b'DATA\r\n', b'354 ')
+                (base64.b64encode(self._password.encode()) + b'\r\n', b'235 ')
             ])
-            self._sock.sendall(self._get_message_from_file(message))
-            self._sender([
-                (b'\n.\r\n', b'250 '),
-                (b'QUIT\r\n', b'221 ')
-            ])
-            return 'Email sent successfully!'
+        except BaseException:
+            self.close()
+            raise
+
+    def transaction(self, data, recipients: List[str] = None) -> None:
+        self._sender([
+            (f'MAIL FROM: {self._from_to}\r\n'.encode(), b'250 '),
+            *((f'rcpt TO: {recipient}\r\n'.encode(), b'2') for recipient in recipients or [self._rcpt_to]),
+            (b'DATA\r\n', b'354 ')
+        ])
+        for chunk in data_chunks(data):
+            self._sock.sendall(chunk)
+        self._ensure_code_correct(self._accept_message(), b'250 ')
+
+    def reset(self) -> None:
+        self._sender([(b'RSET\r\n', b'250 ')])
+
+    def quit(self) -> None:
+        try:
+            self._sender([(b'QUIT\r\n', b'221 ')])
         finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._sock is not None:
             self._sock.close()
+            self._sock = None
+
+    def send_message(self, message: str) -> Optional[str]:
+        self.connect()
+        try:
+            self.transaction(self._get_message_from_file(message))
+            self.quit()
+            return 'Email sent successfully!'
+        finally:
+            self.close()
+
+
+def bulk_send(host: str, user_name: str, password: str, from_to: str, recipients: str, port: int,
+              message: str, tls: TLSSessionCache = None, workers: int = 8) -> None:
+    data = SMTPSender._get_message_from_file(message)
+    # One session per worker thread, kept open from one recipient to the next: a connection, a TLS handshake
+    # and an AUTH for each of them would cost more than the message.
+    sessions, senders, lock = local(), [], Lock()
+
+    def deliver(row: Dict[str, str]) -> None:
+        sender = getattr(sessions, 'sender', None)
+        if sender is None:
+            sender = sessions.sender = SMTPSender(host, user_name, password, from_to, row['email'], port)
+            sender.tls = tls or sender.tls
+            with lock:
+                senders.append(sender)
+        if not sender.connected:
+            sender.connect()
+        try:
+            sender.transaction(data, [row['email']])
+        except SenderException:
+            # A refused recipient leaves the session usable once the transaction is reset.
+            try:
+                sender.reset()
+            except (OSError, SenderException):
+                sender.close()
+            raise
+        except OSError:
+            sender.close()
+            raise
+
+    queue = RetryQueue(recipients + '.queue.sqlite3')
+    try:
+        print(f'Queued {queue.add(read_recipients(recipients))} new recipients')
+        mailer = BulkMailer(queue, deliver, workers, progress=print_progress)
+        print(json.dumps(mailer.run()))
+    finally:
+        for sender in [sender for sender in senders if sender.connected]:
+            try:
+                sender.quit()
+            except (OSError, SenderException):
+                sender.close()
+        queue.close()
+
+
+def run_spool(sender: SMTPSender, directory: str, interval: float = 1.0, once: bool = False, max_attempts: int = 5,
+              backoff: float = 60, max_backoff: float = 3600) -> None:
+    spool = Spool(directory)
+    connected = False
+    try:
+        while True:
+            for name in spool.pending():
+                path = spool.claim(name)
+                if path is None:
+                    continue
+                try:
+                    if not connected:
+                        try:
+                            sender.connect()
+                        except (OSError, SenderException):
+                            # The relay is unreachable, not the message at fault: try again next round.
+                            spool.release(path)
+                            raise
+                        connected = True
+                        print(f'Connected, TLS {"session resumed" if sender.tls_resumed else "full handshake"}')
+                    with SpoolMessage(path) as message:
+                        recipients = [f'<{address}>' for address in header_recipients(message.data)]
+                        sender.transaction(message.data, recipients or None)
+                except (OSError, SenderException) as exc:
+                    error = exc.message if isinstance(exc, SenderException) else str(exc)
+                    # The session state is unknown after an error, the next message starts a new one.
+                    sender.close()
+                    if not connected:
+                        print(f'{name}: not connected: {error.strip()}')
+                        break
+                    connected = False
+                    attempts = spool.attempts(path) + 1
+                    if error.startswith('5') or attempts >= max_attempts:
+                        spool.failed(path, error)
+                        print(f'{name}: failed: {error.strip()}')
+                    else:
+                        delay = min(max_backoff, backoff * 2 ** (attempts - 1))
+                        spool.defer(path, delay)
+                        print(f'{name}: deferred for {delay:.0f}s: {error.strip()}')
+                else:
+                    spool.sent(path)
+                    print(f'{name}: sent')
+            if once:
+                return
+            time.sleep(interval)
+    finally:
+        if connected:
+            try:
+                sender.quit()
+            except (OSError, SenderException):
+                sender.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Mail', description='Send a message, a spool directory or a bulk list')
+    parser.add_argument('--cafile', help='CA certificates to verify the server with')
+    parser.add_argument('--insecure', action='store_true', help='Do not verify the server certificate')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent SMTP sessions for a bulk list')
+    options = parser.parse_args()
+    tls = TLSSessionCache(cafile=options.cafile, verify=not options.insecure)
     print('Write all in utf-8!')
-    sender = SMTPSender(
+    arguments = (
         input('SMTP host -> '),
         input('User name -> '),
         input('Password -> '),
         input('From -> '),
-        input('Rcpt to -> '),
+        input('Rcpt to (address or .csv/.jsonl list) -> '),
         int(input('Server port -> ') or 465)
     )
-    try:
-        print(sender.send_message(input('Path to file with message -> ')))
-    except SenderException as exc:
-        print(exc.message.strip('\r\n'))
+    path = input('Path to file with message or spool directory -> ')
+    sender = SMTPSender(*arguments)
+    sender.tls = tls
+    if os.path.isdir(path):
+        run_spool(sender, path)
+    elif arguments[4].endswith(('.csv', '.jsonl')):
+        bulk_send(*arguments, path, tls, options.workers)
+    else:
+        try:
+            print(sender.send_message(path))
+        except SenderException as exc:
+            print(exc.message.strip('\r\n'))
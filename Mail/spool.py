@@ -0,0 +1,123 @@
+import mmap
+import os
+import time
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from typing import Iterator, List, Optional
+
+BLOCK_SIZE = 64 * 1024
+STATES = ('active', 'sent', 'failed', 'deferred')
+
+
+def data_chunks(data, block_size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    # Whole lines at a time, so a CR LF pair or a leading dot never straddles two blocks.
+    start, size, tail = 0, len(data), b'\r\n'
+    while start < size:
+        end = data.find(b'\n', min(start + block_size, size) - 1)
+        end = size if end == -1 else end + 1
+        block = data[start:end].replace(b'\r\n', b'\n').replace(b'\r', b'\n').replace(b'\n', b'\r\n')
+        block = block.replace(b'\r\n.', b'\r\n..')
+        if block.startswith(b'.'):
+            block = b'.' + block
+        tail = block[-2:]
+        yield block
+        start = end
+    yield (b'' if tail == b'\r\n' else b'\r\n') + b'.\r\n'
+
+
+def header_recipients(data) -> List[str]:
+    ends = [index for index in (data.find(b'\n\n'), data.find(b'\r\n\r\n')) if index != -1]
+    headers = BytesHeaderParser().parsebytes(data[:min(ends) if ends else min(len(data), BLOCK_SIZE)])
+    return [address for _, address in getaddresses(headers.get_all('to', []) + headers.get_all('cc', [])) if address]
+
+
+class SpoolMessage:
+    path: str
+    _file = None
+    data = b''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __enter__(self) -> 'SpoolMessage':
+        self._file = open(self.path, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+
+class Spool:
+    _directory: str
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        for state in STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+        # Whatever was in flight when the previous runner died is queued again.
+        for name in os.listdir(self._state('active')):
+            os.replace(os.path.join(self._state('active'), name), os.path.join(directory, name))
+
+    def _state(self, state: str) -> str:
+        return os.path.join(self._directory, state)
+
+    def pending(self) -> List[str]:
+        # A deferred message has its next attempt time as mtime, so it is left out until then and queued last.
+        now = time.time()
+        with os.scandir(self._directory) as entries:
+            files = [(entry.stat().st_mtime, entry.name) for entry in entries
+                     if entry.is_file() and entry.name.endswith('.eml')]
+        return [name for mtime, name in sorted(files) if mtime <= now]
+
+    def claim(self, name: str) -> Optional[str]:
+        path = os.path.join(self._state('active'), name)
+        try:
+            os.rename(os.path.join(self._directory, name), path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _move(self, path: str, directory: str) -> None:
+        os.replace(path, os.path.join(directory, os.path.basename(path)))
+
+    def _attempts_path(self, path: str) -> str:
+        return os.path.join(self._state('deferred'), os.path.basename(path))
+
+    def attempts(self, path: str) -> int:
+        try:
+            with open(self._attempts_path(path)) as file:
+                return int(file.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _forget(self, path: str) -> None:
+        try:
+            os.remove(self._attempts_path(path))
+        except FileNotFoundError:
+            pass
+
+    def sent(self, path: str) -> None:
+        self._forget(path)
+        self._move(path, self._state('sent'))
+
+    def failed(self, path: str, error: str) -> None:
+        self._forget(path)
+        with open(os.path.join(self._state('failed'), os.path.basename(path) + '.err'), 'w') as file:
+            file.write(error)
+        self._move(path, self._state('failed'))
+
+    def release(self, path: str) -> None:
+        self._move(path, self._directory)
+
+    def defer(self, path: str, delay: float) -> int:
+        attempts = self.attempts(path) + 1
+        with open(self._attempts_path(path), 'w') as file:
+            file.write(str(attempts))
+        next_attempt = time.time() + delay
+        os.utime(path, (next_attempt, next_attempt))
+        self.release(path)
+        return attempts
@@ -0,0 +1,143 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import TestCase
+
+from sender import SMTPSender, bulk_send, run_spool
+from spool import Spool, data_chunks, header_recipients
+# Shared with Smtp-mime, which sender.py puts on the import path.
+from fake_server import FakeSMTPServer, self_signed, server_context
+from tls import TLSSessionCache
+
+
+class DataTests(TestCase):
+    def test_dot_stuffing_and_line_endings(self):
+        data = b'Subject: x\n\n.leading dot\nbare LF\rbare CR\r\n..two dots\nlast'
+        self.assertEqual(b'Subject: x\r\n\r\n..leading dot\r\nbare LF\r\nbare CR\r\n...two dots\r\nlast\r\n.\r\n',
+                         b''.join(data_chunks(data)))
+        self.assertEqual(b'..x\r\n.\r\n', b''.join(data_chunks(b'.x\r\n')))
+
+    def test_blocks_end_on_lines(self):
+        data = b''.join(b'.line %d\n' % i for i in range(1000))
+        chunks = list(data_chunks(data, block_size=100))
+        self.assertGreater(len(chunks), 10)
+        self.assertTrue(all(chunk.endswith(b'\r\n') for chunk in chunks))
+        self.assertEqual(b''.join(data_chunks(data)), b''.join(chunks))
+
+    def test_header_recipients(self):
+        data = b'To: Ann <a@local>, b@local\r\nCc: "C, D" <c@local>\r\nSubject: x\r\n\r\nTo: body@local\r\n'
+        self.assertEqual(['a@local', 'b@local', 'c@local'], header_recipients(data))
+        self.assertEqual([], header_recipients(b'Subject: none\n\nbody'))
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is needed for a test certificate')
+class SpoolTests(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.certificates = tempfile.mkdtemp()
+        cls.cert, key = self_signed(cls.certificates)
+        cls.context = server_context(cls.cert, key)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls.certificates)
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeSMTPServer(tls=self.context, implicit_tls=True, reject=['bad@local'],
+                                     defer=['later@local']).start()
+        self.sender = SMTPSender('127.0.0.1', 'user', 'password', '<from@local>', 'to@local', self.server.port)
+        self.sender.tls, self.sender.timeout = TLSSessionCache(cafile=self.cert), 2
+
+    def tearDown(self) -> None:
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _write(self, name: str, to: str, body: bytes, age: float = 60) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(b'To: <' + to.encode() + b'>\nSubject: ' + name.encode() + b'\n\n' + body)
+        # Older files go first.
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def _run(self, **kwargs) -> str:
+        output = io.StringIO()
+        with redirect_stdout(output):
+            run_spool(self.sender, self.directory, once=True, **kwargs)
+        return output.getvalue()
+
+    def _state(self, state: str) -> list:
+        return sorted(os.listdir(os.path.join(self.directory, state)))
+
+    def test_deferred_message_does_not_block_the_others(self):
+        self._write('1.eml', 'later@local', b'deferred\n', age=90)
+        self._write('2.eml', 'a@local', b'.leading dot\nbare LF only\n', age=60)
+        self._write('3.eml', 'bad@local', b'refused\n', age=30)
+        self._run(backoff=0.2)
+        self.assertEqual(['2.eml'], self._state('sent'))
+        self.assertEqual(['3.eml', '3.eml.err'], self._state('failed'))
+        self.assertEqual(['1.eml'], self._state('deferred'))
+        message, = self.server.messages
+        self.assertEqual(['<a@local>'], message.rcpt_to)
+        # The server took the dot off again, and every line ended in CR LF.
+        self.assertIn(b'\r\n.leading dot\r\nbare LF only\r\n', message.data)
+        self.assertNotIn(b'\n', message.data.replace(b'\r\n', b''))
+        # Not due yet: the next round leaves it alone.
+        self._run(backoff=0.2)
+        self.assertEqual(1, len(self.server.messages))
+        self.assertEqual([], Spool(self.directory).pending())
+        time.sleep(0.3)
+        self.server.defer.clear()
+        self._run(backoff=0.2)
+        self.assertEqual(['1.eml', '2.eml'], self._state('sent'))
+        self.assertEqual([], self._state('deferred'))
+        self.assertEqual(['<later@local>'], self.server.messages[-1].rcpt_to)
+
+    def test_backoff_and_max_attempts(self):
+        path = self._write('1.eml', 'later@local', b'deferred\n')
+        self._run(backoff=10)
+        spool = Spool(self.directory)
+        self.assertEqual(1, spool.attempts(path))
+        self.assertAlmostEqual(time.time() + 10, os.stat(path).st_mtime, delta=2)
+        os.utime(path, (0, 0))
+        self._run(backoff=10, max_attempts=2)
+        self.assertEqual(['1.eml', '1.eml.err'], self._state('failed'))
+        with open(os.path.join(self.directory, 'failed', '1.eml.err')) as file:
+            self.assertIn('451', file.read())
+
+    def test_restart_recovers_active(self):
+        self._write('1.eml', 'a@local', b'in flight\n')
+        spool = Spool(self.directory)
+        self.assertIsNotNone(spool.claim('1.eml'))
+        self.assertEqual(['1.eml'], self._state('active'))
+        # Claimed by a runner that then died: the next one queues it again.
+        self.assertEqual(['1.eml'], Spool(self.directory).pending())
+        self.assertIsNone(spool.claim('missing.eml'))
+        self._run()
+        self.assertEqual(([], ['1.eml']), (self._state('active'), self._state('sent')))
+        self.assertEqual(1, len(self.server.messages))
+
+    def test_bulk_send_keeps_a_session_per_worker(self):
+        recipients, message = os.path.join(self.directory, 'list.csv'), os.path.join(self.directory, 'message.txt')
+        with open(recipients, 'w') as file:
+            file.write('email\n' + ''.join(f'user{i}@local\n' for i in range(20)) + 'bad@local\n')
+        with open(message, 'w') as file:
+            file.write('Subject: bulk\n\nHello\n')
+        with redirect_stdout(io.StringIO()) as output:
+            bulk_send('127.0.0.1', 'user', 'password', '<from@local>', recipients, self.server.port, message,
+                      self.sender.tls, workers=3)
+        self.assertEqual(20, len(self.server.messages))
+        self.assertIn('"failed": 1', output.getvalue())
+        # The refused recipient was reset, not reconnected.
+        self.assertLessEqual(self.server.connections, 3)
+        self.assertEqual(self.server.connections, self.server.commands.count(b'QUIT'))
+
+
+if __name__ == '__main__':
+    unittest.main()
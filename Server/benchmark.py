@@ -0,0 +1,170 @@
+import argparse
+import contextlib
+import json
+import os
+import selectors
+import signal
+import socket
+import time
+from multiprocessing import Pool, Process, Queue
+from typing import Dict, List
+
+from clients import raise_fd_limit
+from protocol import LineFramer
+from server import Limits, Server, SelectorServer, PreforkServer
+
+MODES = {'threaded': Server, 'selector': SelectorServer}
+
+
+def _serve(mode: str, backlog: int, workers: int, ports: Queue) -> None:
+    raise_fd_limit()
+    limits = Limits(idle_timeout=600)
+    if mode == 'prefork':
+        server = PreforkServer(host='127.0.0.1', count=backlog, limits=limits, workers=workers)
+    else:
+        server = MODES[mode](host='127.0.0.1', count=backlog, limits=limits)
+    signal.signal(signal.SIGTERM, lambda *_: server.close())
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            server.create_server()
+            ports.put(server.port)
+            server.start()
+        finally:
+            server.close()
+
+
+def run_server(mode: str, backlog: int = 4096, workers: int = 0):
+    ports = Queue()
+    process = Process(target=_serve, args=(mode, backlog, workers, ports))
+    process.start()
+    return process, ports.get(timeout=10)
+
+
+def hold_connections(port: int, count: int, timeout: float) -> List[socket.socket]:
+    selector = selectors.DefaultSelector()
+    greeted: List[socket.socket] = []
+    for _ in range(count):
+        sock = socket.socket()
+        sock.setblocking(False)
+        sock.connect_ex(('127.0.0.1', port))
+        selector.register(sock, selectors.EVENT_READ)
+    deadline = time.perf_counter() + timeout
+    while len(greeted) < count and time.perf_counter() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            selector.unregister(key.fileobj)
+            try:
+                if key.fileobj.recv(1024):
+                    greeted.append(key.fileobj)
+                    continue
+            except socket.error:
+                pass
+            key.fileobj.close()
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    return greeted
+
+
+def ping_pong(sockets: List[socket.socket], duration: float, pipeline: int = 1) -> int:
+    selector = selectors.DefaultSelector()
+    # A reply may arrive split over two reads, so they are counted as whole lines.
+    framers = {sock: LineFramer() for sock in sockets}
+    for sock in sockets:
+        selector.register(sock, selectors.EVENT_READ)
+        sock.send(b'PING\n' * pipeline)
+    replies = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                data = key.fileobj.recv(4096)
+            except socket.error:
+                data = b''
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            pongs = framers[key.fileobj].feed(data).count(b'PONG')
+            replies += pongs
+            key.fileobj.send(b'PING\n' * pongs)
+    selector.close()
+    return replies
+
+
+def bench(mode: str, connections: int, clients: int, duration: float, pipeline: int = 1) -> Dict[str, float]:
+    process, port = run_server(mode)
+    try:
+        held = hold_connections(port, connections, timeout=max(10.0, connections / 1000))
+        active = held[:clients]
+        replies = ping_pong(active, duration, pipeline)
+        for sock in held:
+            sock.close()
+        return {
+            'mode': mode,
+            'connections_requested': connections,
+            'connections_held': len(held),
+            'ping_clients': len(active),
+            'pipeline': pipeline,
+            'duration': duration,
+            'pongs': replies,
+            'pongs_per_sec': round(replies / duration, 1),
+        }
+    finally:
+        process.terminate()
+        process.join()
+
+
+def _client_process(args) -> int:
+    port, clients, duration, pipeline = args
+    sockets = hold_connections(port, clients, timeout=10.0)
+    try:
+        return ping_pong(sockets, duration, pipeline)
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def bench_prefork(workers: int, clients: int, duration: float, processes: int, pipeline: int = 1) -> Dict[str, float]:
+    process, port = run_server('prefork', workers=workers)
+    try:
+        time.sleep(0.5)
+        with Pool(processes) as pool:
+            share = max(1, clients // processes)
+            replies = sum(pool.map(_client_process, [(port, share, duration, pipeline)] * processes))
+        return {
+            'mode': 'prefork',
+            'workers': workers,
+            'ping_clients': share * processes,
+            'client_processes': processes,
+            'pipeline': pipeline,
+            'duration': duration,
+            'requests': replies,
+            'requests_per_sec': round(replies / duration, 1),
+        }
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Server modes benchmark')
+    parser.add_argument('-m', '--mode', choices=[*MODES, 'prefork', 'all'], default='all')
+    parser.add_argument('-c', '--connections', type=int, default=2000, help='Idle connections to hold')
+    parser.add_argument('-k', '--clients', type=int, default=100, help='Connections doing PING/PONG')
+    parser.add_argument('-d', '--duration', type=float, default=5.0)
+    parser.add_argument('-w', '--workers', default=f'1,2,4,{os.cpu_count()}',
+                        help='Comma separated prefork worker counts')
+    parser.add_argument('-l', '--pipeline', type=int, default=1, help='PINGs in flight per connection')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(), help='Prefork client processes')
+    args = parser.parse_args()
+    limit = raise_fd_limit()
+    if limit is not None and args.connections > limit - 64:
+        print(f'Open files limit is {limit}, connections count may be capped')
+    for mode in (MODES if args.mode == 'all' else [args.mode] if args.mode != 'prefork' else []):
+        print(json.dumps(bench(mode, args.connections, args.clients, args.duration, args.pipeline)), flush=True)
+    if args.mode in ('prefork', 'all'):
+        for workers in sorted({int(count) for count in args.workers.split(',')}):
+            print(json.dumps(bench_prefork(workers, args.clients, args.duration, args.processes, args.pipeline)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
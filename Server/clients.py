@@ -1,21 +1,46 @@
+import argparse
+import asyncio
+import json
+import random
 import socket
+import time
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
 from threading import Thread
 from time import sleep
+from typing import Deque, Dict, Optional
+
+from protocol import Framer, LineFramer
 
 
 class Client(Thread):
-    def __init__(self, host: str, port: int, id: int):
+    def __init__(self, host: str, port: int, id: int, framer: Framer = None):
         super().__init__()
         self.host, self.port = host, port
         self.client: socket.socket = socket.socket()
         self.id = id
+        self.framer = framer or LineFramer()
+        self._frames: Deque[bytes] = deque()
+
+    def send(self, message: str) -> None:
+        self.client.sendall(self.framer.encode(message.encode()))
+
+    def receive(self) -> str:
+        while not self._frames:
+            data = self.client.recv(4096)
+            if not data:
+                raise ConnectionResetError('Connection closed by server')
+            self._frames.extend(self.framer.feed(data))
+        return self._frames.popleft().decode()
 
     def run(self) -> None:
         try:
             self.client.connect((self.host, self.port))
-            print(self.client.recv(1024).decode(), f'Thread - {self.id}', flush=True)
-            self.client.sendall(b'PING')
-            print(self.client.recv(1024).decode(), f'Thread - {self.id}', flush=True)
+            self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(self.receive(), f'Thread - {self.id}', flush=True)
+            self.send('PING')
+            print(self.receive(), f'Thread - {self.id}', flush=True)
             sleep(5)
         except socket.error as exc:
             print(exc)
@@ -23,11 +48,161 @@ class Client(Thread):
             self.client.close()
 
 
-def main(host: str, port: int):
-    clients = [Client(host, port, _) for _ in range(10)]
-    for client in clients:
-        client.start()
+@dataclass
+class LoadConfig:
+    host: str = 'localhost'
+    port: int = 8080
+    connections: int = 100
+    ramp_up: float = 1.0
+    pipeline: int = 1
+    duration: float = 10.0
+    timeout: float = 5.0
+    mix: Dict[str, float] = field(default_factory=lambda: {'PING': 1.0})
+
+
+class LoadGenerator:
+    _config: LoadConfig
+    _latencies: array
+    _opened: int
+    _failed: int
+    _errors: int
+    _deadline: float
+
+    def __init__(self, config: LoadConfig):
+        self._config = config
+        self._latencies = array('d')
+        self._opened = self._failed = self._errors = 0
+        self._commands = [command.encode() + b'\n' for command in config.mix]
+        self._weights = list(config.mix.values())
+
+    async def _read_replies(self, reader: asyncio.StreamReader, sent: Deque[float], count: int) -> None:
+        for _ in range(count):
+            line = await reader.readline()
+            if not line:
+                raise ConnectionResetError('Connection closed by server')
+            self._latencies.append(time.perf_counter() - sent.popleft())
+
+    async def _connection(self, index: int) -> None:
+        config = self._config
+        await asyncio.sleep(config.ramp_up * index / config.connections)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(config.host, config.port), config.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._failed += 1
+            return
+        self._opened += 1
+        sent: Deque[float] = deque()
+        try:
+            await asyncio.wait_for(reader.readline(), config.timeout)
+            while time.perf_counter() < self._deadline:
+                batch = random.choices(self._commands, self._weights, k=config.pipeline)
+                now = time.perf_counter()
+                writer.write(b''.join(batch))
+                sent.extend(now for _ in batch)
+                await asyncio.wait_for(self._read_replies(reader, sent, len(batch)), config.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._errors += 1
+        finally:
+            writer.close()
+
+    async def run(self) -> Dict[str, object]:
+        config = self._config
+        started = time.perf_counter()
+        self._deadline = started + config.duration
+        await asyncio.gather(*(self._connection(i) for i in range(config.connections)))
+        elapsed = time.perf_counter() - started
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, object]:
+        latencies = sorted(self._latencies)
+
+        def percentile(value: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(value / 100 * len(latencies)))] * 1000, 3)
+
+        return {
+            'connections': self._config.connections,
+            'opened': self._opened,
+            'failed': self._failed,
+            'errors': self._errors,
+            'pipeline': self._config.pipeline,
+            'mix': self._config.mix,
+            'duration': round(elapsed, 3),
+            'requests': len(latencies),
+            'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': {
+                'p50': percentile(50),
+                'p95': percentile(95),
+                'p99': percentile(99),
+                'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            },
+        }
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    result: Dict[str, float] = {}
+    for item in mix.split(','):
+        command, _, weight = item.partition('=')
+        result[command] = float(weight or 1)
+    return result
+
+
+def run_in_process(mode: str, config: LoadConfig) -> Dict[str, object]:
+    from server import Limits, Server, SelectorServer
+
+    server = (SelectorServer if mode == 'selector' else Server)(
+        host='127.0.0.1', count=4096, limits=Limits(idle_timeout=config.duration + config.ramp_up + 60)
+    )
+    server.create_server()
+    thread = Thread(target=server.start, daemon=True)
+    thread.start()
+    config.host, config.port = '127.0.0.1', server.port
+    try:
+        report = asyncio.run(LoadGenerator(config).run())
+        report['server'] = mode
+        return report
+    finally:
+        server.close()
+        thread.join()
+
+
+def raise_fd_limit(cap: int = 65536) -> Optional[int]:
+    # Every connection is a descriptor; the soft limit is raised where there is one (not on Windows), and
+    # returned. The hard limit may be RLIM_INFINITY, which macOS refuses as a soft limit, hence the cap.
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = cap if hard == resource.RLIM_INFINITY else min(hard, cap)
+    if soft == resource.RLIM_INFINITY or soft >= target:
+        return soft
+    resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='clients.py', description='Load generator for the PING/PONG server')
+    parser.add_argument('-s', '--server', default='localhost:8080', help='Host:port')
+    parser.add_argument('-c', '--connections', type=int, default=100)
+    parser.add_argument('-r', '--ramp-up', type=float, default=1.0, help='Seconds to open all connections')
+    parser.add_argument('-l', '--pipeline', type=int, default=1, help='Commands in flight per connection')
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    parser.add_argument('-m', '--mix', default='PING', help='Weighted commands, e.g. PING=9,STATS=1')
+    parser.add_argument('--in-process', choices=['threaded', 'selector'],
+                        help='Start Server in this process on an ephemeral port and benchmark it')
+    args = parser.parse_args()
+    raise_fd_limit()
+    host, _, port = args.server.rpartition(':')
+    config = LoadConfig(host, int(port), args.connections, args.ramp_up, args.pipeline, args.duration,
+                        mix=parse_mix(args.mix))
+    if args.in_process:
+        report = run_in_process(args.in_process, config)
+    else:
+        report = asyncio.run(LoadGenerator(config).run())
+    print(json.dumps(report))
 
 
 if __name__ == '__main__':
-    main('localhost', 8080)
+    main()
@@ -0,0 +1,119 @@
+import json
+import os
+import sys
+import time
+from threading import Lock, Thread, Event
+from typing import Dict, List, Optional, TextIO
+
+
+class Histogram:
+    # Bucket i holds values in [2 ** (i - 1), 2 ** i) microseconds, bucket 0 holds values under 1 us.
+    _buckets: List[int]
+    _count: int
+    _total: float
+    _max: float
+
+    def __init__(self, size: int = 32):
+        self._buckets = [0] * size
+        self._count, self._total, self._max = 0, 0.0, 0.0
+
+    def record(self, seconds: float, count: int = 1) -> None:
+        index = min(int(seconds * 1e6).bit_length(), len(self._buckets) - 1)
+        self._buckets[index] += count
+        self._count += count
+        self._total += seconds * count
+        if seconds > self._max:
+            self._max = seconds
+
+    def percentile(self, value: float) -> float:
+        if not self._count:
+            return 0.0
+        rank, seen = value / 100 * self._count, 0
+        for index, count in enumerate(self._buckets):
+            seen += count
+            if seen >= rank and count:
+                return min((1 << index) / 1e6, self._max)
+        return self._max
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self._count,
+            'mean': self._total / self._count if self._count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self._max,
+        }
+
+
+class Metrics:
+    _lock: Lock
+    _counters: Dict[str, int]
+    _commands: Dict[str, int]
+    _latency: Histogram
+    _started: float
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {'accepts': 0, 'rejects': 0, 'closes': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._commands = {}
+        self._latency = Histogram()
+        self._started = time.time()
+
+    def incr(self, name: str, value: int = 1) -> int:
+        with self._lock:
+            self._counters[name] += value
+            return self._counters[name]
+
+    def record_batch(self, bytes_in: int, replies: List[bytes], commands: Dict[bytes, int], latency: float) -> None:
+        with self._lock:
+            self._counters['bytes_in'] += bytes_in
+            for name, count in commands.items():
+                key = name.decode(errors='replace')
+                self._commands[key] = self._commands.get(key, 0) + count
+            if replies:
+                self._counters['bytes_out'] += sum(map(len, replies))
+                self._latency.record(latency, len(replies))
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self._started,
+                **self._counters,
+                'commands': dict(self._commands),
+                'latency': self._latency.snapshot(),
+            }
+
+    def to_json(self, **extra) -> str:
+        return json.dumps({**self.snapshot(), **extra}, separators=(',', ':'))
+
+
+class MetricsDumper(Thread):
+    _metrics: Metrics
+    _interval: float
+    _path: Optional[str]
+    _stream: TextIO
+    _stopped: Event
+
+    def __init__(self, metrics: Metrics, interval: float, path: str = None, stream: TextIO = sys.stderr):
+        super().__init__(daemon=True)
+        self._metrics, self._interval = metrics, interval
+        self._path, self._stream = path, stream
+        self._stopped = Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.dump()
+
+    def dump(self) -> None:
+        line = self._metrics.to_json(pid=os.getpid()) + '\n'
+        if self._path:
+            with open(self._path, 'a') as file:
+                file.write(line)
+        else:
+            self._stream.write(line)
+            self._stream.flush()
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,155 @@
+import os
+import socket
+import struct
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Type
+
+
+@dataclass
+class FrameException(Exception):
+    message: str
+
+
+class Framer:
+    max_size: int = 64 * 1024
+    _buffer: bytearray = None
+
+    def __init__(self, max_size: int = None):
+        self._buffer = bytearray()
+        if max_size is not None:
+            self.max_size = max_size
+
+    def feed(self, data: bytes) -> List[bytes]:
+        raise NotImplementedError
+
+    def encode(self, payload: bytes) -> bytes:
+        raise NotImplementedError
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+
+class LineFramer(Framer):
+    delimiter: bytes = b'\n'
+    _scanned: int = 0
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self._buffer += data
+        frames: List[bytes] = []
+        start = 0
+        end = self._buffer.find(self.delimiter, max(0, self._scanned - len(self.delimiter) + 1))
+        while end != -1:
+            frames.append(bytes(self._buffer[start:end]).rstrip(b'\r'))
+            start = end + len(self.delimiter)
+            end = self._buffer.find(self.delimiter, start)
+        if start:
+            del self._buffer[:start]
+        self._scanned = len(self._buffer)
+        if self._scanned > self.max_size:
+            raise FrameException(f'Line is longer than {self.max_size} bytes')
+        return frames
+
+    def encode(self, payload: bytes) -> bytes:
+        return payload + self.delimiter
+
+
+class LengthPrefixFramer(Framer):
+    _header = struct.Struct('!I')
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self._buffer += data
+        frames: List[bytes] = []
+        start, size = 0, len(self._buffer)
+        while size - start >= self._header.size:
+            length, = self._header.unpack_from(self._buffer, start)
+            if length > self.max_size:
+                raise FrameException(f'Frame of {length} bytes is longer than {self.max_size} bytes')
+            end = start + self._header.size + length
+            if end > size:
+                break
+            frames.append(bytes(self._buffer[start + self._header.size:end]))
+            start = end
+        if start:
+            del self._buffer[:start]
+        return frames
+
+    def encode(self, payload: bytes) -> bytes:
+        return self._header.pack(len(payload)) + payload
+
+
+Handler = Callable[[bytes], Optional[bytes]]
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+class Dispatcher:
+    _framer: Framer
+    _responses: Dict[bytes, bytes]
+    _handlers: Dict[bytes, Handler]
+
+    def __init__(self, framer: Type[Framer] = LineFramer):
+        self._framer = framer()
+        self._responses = {}
+        self._handlers = {}
+
+    @classmethod
+    def from_template(cls, template: Dict[str, str], framer: Type[Framer] = LineFramer) -> 'Dispatcher':
+        dispatcher = cls(framer)
+        for command, response in template.items():
+            dispatcher.register(command, response)
+        return dispatcher
+
+    def register(self, command: str, response: str = None, handler: Handler = None) -> None:
+        if (response is None) == (handler is None):
+            raise ValueError('Exactly one of response or handler is required')
+        name = command.encode()
+        self._responses.pop(name, None)
+        self._handlers.pop(name, None)
+        if handler is None:
+            self._responses[name] = self._framer.encode(response.encode())
+        else:
+            self._handlers[name] = handler
+
+    def unregister(self, command: str) -> None:
+        name = command.encode()
+        self._responses.pop(name, None)
+        self._handlers.pop(name, None)
+
+    def response(self, command: str) -> bytes:
+        return self._responses[command.encode()]
+
+    def dispatch(self, frames: List[bytes], commands: Dict[bytes, int] = None) -> List[bytes]:
+        replies: List[bytes] = []
+        responses, handlers = self._responses, self._handlers
+        for frame in frames:
+            reply = responses.get(frame)
+            if reply is not None:
+                replies.append(reply)
+                if commands is not None:
+                    commands[frame] = commands.get(frame, 0) + 1
+                continue
+            name, _, args = frame.partition(b' ')
+            handler = handlers.get(name)
+            if commands is not None:
+                key = name if handler is not None else b'unknown'
+                commands[key] = commands.get(key, 0) + 1
+            if handler is not None:
+                payload = handler(args)
+                if payload is not None:
+                    replies.append(self._framer.encode(payload))
+        return replies
+
+
+def send_buffers(sock: socket.socket, buffers: List[bytes]) -> List[bytes]:
+    chunk = buffers[:IOV_MAX]
+    sent = sock.sendmsg(chunk)
+    for i, buffer in enumerate(chunk):
+        if sent < len(buffer):
+            return [buffer[sent:], *buffers[i + 1:]]
+        sent -= len(buffer)
+    return buffers[len(chunk):]
+
+
+def sendall_buffers(sock: socket.socket, buffers: List[bytes]) -> None:
+    while buffers:
+        buffers = send_buffers(sock, buffers)
@@ -1,6 +1,36 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
 import socket
-from threading import Thread, Lock
-from typing import Set, Optional, Dict
+import time
+from dataclasses import dataclass
+from threading import Thread, Lock, Event, Condition
+from typing import Set, Optional, Dict, Type, List, Callable, Tuple
+
+from protocol import Dispatcher, Framer, Handler, FrameException, LineFramer, LengthPrefixFramer, send_buffers, sendall_buffers
+
+from metrics import Metrics, MetricsDumper
+from timer_wheel import TimerWheel
+
+logger = logging.getLogger('server')
+
+FRAMERS: Dict[str, Type[Framer]] = {'line': LineFramer, 'length': LengthPrefixFramer}
+
+
+@dataclass
+class Limits:
+    idle_timeout: float = 3.0
+    tick: float = 0.5
+    max_connections: int = 0
+    max_per_ip: int = 0
+
+
+@dataclass
+class ServerException(Exception):
+    message: str
 
 
 def ident_iter():
@@ -17,18 +47,28 @@ class Connection:
     _id: int = None
     _stop: bool = None
     _close_hook: set.remove = None
+    _touch_hook: Callable[['Connection'], None] = None
+    _metrics: Metrics = None
     _conn_thread: Thread = None
+    _framer: Framer = None
+    _dispatcher: Dispatcher = None
     response_template: Dict[str, str] = {
         'Hello': 'Hello, glad to see you on our server!',
         'PING': 'PONG'
     }
 
-    def __init__(self, conn: socket.socket, close_hook: set.remove):
+    def __init__(self, conn: socket.socket, close_hook: set.remove, framer: Type[Framer] = LineFramer,
+                 dispatcher: Dispatcher = None, touch_hook: Callable[['Connection'], None] = None,
+                 metrics: Metrics = None):
         self._connection: socket.socket = conn
-        self._connection.settimeout(3)
+        self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._lock = Lock()
         self._stop = False
         self._close_hook = close_hook
+        self._touch_hook = touch_hook or (lambda connection: None)
+        self._metrics = metrics or Metrics()
+        self._framer = framer()
+        self._dispatcher = dispatcher or Dispatcher.from_template(self.response_template, framer)
 
     def start(self):
         self._conn_thread = Thread(target=self._run)
@@ -36,42 +76,47 @@ class Connection:
 
     def _run(self) -> None:
         try:
-            self._connection.sendall(
-                self.response_template.get('Hello').encode()
-            )
+            self._connection.sendall(self._dispatcher.response('Hello'))
             while not self._stop:
-                message = self._get_message()
-                if message in self.response_template.keys():
-                    self._connection.sendall(
-                        self.response_template.get(message).encode()
-                    )
-        except socket.error:
+                messages, received = self._get_messages()
+                started = time.perf_counter()
+                self._touch_hook(self)
+                commands: Dict[bytes, int] = {}
+                replies = self._dispatcher.dispatch(messages, commands)
+                if replies:
+                    sendall_buffers(self._connection, replies)
+                self._metrics.record_batch(received, replies, commands, time.perf_counter() - started)
+        except (socket.error, FrameException):
             pass
         finally:
             self._close_connection()
 
-    def _get_message(self) -> Optional[str]:
-        buf = []
-        try:
-            while not self._stop:
-                data = self._connection.recv(1024)
-                if not data:
-                    break
-                buf.append(data.decode())
-        except socket.timeout:
-            if not len(buf):
-                raise
-        return ''.join(buf)
+    def _get_messages(self) -> Tuple[List[bytes], int]:
+        messages: List[bytes] = []
+        received = 0
+        while not messages:
+            data = self._connection.recv(65536)
+            if not data:
+                raise ConnectionResetError('Connection closed by client')
+            received += len(data)
+            messages = self._framer.feed(data)
+        return messages, received
 
     def _close_connection(self) -> None:
-        with self._lock:
-            print('Close connection', flush=True)
+        logger.debug('Close connection %d', self.id)
         if self._connection:
             self._connection.close()
         self._close_hook(self)
 
+    def shutdown(self) -> None:
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+
     def close(self) -> None:
         self._stop = True
+        self.shutdown()
         self._conn_thread.join()
 
     @property
@@ -91,25 +136,109 @@ class Server:
     _count: int
     _stop: bool = False
     _server: socket = None
+    _framer: Type[Framer] = LineFramer
+    _dispatcher: Dispatcher = None
+    _limits: Limits = None
+    _wheel: TimerWheel = None
+    _peers: Dict[object, str] = None
+    _per_ip: Dict[str, int] = None
+    _slots: Condition = None
+    _metrics: Metrics = None
+    _dumper: MetricsDumper = None
+    _dump: Tuple[float, Optional[str]] = None
+    _log_sample: int = 1000
 
-    def __init__(self, host: str = '', port: int = 0, count: int = 0):
+    def __init__(self, host: str = '', port: int = 0, count: int = 0, framer: Type[Framer] = LineFramer,
+                 dispatcher: Dispatcher = None, limits: Limits = None):
         self._host, self._port, self._count = host, port, count
         self._connections: Set[Connection] = set()
         self._stop = False
+        self._framer = framer
+        self._dispatcher = dispatcher or Dispatcher.from_template(Connection.response_template, framer)
+        self._limits = limits or Limits()
+        self._wheel = TimerWheel(self._limits.idle_timeout, self._limits.tick)
+        self._peers, self._per_ip = {}, {}
+        self._slots = Condition()
+        self._metrics = Metrics()
+        self._dispatcher.register('STATS', handler=self._stats)
+
+    def _stats(self, args: bytes) -> bytes:
+        return self._metrics.to_json(connections=len(self._connections)).encode()
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
+
+    def dump_metrics(self, interval: float, path: str = None) -> None:
+        self._dump = interval, path
+
+    def _start_dumper(self) -> None:
+        if self._dump and not self._dumper:
+            self._dumper = MetricsDumper(self._metrics, *self._dump)
+            self._dumper.start()
+
+    def register_command(self, command: str, response: str = None, handler: Handler = None) -> None:
+        self._dispatcher.register(command, response, handler)
 
     def create_server(self):
         self._server: socket = socket.create_server(
             (self._host, self._port), backlog=self._count
         )
 
+    @property
+    def _full(self) -> bool:
+        return 0 < self._limits.max_connections <= len(self._connections)
+
+    def _admit(self, connection, ip: str) -> bool:
+        with self._slots:
+            if 0 < self._limits.max_per_ip <= self._per_ip.get(ip, 0):
+                self._metrics.incr('rejects')
+                return False
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+            self._peers[connection] = ip
+            self._connections.add(connection)
+        self._wheel.touch(connection)
+        accepts = self._metrics.incr('accepts')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Accept %s, connections count - %d', ip, len(self._connections))
+        elif accepts % self._log_sample == 0:
+            logger.info('Accepts - %d, connections count - %d', accepts, len(self._connections))
+        return True
+
+    def _forget(self, connection) -> None:
+        self._wheel.discard(connection)
+        with self._slots:
+            self._connections.discard(connection)
+            ip = self._peers.pop(connection, None)
+            if ip is not None:
+                self._metrics.incr('closes')
+                self._per_ip[ip] -= 1
+                if not self._per_ip[ip]:
+                    del self._per_ip[ip]
+            self._slots.notify()
+
+    def _reap(self) -> None:
+        while not self._stop:
+            time.sleep(self._wheel.tick)
+            for connection in self._wheel.expire():
+                connection.shutdown()
+
     def start(self):
+        reaper = Thread(target=self._reap, daemon=True)
+        reaper.start()
+        self._start_dumper()
         try:
             while not self._stop:
+                with self._slots:
+                    while self._full and not self._stop:
+                        self._slots.wait(self._wheel.tick)
                 conn, adr = self._server.accept()
-                connection = Connection(conn, self._connections.remove)
+                connection = Connection(conn, self._forget, self._framer, self._dispatcher, self._wheel.touch,
+                                        self._metrics)
+                if not self._admit(connection, adr[0]):
+                    conn.close()
+                    continue
                 connection.start()
-                self._connections.add(connection)
-                print(f'Connections count - {len(self._connections)}')
         except (OSError, socket.error):
             pass
 
@@ -125,17 +254,335 @@ class Server:
 
     def close(self):
         self._stop = True
+        if self._dumper:
+            self._dumper.stop()
         if self._server:
+            try:
+                self._server.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
             self._server.close()
         for conn in list(self._connections):
             conn.close()
 
 
+class SelectorConnection:
+    _ident_iter = iter(ident_iter())
+    _connection: socket.socket = None
+    _id: int = None
+    _out: List[bytes] = None
+    _framer: Framer = None
+    _dispatcher: Dispatcher = None
+    _metrics: Metrics = None
+    _buffered: int = 0
+    high_water: int = 1024 * 1024
+
+    def __init__(self, conn: socket.socket, framer: Type[Framer] = LineFramer, dispatcher: Dispatcher = None,
+                 metrics: Metrics = None):
+        self._connection = conn
+        self._connection.setblocking(False)
+        self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._out = []
+        self._id = next(self._ident_iter)
+        self._framer = framer()
+        self._dispatcher = dispatcher or Dispatcher.from_template(Connection.response_template, framer)
+        self._metrics = metrics or Metrics()
+
+    @property
+    def socket(self) -> socket.socket:
+        return self._connection
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._out)
+
+    @property
+    def backlogged(self) -> bool:
+        # Past the high-water mark nothing more is read until the client has taken its replies.
+        return self._buffered > self.high_water
+
+    def on_data(self, data: bytes) -> bool:
+        started = time.perf_counter()
+        messages = self._framer.feed(data)
+        commands: Dict[bytes, int] = {}
+        replies = self._dispatcher.dispatch(messages, commands)
+        if replies:
+            self.write(replies)
+        self._metrics.record_batch(len(data), replies, commands, time.perf_counter() - started)
+        return bool(messages)
+
+    def greet(self) -> None:
+        self.write([self._dispatcher.response('Hello')])
+
+    def write(self, buffers: List[bytes]) -> None:
+        waiting = bool(self._out)
+        self._out.extend(buffers)
+        self._buffered += sum(map(len, buffers))
+        if waiting:
+            return
+        try:
+            self.flush()
+        except BlockingIOError:
+            pass
+
+    def flush(self) -> None:
+        remaining = send_buffers(self._connection, self._out)
+        done = len(self._out) - len(remaining)
+        partial = len(self._out[done]) - len(remaining[0]) if remaining else 0
+        self._buffered -= sum(map(len, self._out[:done])) + partial
+        self._out = remaining
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @property
+    def id(self):
+        return self._id
+
+    def __hash__(self):
+        return self.id
+
+
+class SelectorServer(Server):
+    _selector: selectors.BaseSelector = None
+    _wakeup: socket.socket = None
+    _waker: socket.socket = None
+    _running: bool = False
+    _paused: bool = False
+
+    def create_server(self):
+        super().create_server()
+        self.attach(self._server)
+
+    def attach(self, sock: socket.socket) -> None:
+        self._server = sock
+        self._server.setblocking(False)
+        self._waker, self._wakeup = socket.socketpair()
+        self._waker.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ, self._accept)
+        self._selector.register(self._waker, selectors.EVENT_READ, None)
+
+    def start(self):
+        self._running = True
+        self._start_dumper()
+        try:
+            while not self._stop:
+                for key, mask in self._selector.select(self._wheel.tick):
+                    if key.data is None:
+                        continue
+                    key.data(key.fileobj, mask)
+                for connection in self._wheel.expire():
+                    self._drop(connection)
+                if self._paused and not self._full:
+                    self._pause(False)
+        except (OSError, socket.error, ValueError):
+            pass
+        finally:
+            self._running = False
+            self._release()
+
+    def _pause(self, paused: bool) -> None:
+        # Leaving the listening socket out of the selector lets the kernel backlog fill up,
+        # so new clients wait in SYN/accept queues instead of costing us memory.
+        if paused:
+            self._selector.unregister(self._server)
+        else:
+            self._selector.register(self._server, selectors.EVENT_READ, self._accept)
+        self._paused = paused
+
+    def _accept(self, sock: socket.socket, mask: int) -> None:
+        while True:
+            if self._full:
+                return self._pause(True)
+            try:
+                conn, adr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Out of file descriptors: retry on the next tick.
+                return self._pause(True)
+            connection = SelectorConnection(conn, self._framer, self._dispatcher, self._metrics)
+            if not self._admit(connection, adr[0]):
+                conn.close()
+                continue
+            self._selector.register(conn, selectors.EVENT_READ, self._serve(connection))
+            try:
+                connection.greet()
+            except socket.error:
+                self._drop(connection)
+                continue
+            self._update(connection)
+
+    def _serve(self, connection: SelectorConnection):
+        def handler(sock: socket.socket, mask: int) -> None:
+            try:
+                if mask & selectors.EVENT_READ:
+                    data = sock.recv(65536)
+                    if not data:
+                        return self._drop(connection)
+                    if connection.on_data(data):
+                        self._wheel.touch(connection)
+                if mask & selectors.EVENT_WRITE:
+                    connection.flush()
+            except (BlockingIOError, InterruptedError):
+                pass
+            except (socket.error, FrameException):
+                return self._drop(connection)
+            self._update(connection)
+        return handler
+
+    def _update(self, connection: SelectorConnection) -> None:
+        events = 0 if connection.backlogged else selectors.EVENT_READ
+        if connection.pending:
+            events |= selectors.EVENT_WRITE
+        key = self._selector.get_key(connection.socket)
+        if key.events != events:
+            self._selector.modify(connection.socket, events, key.data)
+
+    def _drop(self, connection: SelectorConnection) -> None:
+        self._forget(connection)
+        self._selector.unregister(connection.socket)
+        connection.close()
+
+    def _release(self) -> None:
+        if self._selector is None:
+            return
+        for connection in list(self._connections):
+            self._drop(connection)
+        self._selector.close()
+        self._selector = None
+        self._waker.close()
+        self._wakeup.close()
+        if self._server:
+            self._server.close()
+
+    def close(self):
+        self._stop = True
+        if self._dumper:
+            self._dumper.stop()
+        if self._wakeup:
+            try:
+                self._wakeup.send(b'\0')
+            except socket.error:
+                pass
+        if not self._running:
+            self._release()
+
+
+def _prefork_worker(sock: Optional[socket.socket], host: str, port: int, count: int, framer: Type[Framer],
+                    dispatcher: Dispatcher, limits: Limits, dump: Optional[Tuple[float, Optional[str]]]) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = SelectorServer(host, port, count, framer, dispatcher, limits)
+    signal.signal(signal.SIGTERM, lambda *_: server.close())
+    if dump:
+        server.dump_metrics(*dump)
+    if sock is None:
+        server.attach(socket.create_server((host, port), backlog=count, reuse_port=True))
+    else:
+        server.attach(sock)
+    server.start()
+
+
+class PreforkServer(Server):
+    _workers_count: int
+    _reuse_port: bool
+    _workers: List[multiprocessing.Process] = None
+    _stopped: Event = None
+
+    def __init__(self, host: str = '', port: int = 0, count: int = 0, framer: Type[Framer] = LineFramer,
+                 dispatcher: Dispatcher = None, limits: Limits = None, workers: int = 0,
+                 reuse_port: bool = hasattr(socket, 'SO_REUSEPORT')):
+        if not self.supported():
+            raise ServerException('Prefork mode needs os.fork, which this platform does not have')
+        super().__init__(host, port, count, framer, dispatcher, limits)
+        self._workers_count = workers or os.cpu_count() or 1
+        self._reuse_port = reuse_port
+        self._workers = []
+        self._stopped = Event()
+
+    @staticmethod
+    def supported() -> bool:
+        return 'fork' in multiprocessing.get_all_start_methods()
+
+    def create_server(self):
+        if not self._reuse_port:
+            return super().create_server()
+        # Bound but not listening: reserves the port for the workers' SO_REUSEPORT group
+        # without taking a share of the incoming connections.
+        self._server = socket.socket(socket.AF_INET6 if ':' in self._host else socket.AF_INET)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._server.bind((self._host, self._port))
+
+    def _spawn(self) -> multiprocessing.Process:
+        # Forked, not spawned: workers inherit the listening socket and the dispatcher as they are.
+        worker = multiprocessing.get_context('fork').Process(
+            target=_prefork_worker,
+            args=(None if self._reuse_port else self._server, self.host, self.port, self._count, self._framer,
+                  self._dispatcher, self._limits, self._dump),
+            daemon=True
+        )
+        worker.start()
+        return worker
+
+    def start(self):
+        self._workers = [self._spawn() for _ in range(self._workers_count)]
+        while not self._stopped.wait(0.5):
+            for i, worker in enumerate(self._workers):
+                if not worker.is_alive() and not self._stopped.is_set():
+                    logger.warning('Worker %d exited with %s, restarting', worker.pid, worker.exitcode)
+                    self._workers[i] = self._spawn()
+
+    @property
+    def workers(self) -> List[int]:
+        return [worker.pid for worker in self._workers]
+
+    def close(self):
+        self._stop = True
+        self._stopped.set()
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self._workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+        if self._server:
+            self._server.close()
+
+
 def main():
-    server = Server(port=8080)
+    parser = argparse.ArgumentParser(prog='server.py', description='PING/PONG tcp server')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-m', '--mode', choices=['threaded', 'selector', 'prefork'], default='threaded')
+    parser.add_argument('-b', '--backlog', type=int, default=0)
+    parser.add_argument('-f', '--framing', choices=FRAMERS, default='line')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='Prefork workers. Default cpu count.')
+    parser.add_argument('-i', '--idle-timeout', type=float, default=Limits.idle_timeout, help='Seconds')
+    parser.add_argument('--max-connections', type=int, default=0, help='0 for unlimited')
+    parser.add_argument('--max-per-ip', type=int, default=0, help='0 for unlimited')
+    parser.add_argument('--stats-interval', type=float, default=0, help='Dump metrics as JSON every N seconds')
+    parser.add_argument('--stats-file', help='Append metrics dumps to file instead of stderr')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    if args.mode == 'prefork' and not PreforkServer.supported():
+        parser.error('prefork mode needs os.fork, which this platform does not have')
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(process)d %(levelname)s %(message)s')
+    limits = Limits(idle_timeout=args.idle_timeout, max_connections=args.max_connections, max_per_ip=args.max_per_ip)
+    if args.mode == 'prefork':
+        server = PreforkServer(port=args.port, count=args.backlog, framer=FRAMERS[args.framing], limits=limits,
+                               workers=args.workers)
+    else:
+        server = (SelectorServer if args.mode == 'selector' else Server)(
+            port=args.port, count=args.backlog, framer=FRAMERS[args.framing], limits=limits
+        )
+    if args.stats_interval:
+        server.dump_metrics(args.stats_interval, args.stats_file)
     try:
         server.create_server()
-        print(f'Server run on {server.host}:{server.port}')
+        logger.info('Server run on %s:%s', server.host, server.port)
         server.start()
     except KeyboardInterrupt:
         pass
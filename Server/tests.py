@@ -0,0 +1,312 @@
+import json
+import os
+import signal
+import socket
+import statistics
+import time
+import unittest
+from threading import Thread
+from unittest import TestCase, mock
+
+from clients import Client, LoadConfig, parse_mix, raise_fd_limit, run_in_process
+from metrics import Histogram
+from protocol import Dispatcher, FrameException, LengthPrefixFramer, LineFramer
+from server import Connection, Limits, Server, SelectorConnection, SelectorServer, PreforkServer
+from timer_wheel import TimerWheel
+
+
+class FramerTests(TestCase):
+    def test_line_split_and_coalesced(self):
+        framer = LineFramer()
+        self.assertEqual([], framer.feed(b'PI'))
+        self.assertEqual([b'PING', b'PING'], framer.feed(b'NG\r\nPING\nPI'))
+        self.assertEqual([b'PING'], framer.feed(b'NG\n'))
+        self.assertEqual(0, framer.buffered)
+
+    def test_line_too_long(self):
+        with self.assertRaises(FrameException):
+            LineFramer(max_size=8).feed(b'x' * 9)
+
+    def test_length_prefix(self):
+        framer = LengthPrefixFramer()
+        data = framer.encode(b'PING') + framer.encode(b'') + framer.encode(b'PONG\n')
+        self.assertEqual([b'PING', b''], framer.feed(data[:12]))
+        self.assertEqual([b'PONG\n'], framer.feed(data[12:]))
+
+
+class DispatcherTests(TestCase):
+    def test_pre_encoded_and_handlers(self):
+        dispatcher = Dispatcher.from_template({'PING': 'PONG'})
+        dispatcher.register('ECHO', handler=lambda args: args)
+        dispatcher.register('NOOP', handler=lambda args: None)
+        self.assertEqual(
+            [b'PONG\n', b'a b\n', b'PONG\n'],
+            dispatcher.dispatch([b'PING', b'ECHO a b', b'NOOP', b'unknown', b'PING'])
+        )
+
+    def test_register_replaces(self):
+        dispatcher = Dispatcher.from_template({'PING': 'PONG'}, LengthPrefixFramer)
+        dispatcher.register('PING', handler=lambda args: b'pong')
+        self.assertEqual([b'\x00\x00\x00\x04pong'], dispatcher.dispatch([b'PING']))
+        with self.assertRaises(ValueError):
+            dispatcher.register('PING')
+
+
+class TimerWheelTests(TestCase):
+    def test_expire_after_timeout(self):
+        wheel = TimerWheel(timeout=2, tick=1)
+        start = time.monotonic()
+        wheel.touch('a')
+        wheel.touch('b')
+        self.assertEqual([], wheel.expire(start + 1.5))
+        wheel.touch('b')
+        self.assertEqual(['a'], wheel.expire(start + 2.5))
+        self.assertNotIn('a', wheel)
+        self.assertEqual(['b'], wheel.expire(start + 3.5))
+        self.assertEqual(0, len(wheel))
+
+    def test_discard_and_long_gap(self):
+        wheel = TimerWheel(timeout=2, tick=1)
+        start = time.monotonic()
+        wheel.touch('a')
+        wheel.touch('b')
+        wheel.discard('a')
+        self.assertEqual(['b'], wheel.expire(start + 100))
+        wheel.touch('c')
+        self.assertEqual([], wheel.expire(start + 101.5))
+        self.assertEqual(['c'], wheel.expire(start + 102.5))
+
+
+class HistogramTests(TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        histogram.record(0.00005, 90)
+        histogram.record(0.003, 10)
+        snapshot = histogram.snapshot()
+        self.assertEqual(100, snapshot['count'])
+        self.assertLessEqual(0.00005, snapshot['p50'])
+        self.assertLess(snapshot['p50'], 0.0001)
+        self.assertLessEqual(0.003, snapshot['p99'])
+        self.assertEqual(0.003, snapshot['max'])
+
+
+class LatencyTests(TestCase):
+    server_class = Server
+
+    def setUp(self) -> None:
+        self.server = self.server_class(host='127.0.0.1')
+        self.server.create_server()
+        self.thread = Thread(target=self.server.start)
+        self.thread.start()
+        self.client = Client('127.0.0.1', self.server.port, 0)
+        self.client.client.connect(('127.0.0.1', self.server.port))
+
+    def tearDown(self) -> None:
+        self.client.client.close()
+        self.server.close()
+        self.thread.join()
+
+    def test_pipelined_frames(self):
+        self.client.receive()
+        self.client.client.sendall(b'PING\nunknown\nPI')
+        self.assertEqual('PONG', self.client.receive())
+        self.client.client.sendall(b'NG\n')
+        self.assertEqual('PONG', self.client.receive())
+
+    def test_batch_replies(self):
+        self.client.receive()
+        self.server.register_command('ECHO', handler=lambda args: args)
+        self.client.client.sendall(b''.join(b'ECHO %d\n' % i for i in range(2000)))
+        self.assertEqual([str(i) for i in range(2000)], [self.client.receive() for _ in range(2000)])
+
+    def test_stats(self):
+        self.client.receive()
+        self.client.client.sendall(b'PING\nPING\nnope\n')
+        self.client.receive()
+        self.client.receive()
+        self.client.send('STATS')
+        stats = json.loads(self.client.receive())
+        self.assertEqual(1, stats['accepts'])
+        self.assertEqual(1, stats['connections'])
+        self.assertEqual({'PING': 2, 'unknown': 1}, stats['commands'])
+        self.assertEqual(len(b'PING\nPING\nnope\n'), stats['bytes_in'])
+        self.assertEqual(len(b'PONG\n') * 2, stats['bytes_out'])
+        self.assertEqual(2, stats['latency']['count'])
+
+    def test_round_trip_latency(self):
+        self.client.receive()
+        samples = []
+        for _ in range(200):
+            start = time.perf_counter()
+            self.client.send('PING')
+            self.assertEqual('PONG', self.client.receive())
+            samples.append(time.perf_counter() - start)
+        self.assertLess(statistics.median(samples), 0.001)
+
+
+class SelectorLatencyTests(LatencyTests):
+    server_class = SelectorServer
+
+
+class LimitsTests(TestCase):
+    server_class = Server
+
+    def _start(self, limits: Limits) -> None:
+        self.server = self.server_class(host='127.0.0.1', limits=limits)
+        self.server.create_server()
+        self.thread = Thread(target=self.server.start)
+        self.thread.start()
+        self.clients = []
+
+    def _connect(self) -> Client:
+        client = Client('127.0.0.1', self.server.port, len(self.clients))
+        client.client.settimeout(2)
+        client.client.connect(('127.0.0.1', self.server.port))
+        self.clients.append(client)
+        return client
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.client.close()
+        self.server.close()
+        self.thread.join()
+
+    def test_idle_connection_reaped(self):
+        self._start(Limits(idle_timeout=0.3, tick=0.1))
+        idle, slow = self._connect(), self._connect()
+        idle.receive()
+        slow.receive()
+        slow.client.sendall(b'PI')
+        time.sleep(0.2)
+        slow.client.sendall(b'N')
+        with self.assertRaises(ConnectionResetError):
+            idle.receive()
+        with self.assertRaises(ConnectionResetError):
+            slow.receive()
+
+    def test_active_connection_kept(self):
+        self._start(Limits(idle_timeout=0.3, tick=0.1))
+        client = self._connect()
+        client.receive()
+        for _ in range(6):
+            time.sleep(0.1)
+            client.send('PING')
+            self.assertEqual('PONG', client.receive())
+
+    def test_max_connections_backpressure(self):
+        self._start(Limits(max_connections=1))
+        first = self._connect()
+        first.receive()
+        second = self._connect()
+        second.client.settimeout(0.3)
+        with self.assertRaises(OSError):
+            second.receive()
+        first.client.close()
+        second.client.settimeout(2)
+        self.assertEqual(Connection.response_template['Hello'], second.receive())
+
+    def test_max_per_ip(self):
+        self._start(Limits(max_per_ip=1))
+        self._connect().receive()
+        with self.assertRaises(OSError):
+            self._connect().receive()
+
+
+class SelectorLimitsTests(LimitsTests):
+    server_class = SelectorServer
+
+    @mock.patch.object(SelectorConnection, 'high_water', 4096)
+    def test_reading_stops_above_high_water(self):
+        self._start(Limits())
+        client = Client('127.0.0.1', self.server.port, 0)
+        self.clients.append(client)
+        # Small kernel buffers on both ends, so the replies back up in the server and not in the kernel.
+        client.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.client.connect(('127.0.0.1', self.server.port))
+        client.receive()
+        connection, = self.server._connections
+        connection.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        count = 200000
+        sender = Thread(target=client.client.sendall, args=(b'PING\n' * count,), daemon=True)
+        sender.start()
+        # The client reads nothing yet, so replies pile up only to the mark plus one read's worth.
+        time.sleep(0.3)
+        self.assertTrue(connection.backlogged)
+        self.assertLess(connection._buffered, 4096 + 65536 // 5 * 5)
+        framer, pongs = LineFramer(), 0
+        while pongs < count:
+            pongs += framer.feed(client.client.recv(65536)).count(b'PONG')
+        sender.join(2)
+        self.assertEqual(count, pongs)
+        self.assertFalse(connection.backlogged)
+
+
+class LoadGeneratorTests(TestCase):
+    def test_parse_mix(self):
+        self.assertEqual({'PING': 9.0, 'STATS': 1.0}, parse_mix('PING=9,STATS=1'))
+        self.assertEqual({'PING': 1.0}, parse_mix('PING'))
+
+    def test_in_process_report(self):
+        report = run_in_process('selector', LoadConfig(connections=20, ramp_up=0.1, pipeline=4, duration=0.3))
+        self.assertEqual(20, report['opened'])
+        self.assertEqual(0, report['errors'])
+        self.assertGreater(report['requests'], 0)
+        self.assertLessEqual(report['latency_ms']['p50'], report['latency_ms']['max'])
+
+    @unittest.skipIf(os.name == 'nt', 'no resource module on Windows')
+    def test_raise_fd_limit(self):
+        import resource
+        for (soft, hard), expected in (((1024, resource.RLIM_INFINITY), (65536, resource.RLIM_INFINITY)),
+                                       ((1024, 4096), (4096, 4096)), ((4096, 4096), None)):
+            with mock.patch('resource.getrlimit', return_value=(soft, hard)), \
+                    mock.patch('resource.setrlimit') as setrlimit:
+                self.assertEqual((expected or (soft,))[0], raise_fd_limit())
+            if expected:
+                setrlimit.assert_called_once_with(resource.RLIMIT_NOFILE, expected)
+            else:
+                setrlimit.assert_not_called()
+
+
+@unittest.skipUnless(PreforkServer.supported(), 'prefork needs os.fork')
+class PreforkTests(TestCase):
+    def setUp(self) -> None:
+        self.server = PreforkServer(host='127.0.0.1', workers=2)
+        self.server.create_server()
+        self.thread = Thread(target=self.server.start)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.thread.join()
+
+    def _ping(self) -> str:
+        client = Client('127.0.0.1', self.server.port, 0)
+        for _ in range(50):
+            try:
+                client.client.connect(('127.0.0.1', self.server.port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        try:
+            client.receive()
+            client.send('PING')
+            return client.receive()
+        finally:
+            client.client.close()
+
+    def test_workers_serve_and_restart(self):
+        self.assertEqual('PONG', self._ping())
+        workers = self.server.workers
+        self.assertEqual(2, len(workers))
+        os.kill(workers[0], signal.SIGKILL)
+        for _ in range(50):
+            if workers[0] not in self.server.workers:
+                break
+            time.sleep(0.1)
+        self.assertNotIn(workers[0], self.server.workers)
+        self.assertEqual(2, len(self.server.workers))
+        self.assertEqual('PONG', self._ping())
+
+
+if __name__ == '__main__':
+    unittest.main()
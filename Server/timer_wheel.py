@@ -0,0 +1,67 @@
+import math
+import time
+from threading import Lock
+from typing import Dict, Hashable, List, Set
+
+
+class TimerWheel:
+    _tick: float
+    _slots: List[Set[Hashable]]
+    _where: Dict[Hashable, int]
+    _cursor: int
+    _last: float
+    _lock: Lock
+
+    def __init__(self, timeout: float, tick: float = 0.5):
+        self._tick = tick
+        self._slots = [set() for _ in range(max(1, math.ceil(timeout / tick)) + 1)]
+        self._where = {}
+        self._cursor = 0
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    @property
+    def tick(self) -> float:
+        return self._tick
+
+    def touch(self, item: Hashable) -> None:
+        slot = (self._cursor - 1) % len(self._slots)
+        with self._lock:
+            old = self._where.get(item)
+            if old == slot:
+                return
+            if old is not None:
+                self._slots[old].discard(item)
+            self._slots[slot].add(item)
+            self._where[item] = slot
+
+    def discard(self, item: Hashable) -> None:
+        with self._lock:
+            slot = self._where.pop(item, None)
+            if slot is not None:
+                self._slots[slot].discard(item)
+
+    def expire(self, now: float = None) -> List[Hashable]:
+        now = time.monotonic() if now is None else now
+        ticks = int((now - self._last) / self._tick)
+        if ticks <= 0:
+            return []
+        self._last += ticks * self._tick
+        expired: List[Hashable] = []
+        with self._lock:
+            for _ in range(min(ticks, len(self._slots))):
+                self._cursor = (self._cursor + 1) % len(self._slots)
+                slot = self._slots[self._cursor]
+                for item in slot:
+                    del self._where[item]
+                expired.extend(slot)
+                slot.clear()
+            if ticks > len(self._slots):
+                self._cursor = (self._cursor + ticks - len(self._slots)) % len(self._slots)
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self._where
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+from cache import AttachmentCache
+from fake_server import FakeSMTPServer, self_signed, server_context
+from sender import SMTPSender
+from tls import TLSSessionCache
+
+
+def make_images(directory: str, count: int, size: int) -> None:
+    for i in range(count):
+        with open(os.path.join(directory, f'image{i:04}.jpg'), 'wb') as file:
+            file.write(os.urandom(size))
+
+
+def timed_build(directory: str, cache: Optional[AttachmentCache]) -> float:
+    sender = SMTPSender('', 'from@local', 'to@local', 0, directory, 'Bench')
+    sender.cache = cache
+    start = time.perf_counter()
+    for _ in sender.create_message().chunks():
+        pass
+    return round(time.perf_counter() - start, 3)
+
+
+def timed_send(server: FakeSMTPServer, directory: str, cache: Optional[AttachmentCache]) -> Dict[str, float]:
+    sender = SMTPSender('127.0.0.1', 'from@local', 'to@local', server.port, directory, 'Bench')
+    sender.cache, sender.chunk_size = cache, 0
+    start = time.perf_counter()
+    sender.send_message(False, False, False)
+    elapsed = time.perf_counter() - start
+    size = len(server.messages.pop().data)
+    return {'seconds': round(elapsed, 3), 'mb_per_second': round(size / elapsed / 1024 / 1024, 1)}
+
+
+def bench_cache(args) -> Dict[str, object]:
+    images, store = tempfile.mkdtemp(), tempfile.mkdtemp()
+    server = FakeSMTPServer().start()
+    try:
+        make_images(images, args.images, args.size)
+        limit = args.cache_size * 1024 * 1024
+        cache = AttachmentCache(limit, store, processes=args.processes)
+        results = {
+            # Building the message means reading and encoding every attachment.
+            'build': {
+                'uncached': timed_build(images, None),
+                'cold': timed_build(images, cache),
+                'warm_memory': timed_build(images, cache),
+                # A fresh process only has the on-disk store.
+                'warm_disk': timed_build(images, AttachmentCache(limit, store)),
+            },
+            'send': {
+                'uncached': timed_send(server, images, None),
+                'warm_memory': timed_send(server, images, cache),
+            },
+        }
+        results['cache'] = {'hits': cache.hits, 'misses': cache.misses, 'entries': len(cache), 'bytes': cache.size}
+        return results
+    finally:
+        server.close()
+        shutil.rmtree(images)
+        shutil.rmtree(store)
+
+
+def timed_connections(port: int, directory: str, count: int,
+                      tls: Callable[[], TLSSessionCache]) -> Dict[str, float]:
+    times, resumed = [], 0
+    for _ in range(count):
+        sender = SMTPSender('127.0.0.1', 'from@local', 'to@local', port, directory, 'Bench')
+        sender.tls = tls()
+        start = time.perf_counter()
+        sender.connect(tls=True)
+        times.append(time.perf_counter() - start)
+        resumed += bool(sender.tls_resumed)
+        sender.quit()
+    return {'mean_ms': round(sum(times) / count * 1000, 2), 'resumed': resumed, 'connections': count}
+
+
+def bench_tls(args) -> Dict[str, object]:
+    directory = tempfile.mkdtemp()
+    try:
+        cert, key = self_signed(directory)
+        server = FakeSMTPServer(tls=server_context(cert, key)).start()
+        shared = TLSSessionCache(cafile=cert)
+        try:
+            return {
+                # What ssl.wrap_socket used to cost: a new context and a full handshake every time.
+                'new_context': timed_connections(server.port, directory, args.connections,
+                                                 lambda: TLSSessionCache(cafile=cert)),
+                'shared_context': timed_connections(server.port, directory, args.connections,
+                                                    lambda: TLSSessionCache(shared.context)),
+                'resumed': timed_connections(server.port, directory, args.connections, lambda: shared),
+            }
+        finally:
+            server.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHES = {'cache': bench_cache, 'tls': bench_tls}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Smtp-mime benchmarks')
+    parser.add_argument('-b', '--bench', choices=[*BENCHES, 'all'], default='all')
+    parser.add_argument('-n', '--images', type=int, default=500)
+    parser.add_argument('-s', '--size', type=int, default=64 * 1024, help='Bytes per image')
+    parser.add_argument('--cache-size', type=int, default=256, help='Memory cache in MiB')
+    parser.add_argument('--processes', action='store_true', help='Encode misses in a process pool')
+    parser.add_argument('-c', '--connections', type=int, default=50, help='STARTTLS connections per variant')
+    args = parser.parse_args()
+    benches = BENCHES if args.bench == 'all' else {args.bench: BENCHES[args.bench]}
+    print(json.dumps({name: bench(args) for name, bench in benches.items()}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import csv
+import json
+import re
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional
+
+from ratelimit import TokenBucket
+
+
+@dataclass
+class DeliveryException(Exception):
+    message: str
+    temporary: bool = True
+
+
+@dataclass
+class Task:
+    id: int
+    email: str
+    row: Dict[str, str]
+    attempts: int
+
+    @property
+    def domain(self) -> str:
+        return self.email.rpartition('@')[2].lower()
+
+
+def read_recipients(path: str) -> Iterator[Dict[str, str]]:
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    row = json.loads(line)
+                    yield {key: str(value) for key, value in row.items()}
+            return
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return
+        if not any('@' in cell for cell in header):
+            for values in reader:
+                yield dict(zip(header, values))
+            return
+        # No header row: the first column is the address.
+        for values in [header, *reader]:
+            yield {'email': values[0], **{f'field{i}': value for i, value in enumerate(values[1:], 1)}}
+
+
+def reply_code(message: str) -> Optional[int]:
+    match = re.search(r'(?:^|\s)([245]\d\d)(?=[\s-]|$)', message)
+    return int(match.group(1)) if match else None
+
+
+class RetryQueue:
+    _db: sqlite3.Connection
+    _lock: Lock
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS deliveries ('
+                "id INTEGER PRIMARY KEY, email TEXT UNIQUE, row TEXT, state TEXT DEFAULT 'pending', "
+                'attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0, error TEXT)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS due ON deliveries (state, next_attempt)')
+            # Deliveries that were in flight when a previous run died are attempted again.
+            self._db.execute("UPDATE deliveries SET state = 'pending' WHERE state = 'active'")
+
+    def add(self, rows: Iterable[Dict[str, str]]) -> int:
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT OR IGNORE INTO deliveries (email, row) VALUES (?, ?)',
+                ((row['email'], json.dumps(row)) for row in rows if row.get('email'))
+            )
+            self._db.execute('COMMIT')
+            return self._db.total_changes - before
+
+    def claim(self, limit: int, now: float = None, skip_domains: Iterable[str] = ()) -> List[Task]:
+        now = time.time() if now is None else now
+        skip_domains = list(skip_domains)
+        # The domain is what follows the last "@", like Task.domain.
+        skipped = (f"AND lower(substr(email, length(rtrim(email, replace(email, '@', ''))) + 1)) "
+                   f"NOT IN ({', '.join('?' * len(skip_domains))}) " if skip_domains else '')
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, email, row, attempts FROM deliveries WHERE state = 'pending' AND next_attempt <= ? "
+                f'{skipped}ORDER BY next_attempt LIMIT ?', (now, *skip_domains, limit)
+            ).fetchall()
+            self._db.executemany("UPDATE deliveries SET state = 'active' WHERE id = ?", ((row[0],) for row in rows))
+        return [Task(id, email, json.loads(row), attempts) for id, email, row, attempts in rows]
+
+    def _finish(self, task: Task, state: str, error: str = None, next_attempt: float = 0) -> None:
+        with self._lock:
+            self._db.execute(
+                'UPDATE deliveries SET state = ?, attempts = ?, error = ?, next_attempt = ? WHERE id = ?',
+                (state, task.attempts + 1, error, next_attempt, task.id)
+            )
+
+    def done(self, task: Task) -> None:
+        self._finish(task, 'sent')
+
+    def retry(self, task: Task, error: str, delay: float) -> None:
+        self._finish(task, 'pending', error, time.time() + delay)
+
+    def fail(self, task: Task, error: str) -> None:
+        self._finish(task, 'failed', error)
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            return self._db.execute("SELECT MIN(next_attempt) FROM deliveries WHERE state = 'pending'").fetchone()[0]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._db.execute('SELECT state, COUNT(*) FROM deliveries GROUP BY state').fetchall())
+
+    def close(self) -> None:
+        self._db.close()
+
+
+@dataclass
+class BulkStats:
+    started: float = field(default_factory=time.monotonic)
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+
+    def report(self, queue: RetryQueue) -> Dict[str, object]:
+        elapsed = time.monotonic() - self.started
+        return {
+            'elapsed': round(elapsed, 3),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'per_second': round(self.sent / elapsed, 2) if elapsed else 0.0,
+            'queue': queue.counts(),
+        }
+
+
+class BulkMailer:
+    _queue: RetryQueue
+    _deliver: Callable[[Dict[str, str]], None]
+    _workers: int
+    _per_domain: int
+    _bucket: TokenBucket
+    _max_attempts: int
+    _backoff: float
+    _max_backoff: float
+    _progress: Optional[Callable[[Dict[str, object]], None]]
+    _progress_interval: float
+    stats: BulkStats
+
+    def __init__(self, queue: RetryQueue, deliver: Callable[[Dict[str, str]], None], workers: int = 8,
+                 per_domain: int = 4, rate: float = 0, max_attempts: int = 5, backoff: float = 60,
+                 max_backoff: float = 3600, progress: Callable[[Dict[str, object]], None] = None,
+                 progress_interval: float = 5):
+        self._queue, self._deliver = queue, deliver
+        self._workers, self._per_domain = workers, per_domain
+        self._bucket = TokenBucket(rate)
+        self._max_attempts = max_attempts
+        self._backoff, self._max_backoff = backoff, max_backoff
+        self._progress, self._progress_interval = progress, progress_interval
+        self.stats = BulkStats()
+
+    def _attempt(self, task: Task) -> None:
+        self._bucket.acquire()
+        self._deliver(task.row)
+
+    def _settle(self, task: Task, future: Future) -> None:
+        exc = future.exception()
+        if exc is None:
+            self._queue.done(task)
+            self.stats.sent += 1
+            return
+        message = getattr(exc, 'message', None) or str(exc) or type(exc).__name__
+        code = reply_code(message)
+        temporary = exc.temporary if isinstance(exc, DeliveryException) else code is None or 400 <= code < 500
+        if temporary and task.attempts + 1 < self._max_attempts:
+            self._queue.retry(task, message, min(self._max_backoff, self._backoff * 2 ** task.attempts))
+            self.stats.retried += 1
+        else:
+            self._queue.fail(task, message)
+            self.stats.failed += 1
+
+    def _dispatch(self, pool: ThreadPoolExecutor, waiting: Deque[Task], running: Dict[Future, Task],
+                  in_flight: Dict[str, int]) -> None:
+        # Tasks of a domain at its cap are kept aside, in order, while the ones behind them go ahead.
+        skipped: Deque[Task] = deque()
+        while waiting and len(running) < self._workers:
+            task = waiting.popleft()
+            if in_flight.get(task.domain, 0) >= self._per_domain:
+                skipped.append(task)
+                continue
+            in_flight[task.domain] = in_flight.get(task.domain, 0) + 1
+            running[pool.submit(self._attempt, task)] = task
+        waiting.extendleft(reversed(skipped))
+
+    def run(self) -> Dict[str, object]:
+        self.stats = BulkStats()
+        waiting: Deque[Task] = deque()
+        running: Dict[Future, Task] = {}
+        in_flight: Dict[str, int] = {}
+        reported = time.monotonic()
+        with ThreadPoolExecutor(self._workers) as pool:
+            while True:
+                self._dispatch(pool, waiting, running, in_flight)
+                if len(running) < self._workers:
+                    # Whatever still waits is capped: claim rows of the other domains rather than more of those.
+                    capped = [domain for domain, count in in_flight.items() if count >= self._per_domain]
+                    waiting.extend(self._queue.claim(self._workers * 4, skip_domains=capped))
+                    self._dispatch(pool, waiting, running, in_flight)
+                if not running and not waiting:
+                    next_due = self._queue.next_due()
+                    if next_due is None:
+                        break
+                    time.sleep(min(max(0.0, next_due - time.time()), self._progress_interval))
+                else:
+                    done, _ = wait(running, timeout=self._progress_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = running.pop(future)
+                        in_flight[task.domain] -= 1
+                        self._settle(task, future)
+                if self._progress and time.monotonic() - reported >= self._progress_interval:
+                    reported = time.monotonic()
+                    self._progress(self.stats.report(self._queue))
+        return self.stats.report(self._queue)
+
+
+def print_progress(report: Dict[str, object]) -> None:
+    print(json.dumps(report), file=sys.stderr, flush=True)
@@ -0,0 +1,188 @@
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Event, Lock
+from typing import Dict, Iterable, List, Optional
+
+from message import LINE_LENGTH, encode_base64
+
+
+def _encode_file(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        return encode_base64(file.read())
+
+
+def encoded_size(size: int) -> int:
+    # Length of encode_base64 output for size bytes: 76 column lines, no newline after the last one.
+    characters = (size + 2) // 3 * 4
+    return characters + max(0, (characters + LINE_LENGTH - 1) // LINE_LENGTH - 1)
+
+
+class AttachmentCache:
+    _max_bytes: int
+    _directory: Optional[str]
+    _workers: Optional[int]
+    _processes: bool
+    _entries: 'OrderedDict[str, bytes]'
+    _size: int
+    _lock: Lock
+    _encoding: Dict[str, Event]
+    hits: int
+    misses: int
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, directory: str = None, workers: int = None,
+                 processes: bool = False):
+        self._max_bytes = max_bytes
+        self._directory = directory
+        self._workers = workers
+        self._processes = processes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._encoding = {}
+        self.hits = self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(path: str) -> str:
+        # A rewritten file changes size or mtime, so stale entries are never looked up again.
+        stat = os.stat(path)
+        return hashlib.sha1(f'{os.path.realpath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}'.encode()).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._directory, f'{key}.b64')
+
+    def _remember(self, key: str, encoded: bytes) -> None:
+        if len(encoded) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = encoded
+            self._size += len(encoded)
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                return encoded
+        if not self._directory:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as file:
+                encoded = file.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, encoded)
+        return encoded
+
+    def _contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self._directory) and os.path.exists(self._disk_path(key))
+
+    def put(self, path: str, encoded: bytes, key: str = None, memory: bool = True) -> None:
+        key = key or self.key(path)
+        if memory:
+            self._remember(key, encoded)
+        if self._directory:
+            target = self._disk_path(key)
+            temporary = f'{target}.{os.getpid()}.tmp'
+            with open(temporary, 'wb') as file:
+                file.write(encoded)
+            os.replace(temporary, target)
+
+    def get(self, path: str) -> Optional[bytes]:
+        encoded = self._lookup(self.key(path))
+        if encoded is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return encoded
+
+    def _claim(self, key: str) -> Optional[Event]:
+        # None when the caller is now the one encoding key, else the event of whoever already is.
+        with self._lock:
+            event = self._encoding.get(key)
+            if event is None:
+                self._encoding[key] = Event()
+            return event
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            self._encoding.pop(key).set()
+
+    def encoded(self, path: str) -> Optional[bytes]:
+        # Threads sending the same file at once wait for one encoding of it. None for a file that can never fit:
+        # the caller streams it instead.
+        if encoded_size(os.stat(path).st_size) > self._max_bytes:
+            self.misses += 1
+            return None
+        key = self.key(path)
+        while True:
+            encoded = self._lookup(key)
+            if encoded is not None:
+                self.hits += 1
+                return encoded
+            event = self._claim(key)
+            if event is None:
+                break
+            event.wait()
+        try:
+            encoded = self._lookup(key)
+            if encoded is None:
+                self.misses += 1
+                encoded = _encode_file(path)
+                self.put(path, encoded, key)
+            else:
+                self.hits += 1
+        finally:
+            self._release(key)
+        return encoded
+
+    def _executor(self, jobs: int) -> Executor:
+        workers = min(jobs, self._workers or os.cpu_count() or 1)
+        return ProcessPoolExecutor(workers) if self._processes else ThreadPoolExecutor(workers)
+
+    def warm(self, paths: Iterable[str]) -> List[str]:
+        # Only as much as the memory bound holds: anything evicted before the send is encoded a second time.
+        # Past the bound files are still encoded once for the disk store, which the send then reads.
+        missing = []
+        total = 0
+        for path in paths:
+            key = self.key(path)
+            size = encoded_size(os.stat(path).st_size)
+            memory = size <= self._max_bytes - total
+            if memory:
+                total += size
+            elif not self._directory:
+                continue
+            # A file another thread is encoding right now is left to it.
+            if not self._contains(key) and self._claim(key) is None:
+                missing.append((path, key, memory))
+        if not missing:
+            return []
+        try:
+            with self._executor(len(missing)) as pool:
+                paths = [path for path, _, _ in missing]
+                for (path, key, memory), encoded in zip(missing, pool.map(_encode_file, paths)):
+                    self.put(path, encoded, key, memory)
+        finally:
+            for _, key, _ in missing:
+                self._release(key)
+        return [path for path, _, _ in missing]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
@@ -0,0 +1,213 @@
+import os
+import socket
+import ssl
+import subprocess
+from dataclasses import dataclass, field
+from threading import Thread
+from typing import List, Optional, Sequence, Set, Tuple
+
+
+def self_signed(directory: str) -> Tuple[str, str]:
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost', '-keyout', key, '-out', cert],
+        check=True, capture_output=True
+    )
+    return cert, key
+
+
+def server_context(cert: str, key: str) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+@dataclass
+class ReceivedMessage:
+    mail_from: str
+    params: List[str] = field(default_factory=list)
+    rcpt_to: List[str] = field(default_factory=list)
+    data: bytes = b''
+
+
+class FakeSMTPServer:
+    _server: socket.socket = None
+    _thread: Thread = None
+    _stop: bool = False
+    capabilities: Sequence[str]
+    reject: Set[str]
+    defer: Set[str]
+    messages: List[ReceivedMessage]
+    commands: List[bytes]
+    connections: int
+    close_after: int
+    empty_data: bool
+    tls: Optional[ssl.SSLContext]
+    implicit_tls: bool
+    resumed: int
+
+    def __init__(self, capabilities: Sequence[str] = ('8BITMIME', 'AUTH LOGIN'), reject: Sequence[str] = (),
+                 host: str = '127.0.0.1', port: int = 0, close_after: int = 0, tls: ssl.SSLContext = None,
+                 empty_data: bool = False, defer: Sequence[str] = (), implicit_tls: bool = False):
+        self.capabilities = capabilities
+        self.reject = set(reject)
+        self.defer = set(defer)
+        self.close_after = close_after
+        # Some pipelining servers open DATA without recipients and refuse only after the dot.
+        self.empty_data = empty_data
+        self.tls = tls
+        # TLS from the first byte (port 465) instead of STARTTLS.
+        self.implicit_tls = implicit_tls
+        self.messages, self.commands = [], []
+        self.connections = self.resumed = 0
+        self._server = socket.create_server((host, port))
+
+    @property
+    def port(self) -> int:
+        return self._server.getsockname()[1]
+
+    def start(self) -> 'FakeSMTPServer':
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def _serve(self) -> None:
+        try:
+            while not self._stop:
+                conn, _ = self._server.accept()
+                self.connections += 1
+                Thread(target=self._handle, args=(conn,), daemon=True).start()
+        except OSError:
+            pass
+
+    def _handle(self, conn: socket.socket) -> None:
+        try:
+            if self.tls and self.implicit_tls:
+                conn = self.tls.wrap_socket(conn, server_side=True)
+            self._session(conn)
+        except OSError:
+            pass
+
+    def _session(self, conn: socket.socket) -> None:
+        file = conn.makefile('rb')
+        try:
+            pipelining = 'PIPELINING' in self.capabilities
+            deferred: List[bytes] = []
+
+            def reply(*lines: str) -> None:
+                data = ''.join(
+                    f'{line[:3]}{"-" if i < len(lines) - 1 else " "}{line[4:]}\r\n' for i, line in enumerate(lines)
+                ).encode()
+                # With PIPELINING the envelope replies are held back until DATA, like a server that batches
+                # its replies; a lock-step client would wait for them forever. A BODY=BINARYMIME envelope
+                # is flushed right away since there is no DATA to wait for before the BDAT chunks.
+                if pipelining and verb in (b'MAIL', b'RCPT') and not (message and message.params):
+                    deferred.append(data)
+                    return
+                conn.sendall(b''.join(deferred) + data)
+                deferred.clear()
+
+            verb = b''
+            reply('220 fake.local ESMTP ready')
+            message: ReceivedMessage = None
+            received = 0
+            while True:
+                line = file.readline()
+                if not line:
+                    return
+                command = line.rstrip(b'\r\n')
+                self.commands.append(command)
+                verb = command.split(b' ', 1)[0].upper()
+                if verb in (b'EHLO', b'HELO'):
+                    starttls = ['STARTTLS'] if self.tls and not isinstance(conn, ssl.SSLSocket) else []
+                    reply('250 fake.local greets you',
+                          *(f'250 {capability}' for capability in [*self.capabilities, *starttls]))
+                elif verb == b'STARTTLS' and self.tls and not isinstance(conn, ssl.SSLSocket):
+                    reply('220 Ready to start TLS')
+                    file.close()
+                    conn = self.tls.wrap_socket(conn, server_side=True)
+                    file = conn.makefile('rb')
+                    self.resumed += conn.session_reused
+                elif verb == b'AUTH':
+                    reply('334 VXNlcm5hbWU6')
+                    file.readline()
+                    reply('334 UGFzc3dvcmQ6')
+                    file.readline()
+                    reply('235 Authentication succeeded')
+                elif verb == b'MAIL':
+                    mail_from, *params = command.split(b':', 1)[1].decode().split()
+                    message = ReceivedMessage(mail_from, params)
+                    reply('250 OK')
+                elif verb == b'RCPT':
+                    recipient = command.split(b':', 1)[1].strip().decode()
+                    if message is None:
+                        reply('503 Need MAIL first')
+                    elif recipient.strip('<>') in self.reject:
+                        reply('550 No such user')
+                    elif recipient.strip('<>') in self.defer:
+                        reply('451 Try again later')
+                    else:
+                        message.rcpt_to.append(recipient)
+                        reply('250 OK')
+                elif verb == b'DATA':
+                    if message is None or not message.rcpt_to and not self.empty_data:
+                        reply('554 No valid recipients')
+                        continue
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = []
+                    for data_line in file:
+                        if data_line.rstrip(b'\r\n') == b'.':
+                            break
+                        data.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                    if not message.rcpt_to:
+                        message = None
+                        reply('554 No valid recipients')
+                        continue
+                    message.data = b''.join(data)
+                    self.messages.append(message)
+                    message = None
+                    reply('250 OK queued')
+                    received += 1
+                    if received == self.close_after:
+                        return
+                elif verb == b'BDAT' and 'CHUNKING' in self.capabilities:
+                    _, size, *last = command.split()
+                    # The chunk is always consumed, even when it is refused.
+                    chunk = file.read(int(size))
+                    if message is None or not message.rcpt_to:
+                        reply('554 No valid recipients')
+                        continue
+                    message.data += chunk
+                    if not last:
+                        reply(f'250 {size.decode()} octets received')
+                        continue
+                    self.messages.append(message)
+                    message = None
+                    reply('250 OK queued')
+                    received += 1
+                    if received == self.close_after:
+                        return
+                elif verb == b'RSET':
+                    message = None
+                    reply('250 OK')
+                elif verb == b'NOOP':
+                    reply('250 OK')
+                elif verb == b'QUIT':
+                    reply('221 Bye')
+                    return
+                else:
+                    reply('502 Command not implemented')
+        finally:
+            file.close()
+            conn.close()
+
+    def close(self) -> None:
+        self._stop = True
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        if self._thread:
+            self._thread.join()
@@ -1,4 +1,16 @@
-from typing import Dict, List
+import base64
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    from cache import AttachmentCache
+
+LINE_LENGTH = 76
+# 57 input bytes encode to exactly one 76 column base64 line.
+LINE_BYTES = LINE_LENGTH // 4 * 3
+
+
+def encode_base64(data: bytes) -> bytes:
+    return base64.encodebytes(data).rstrip(b'\n')
 
 
 class ContentMessage:
@@ -9,13 +21,60 @@ class ContentMessage:
         self._headers = headers
         self._body = body
 
-    def __bytes__(self):
-        return b'\n'.join([
-            *(f'{key}: {value};'.encode() for key, value in self._headers.items()),
-            b'',
-            self._body
+    def _head(self, headers: Dict[str, str] = None, newline: bytes = b'\n') -> bytes:
+        return newline.join([
+            *(f'{key}: {value};'.encode() for key, value in (headers or self._headers).items()),
+            b'', b''
         ])
 
+    def chunks(self, binary: bool = False) -> Iterator[bytes]:
+        yield self._head(newline=b'\r\n' if binary else b'\n')
+        yield self._body
+
+    def __bytes__(self):
+        return b''.join(self.chunks())
+
+
+class FileContentMessage(ContentMessage):
+    _path: str
+    _block_size: int
+    _cache: Optional['AttachmentCache']
+
+    def __init__(self, headers: Dict[str, str], path: str, block_lines: int = 1024,
+                 cache: 'AttachmentCache' = None):
+        super().__init__(headers, b'')
+        self._path = path
+        self._block_size = LINE_BYTES * block_lines
+        self._cache = cache
+
+    def _binary_head(self) -> bytes:
+        headers = {key: value for key, value in self._headers.items() if key.lower() != 'content-transfer-encoding'}
+        headers['Content-transfer-encoding'] = 'binary'
+        # BDAT content goes out unchanged, so the lines the server reads must already end in CR LF.
+        return self._head(headers, b'\r\n')
+
+    def chunks(self, binary: bool = False) -> Iterator[bytes]:
+        if binary:
+            # RFC 3030 BINARYMIME: the file goes out as is, without the base64 third.
+            yield self._binary_head()
+            with open(self._path, 'rb') as file:
+                yield from iter(lambda: file.read(self._block_size), b'')
+            return
+        yield self._head()
+        # Encoded here and not when the message is built: a BDAT send never needs the base64.
+        encoded = self._cache.encoded(self._path) if self._cache is not None else None
+        if encoded is not None:
+            yield encoded
+            return
+        with open(self._path, 'rb') as file:
+            encoded = b''
+            block = file.read(self._block_size)
+            while block:
+                yield encoded
+                encoded = base64.encodebytes(block)
+                block = file.read(self._block_size)
+            yield encoded.rstrip(b'\n')
+
 
 class Message:
     _headers: Dict[str, str]
@@ -27,14 +86,18 @@ class Message:
         self._body = body
         self._boundary = boundary
 
-    def __bytes__(self):
-        head = '\n'.join([
+    def chunks(self, binary: bool = False) -> Iterator[bytes]:
+        newline = '\r\n' if binary else '\n'
+        yield newline.join([
             *(f'{key}: {value}' for key, value in self._headers.items()),
             '', ''
-        ])
-        body = f'--{self._boundary}\n'.encode().join([
-            b'',
-            *(content.__bytes__() + b'\n' for content in self._body)
-        ]) + f'\n--{self._boundary}--\n'.encode()
-        return head.encode() + body
+        ]).encode()
+        separator = f'--{self._boundary}{newline}'.encode()
+        for content in self._body:
+            yield separator
+            yield from content.chunks(binary)
+            yield newline.encode()
+        yield f'{newline}--{self._boundary}--{newline}'.encode()
 
+    def __bytes__(self):
+        return b''.join(self.chunks())
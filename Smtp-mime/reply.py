@@ -0,0 +1,92 @@
+import socket
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+
+@dataclass
+class ReplyException(Exception):
+    message: str
+
+
+@dataclass
+class Reply:
+    code: int
+    lines: List[str] = field(default_factory=list)
+    raw: bytes = b''
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.lines)
+
+    @property
+    def capabilities(self) -> Dict[str, str]:
+        # The first EHLO line is the greeting, every following line is "KEYWORD [params]".
+        result: Dict[str, str] = {}
+        for line in self.lines[1:]:
+            keyword, _, params = line.partition(' ')
+            result[keyword.upper()] = params
+        return result
+
+    def __str__(self):
+        return self.raw.decode(errors='replace').strip('\r\n')
+
+
+class ReplyParser:
+    _buffer: bytearray
+    _lines: List[str]
+    _start: int
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._lines = []
+        self._start = 0
+
+    def feed(self, data: bytes) -> List[Reply]:
+        self._buffer += data
+        replies: List[Reply] = []
+        end = self._buffer.find(b'\n', self._start)
+        while end != -1:
+            line = bytes(self._buffer[self._start:end]).rstrip(b'\r')
+            self._start = end + 1
+            if len(line) < 3 or not line[:3].isdigit() or line[3:4] not in (b'', b' ', b'-'):
+                raise ReplyException(f'Malformed reply line: {line!r}')
+            self._lines.append(line[4:].decode(errors='replace'))
+            if line[3:4] != b'-':
+                replies.append(Reply(int(line[:3]), self._lines, bytes(self._buffer[:self._start])))
+                del self._buffer[:self._start]
+                self._lines, self._start = [], 0
+            end = self._buffer.find(b'\n', self._start)
+        return replies
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._buffer)
+
+
+class ReplyReader:
+    _sock: socket.socket
+    _parser: ReplyParser
+    _replies: List[Reply]
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._parser = ReplyParser()
+        self._replies = []
+
+    def read(self) -> Reply:
+        while not self._replies:
+            try:
+                data = self._sock.recv(4096)
+            except socket.timeout:
+                raise ReplyException('Timed out waiting for server reply')
+            if not data:
+                raise ReplyException('Connection closed by server')
+            self._replies.extend(self._parser.feed(data))
+        return self._replies.pop(0)
+
+    def read_many(self, count: int) -> List[Reply]:
+        return [self.read() for _ in range(count)]
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._replies) or self._parser.pending
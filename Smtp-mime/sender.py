@@ -1,12 +1,19 @@
 import argparse
+import getpass
+import json
 import os
 import socket
 import ssl
+import time
 from dataclasses import dataclass
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict, Iterable
 import base64
 
-from message import ContentMessage, Message
+from cache import AttachmentCache
+from message import ContentMessage, FileContentMessage, Message
+from reply import Reply, ReplyException, ReplyReader
+from tls import TLSSessionCache
+from tracing import Profile, TraceCallback, elapsed_ms, json_lines, tee
 
 
 @dataclass
@@ -23,101 +30,347 @@ class SMTPSender:
     _directory: str
     _boundary: str = 'part'
     _subject: str
+    _password: Optional[str]
+    _reader: ReplyReader = None
+    _capabilities: Dict[str, str] = None
+    timeout: float = 30
+    write_buffer: int = 64 * 1024
+    chunk_size: int = 1024 * 1024
+    cache: Optional[AttachmentCache] = None
+    tls: TLSSessionCache = TLSSessionCache()
+    tls_resumed: Optional[bool] = None
+    trace: Optional[TraceCallback] = None
 
-    def __init__(self, host: str, mess_from: str, mess_to: str, port: int, directory: str, subject: str):
+    def __init__(self, host: str, mess_from: str, mess_to: str, port: int, directory: str, subject: str,
+                 password: str = None):
         self._host, self._port = host, port
+        self._password = password
         self._mess_from, self._mess_to = mess_from, mess_to
         self._directory = directory or os.getcwd()
         self._subject = subject
         self._sock = socket.socket()
+        self._capabilities = {}
 
-    def _accept_message(self) -> Optional[bytes]:
-        buffer = []
+    def _accept_message(self) -> Reply:
         try:
-            while 1:
-                message = self._sock.recv(1024)
-                if not message:
-                    break
-                buffer.append(message)
-        except socket.timeout:
-            pass
-        return b''.join(buffer)
+            return self._reader.read()
+        except ReplyException as exc:
+            raise SenderException(exc.message)
+
+    @property
+    def capabilities(self) -> Dict[str, str]:
+        return self._capabilities
 
     def _open_content(self) -> List[ContentMessage]:
         result: List[ContentMessage] = []
-        for name in os.listdir(self._directory):
+        names = os.listdir(self._directory)
+        for name in names:
             ext = name.rsplit('.', maxsplit=1)[1]
-            with open(os.path.join(self._directory, name), 'rb') as file:
-                result.append(ContentMessage(
-                    {'Content-type': f'image/{ext}; name={name}',
-                     'Content-transfer-encoding': 'base64',
-                     'Content-disposition': f'attachment;filename:"{name}"'},
-                    base64.b64encode(file.read()),
-                ))
+            result.append(FileContentMessage(
+                {'Content-type': f'image/{ext}; name={name}',
+                 'Content-transfer-encoding': 'base64',
+                 'Content-disposition': f'attachment;filename:"{name}"'},
+                os.path.join(self._directory, name),
+                cache=self.cache
+            ))
         if not len(result):
             raise SenderException('Dir is empty!')
         return result
 
-    def _create_message(self) -> Message:
+    def create_message(self, mess_to: str = None, subject: str = None) -> Message:
         return Message(
             {
                 'From': f'<{self._mess_from}>',
-                'To': f'<{self._mess_to}>',
-                'Subject': f'{self._subject}',
+                'To': ', '.join(f'<{to}>' for to in (mess_to or self._mess_to).split(',')),
+                'Subject': f'{subject or self._subject}',
                 'Content-type': f'multipart/mixed; boundary={self._boundary}'
             },
             self._open_content(),
             self._boundary
         )
 
+    def _emit(self, phase: str, start: float, **fields) -> None:
+        self.trace({'phase': phase, 'host': self._host, 'ms': elapsed_ms(start), **fields})
+
+    def _write(self, data: bytes) -> float:
+        start = time.perf_counter()
+        self._sock.sendall(data)
+        return time.perf_counter() - start
+
+    def _send_stream(self, chunks: Iterable[bytes]) -> Tuple[int, float]:
+        # Returns the bytes sent and the seconds spent in the socket, the rest is reading and encoding.
+        buffer = bytearray()
+        sent, network = 0, 0.0
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= self.write_buffer:
+                network += self._write(buffer)
+                sent += len(buffer)
+                buffer.clear()
+        if buffer:
+            network += self._write(buffer)
+            sent += len(buffer)
+        return sent, network
+
+    @staticmethod
+    def _verb(command: bytes) -> str:
+        return command.strip().split(b' ', 1)[0].split(b':', 1)[0].upper().decode(errors='replace')
+
     @staticmethod
-    def _ensure_code_correct(accept: bytes, accept_code: bytes) -> None:
-        accept = accept.strip(b'\r\n').split(b'\r\n')[-1]
-        if not accept.startswith(accept_code):
-            raise SenderException(accept.decode())
+    def _ensure_code_correct(accept: Reply, accept_code: bytes) -> None:
+        if accept.code != int(accept_code[:3]):
+            raise SenderException(str(accept))
 
-    def _sender(self, commands: List[Tuple[bytes, bytes]], verbose: bool) -> None:
+    def _sender(self, commands: List[Tuple[bytes, Optional[bytes]]], verbose: bool, label: str = None) -> Reply:
+        answer = None
         for command, code in commands:
+            start = time.perf_counter() if self.trace else 0.0
             self._sock.sendall(command)
             answer = self._accept_message()
-            self._ensure_code_correct(answer, code)
+            if self.trace is not None:
+                # Credentials are traced under their label, never by content.
+                self._emit('command', start, command=label or self._verb(command), code=answer.code)
             if verbose:
                 print('Client:')
                 print(b'\n'.join(command.split(b'\r\n')).decode())
                 print('Server:')
-                print(b'\n'.join(answer.split(b'\r\n')).decode())
+                print(b'\n'.join(answer.raw.split(b'\r\n')).decode())
+            if code is not None:
+                self._ensure_code_correct(answer, code)
+        return answer
 
-    def send_message(self, verbose: bool, auth: bool, tls: bool) -> Optional[str]:
+    def _ehlo(self, verbose: bool) -> None:
+        reply = self._sender([(f'EHLO {self._host}\r\n'.encode(), b'250 ')], verbose)
+        self._capabilities = reply.capabilities
+
+    def _remember_tls(self, verbose: bool) -> None:
+        self.tls_resumed = None
+        if isinstance(self._sock, ssl.SSLSocket):
+            self.tls_resumed = self.tls.remember(self._host, self._sock)
+            if verbose:
+                print(f'TLS {self._sock.version()}: {"session resumed" if self.tls_resumed else "full handshake"}')
+
+    def _handshake(self) -> None:
+        start = time.perf_counter() if self.trace else 0.0
+        self._sock = self.tls.wrap(self._sock, self._host)
+        self._reader = ReplyReader(self._sock)
+        if self.trace is not None:
+            self._emit('tls', start, version=self._sock.version())
+
+    def connect(self, verbose: bool = False, auth: bool = False, tls: bool = False) -> None:
+        started = time.perf_counter() if self.trace else 0.0
         self._sock = socket.socket()
-        self._sock.settimeout(1)
-        if self._port == 465:
-            self._sock, tls = ssl.wrap_socket(self._sock), False
+        self._sock.settimeout(self.timeout)
         try:
             self._sock.connect((self._host, self._port))
+            if self.trace is not None:
+                self._emit('tcp', started)
+            self._reader = ReplyReader(self._sock)
+            if self._port == 465:
+                self._handshake()
+                tls = False
+            start = time.perf_counter() if self.trace else 0.0
             self._ensure_code_correct(self._accept_message(), b'220 ')
+            if self.trace is not None:
+                self._emit('greeting', start)
             if tls:
-                self._sender([(f'EHLO {self._host}\r\n'.encode(), b'250 ')], verbose)   # ESMTP
+                self._ehlo(verbose)   # ESMTP
                 self._sender([(b'STARTTLS\r\n', b'220 ')], verbose)     # ESMTP
-                self._sock = ssl.wrap_socket(self._sock)
-            self._sender([(f'EHLO {self._host}\r\n'.encode(), b'250 ')], verbose)
+                self._handshake()
+            self._ehlo(verbose)
+            self._remember_tls(verbose)
             if auth:
+                if self._password is None:
+                    self._password = input('Password --> ')
                 self._sender([
                     (b'AUTH LOGIN\r\n', b'334 '),
                     (base64.b64encode(self._mess_from.encode()) + b'\r\n', b'334 '),
-                    (base64.b64encode(input('Password --> ').encode()) + b'\r\n', b'235 ')], verbose)
-            self._sender([
-                (f'MAIL FROM: <{self._mess_from}>\r\n'.encode(), b'250 '),
-                (f'rcpt TO: <{self._mess_to}>\r\n'.encode(), b'250 '),
-                (b'DATA\r\n', b'354 ')
-            ], verbose)
-            self._sock.sendall(self._create_message().__bytes__())
-            self._sender([
-                (b'\n.\r\n', b'250 '),
-                (b'QUIT\r\n', b'221 ')
-            ], verbose)
+                    (base64.b64encode(self._password.encode()) + b'\r\n', b'235 ')], verbose, 'AUTH')
+        except BaseException:
+            self.close()
+            raise
+        if self.trace is not None:
+            self._emit('connect', started, port=self._port, tls_resumed=self.tls_resumed)
+
+    @staticmethod
+    def _print_exchange(commands: List[bytes], replies: List[Reply]) -> None:
+        print('Client:')
+        print(b'\n'.join(b''.join(commands).split(b'\r\n')).decode())
+        print('Server:')
+        print(b'\n'.join(b''.join(reply.raw for reply in replies).split(b'\r\n')).decode())
+
+    @property
+    def chunking(self) -> bool:
+        return bool(self.chunk_size) and 'CHUNKING' in self._capabilities and 'BINARYMIME' in self._capabilities
+
+    def _envelope(self, recipients: List[str], verbose: bool,
+                  chunking: bool = False) -> Tuple[Reply, Dict[str, Reply], Optional[Reply]]:
+        mail = f'MAIL FROM: <{self._mess_from}>{" BODY=BINARYMIME" if chunking else ""}\r\n'.encode()
+        rcpts = [f'rcpt TO: <{recipient}>\r\n'.encode() for recipient in recipients]
+        if 'PIPELINING' in self._capabilities:
+            # RFC 2920: MAIL, every RCPT and DATA go out in one write, replies come back in order.
+            commands = [mail, *rcpts] + ([] if chunking else [b'DATA\r\n'])
+            start = time.perf_counter() if self.trace else 0.0
+            self._sock.sendall(b''.join(commands))
+            replies = self._accept_messages(len(commands))
+            if self.trace is not None:
+                self._emit('command', start, command='PIPELINE', commands=len(commands))
+            if verbose:
+                self._print_exchange(commands, replies)
+            data = None if chunking else replies[-1]
+            return replies[0], dict(zip(recipients, replies[1:len(recipients) + 1])), data
+        replies = []
+        for command in [mail, *rcpts]:
+            start = time.perf_counter() if self.trace else 0.0
+            self._sock.sendall(command)
+            replies.append(self._accept_message())
+            if self.trace is not None:
+                self._emit('command', start, command=self._verb(command), code=replies[-1].code)
+            if verbose:
+                self._print_exchange([command], replies[-1:])
+            if replies[0].code != 250:
+                return replies[0], {}, None
+        results = dict(zip(recipients, replies[1:]))
+        if chunking or not any(reply.code in (250, 251) for reply in results.values()):
+            return replies[0], results, None
+        start = time.perf_counter() if self.trace else 0.0
+        self._sock.sendall(b'DATA\r\n')
+        data = self._accept_message()
+        if self.trace is not None:
+            self._emit('command', start, command='DATA', code=data.code)
+        if verbose:
+            self._print_exchange([b'DATA\r\n'], [data])
+        return replies[0], results, data
+
+    def _accept_messages(self, count: int) -> List[Reply]:
+        try:
+            return self._reader.read_many(count)
+        except ReplyException as exc:
+            raise SenderException(exc.message)
+
+    def _bdat(self, chunk: bytes, last: bool, verbose: bool) -> float:
+        command = f'BDAT {len(chunk)}{" LAST" if last else ""}\r\n'.encode()
+        start = time.perf_counter()
+        self._sock.sendall(command + chunk)
+        reply = self._accept_message()
+        network = time.perf_counter() - start
+        if verbose:
+            self._print_exchange([command], [reply])
+        self._ensure_code_correct(reply, b'250 ')
+        return network
+
+    def _send_chunks(self, chunks: Iterable[bytes], verbose: bool) -> Tuple[int, float]:
+        # RFC 3030 CHUNKING: sized BDAT chunks, no dot-stuffing and no end-of-data marker to scan for.
+        buffer = bytearray()
+        sent, network = 0, 0.0
+        for chunk in chunks:
+            buffer += chunk
+            # Keep at least one byte back so the final chunk can carry LAST.
+            while len(buffer) > self.chunk_size:
+                network += self._bdat(bytes(buffer[:self.chunk_size]), False, verbose)
+                sent += self.chunk_size
+                del buffer[:self.chunk_size]
+        network += self._bdat(bytes(buffer), True, verbose)
+        return sent + len(buffer), network
+
+    def _emit_data(self, start: float, sent: int, network: float, **fields) -> None:
+        seconds = time.perf_counter() - start
+        self.trace({
+            'phase': 'data', 'host': self._host, 'ms': round(seconds * 1000, 3), 'bytes': sent,
+            'network_ms': round(network * 1000, 3), 'encode_ms': round((seconds - network) * 1000, 3),
+            'mb_per_second': round(sent / seconds / 1024 / 1024, 2) if seconds else 0.0, **fields
+        })
+
+    def transaction(self, message: Message, recipients: List[str], verbose: bool = False) -> Dict[str, Reply]:
+        started = time.perf_counter() if self.trace else 0.0
+        chunking = self.chunking
+        mail, results, data = self._envelope(recipients, verbose, chunking)
+        self._ensure_code_correct(mail, b'250 ')
+        accepted = [recipient for recipient, reply in results.items() if reply.code in (250, 251)]
+        if data is not None and data.code == 354 and not accepted:
+            # A pipelining server may still open DATA when every recipient was refused: send nothing.
+            # Its refusal of the empty message, usually 554, is expected; the recipients' replies are the error.
+            self._sender([(b'.\r\n', None)], verbose)
+        if not accepted:
+            raise SenderException('\n'.join(f'{recipient}: {reply}' for recipient, reply in results.items()))
+        start = time.perf_counter()
+        if chunking:
+            sent, network = self._send_chunks(message.chunks(binary=True), verbose)
+        else:
+            self._ensure_code_correct(data, b'354 ')
+            sent, network = self._send_stream(message.chunks())
+        if self.trace is not None:
+            self._emit_data(start, sent, network, bdat=chunking)
+        if not chunking:
+            self._sender([(b'\n.\r\n', b'250 ')], verbose, '.')
+        if self.trace is not None:
+            self._emit('transaction', started, recipients=len(recipients), accepted=len(accepted), bytes=sent)
+        return results
+
+    def reset(self, verbose: bool = False) -> None:
+        self._sender([(b'RSET\r\n', b'250 ')], verbose)
+
+    def quit(self, verbose: bool = False) -> None:
+        try:
+            self._sender([(b'QUIT\r\n', b'221 ')], verbose)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def send_message(self, verbose: bool, auth: bool, tls: bool) -> Optional[str]:
+        start = time.perf_counter() if self.trace else 0.0
+        self.connect(verbose, auth, tls)
+        try:
+            self.transaction(self.create_message(), self._mess_to.split(','), verbose)
+            self.quit(verbose)
+            if self.trace is not None:
+                self._emit('send', start)
             return 'Email sent successfully!'
         finally:
-            self._sock.close()
+            self.close()
+
+
+def attachment_cache(args) -> Optional[AttachmentCache]:
+    if not args.cache_size:
+        return None
+    return AttachmentCache(args.cache_size * 1024 * 1024, args.cache_dir, processes=args.encode_processes)
+
+
+def bulk_send(args, host: str, port: int, trace: TraceCallback = None, tls: TLSSessionCache = None) -> None:
+    from bulk import BulkMailer, RetryQueue, print_progress, read_recipients
+    from session import SMTPSession, SessionPool
+
+    password = getpass.getpass('Password --> ') if args.auth else None
+    template = SMTPSender(host, args.user_name, '', port, args.directory, args.subject)
+    template.cache = attachment_cache(args)
+
+    def session() -> SMTPSession:
+        sender = SMTPSender(host, args.user_name, '', port, args.directory, args.subject, password)
+        sender.chunk_size, sender.trace = args.chunk_size, trace
+        sender.tls = tls or sender.tls
+        return SMTPSession(sender, args.auth, args.ssh, args.verbose, args.max_messages)
+
+    pool = SessionPool(session, size=args.workers)
+
+    def deliver(row: Dict[str, str]) -> None:
+        try:
+            subject = args.subject.format(**row)
+        except (KeyError, IndexError, ValueError):
+            subject = args.subject
+        pool.send(template.create_message(row['email'], subject), [row['email']])
+
+    queue = RetryQueue(args.queue)
+    try:
+        if args.recipients:
+            print(f'Queued {queue.add(read_recipients(args.recipients))} new recipients', flush=True)
+        mailer = BulkMailer(queue, deliver, args.workers, args.per_domain, args.rate, args.max_attempts,
+                            args.backoff, progress=print_progress)
+        print(json.dumps(mailer.run()))
+    finally:
+        pool.close()
+        queue.close()
 
 
 def main():
@@ -127,23 +380,56 @@ def main():
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose')
     parser.add_argument('-s', '--server', help='Server[:port]. Default 25 port.')
     parser.add_argument('-d', '--directory', help='Directory')
-    parser.add_argument('-t', '--to', help='Email of recipient')
+    parser.add_argument('-t', '--to', help='Email of recipient. Comma separated for several recipients')
     parser.add_argument('-f', '--from', dest='user_name', default='', help='Email of sender')
     parser.add_argument('--subject', default='Happy Pictures', help='Sabject of mail.')
+    parser.add_argument('--chunk-size', type=int, default=SMTPSender.chunk_size,
+                        help='BDAT chunk size when the server offers CHUNKING and BINARYMIME, 0 to always use DATA')
+    parser.add_argument('--cafile', help='CA certificates to verify the server with')
+    parser.add_argument('--insecure', action='store_true', help='Do not verify the server certificate')
+    parser.add_argument('--trace', nargs='?', const='-', help='Write timing events as JSON lines to a file or stderr')
+    parser.add_argument('--profile', action='store_true', help='Print a per-phase timing summary when done')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Encoded attachment cache in MiB, off by default: attachments are streamed')
+    parser.add_argument('--cache-dir', help='Keep encoded attachments on disk between runs')
+    parser.add_argument('--encode-processes', action='store_true', help='Encode cache misses in a process pool')
+    bulk = parser.add_argument_group('bulk', 'Deliver to every recipient of a list instead of --to')
+    bulk.add_argument('-r', '--recipients', help='CSV or JSONL file with an email column/field')
+    bulk.add_argument('--queue', default='bulk_queue.sqlite3', help='Retry queue file, resumed on restart')
+    bulk.add_argument('--workers', type=int, default=8, help='Concurrent SMTP sessions')
+    bulk.add_argument('--per-domain', type=int, default=4, help='Concurrent deliveries per recipient domain')
+    bulk.add_argument('--rate', type=float, default=0, help='Messages per second, 0 for unlimited')
+    bulk.add_argument('--max-attempts', type=int, default=5)
+    bulk.add_argument('--backoff', type=float, default=60, help='First retry delay in seconds, doubled each time')
+    bulk.add_argument('--max-messages', type=int, default=100, help='Messages per SMTP connection')
     args = parser.parse_args()
-    for method in ['server', 'directory', 'to']:
+    for method in ['server', 'directory'] + ([] if args.recipients else ['to']):
         if getattr(args, method) is None:
             return print(f'Empty field {method}')
     try:
         host, port = args.server.strip(':').split(':')
     except ValueError:
         host, port = args.server, 25
-    sender = SMTPSender(host, args.user_name, args.to, int(port), args.directory, args.subject)
+    profile = Profile() if args.profile else None
+    trace_file = open(args.trace, 'a') if args.trace not in (None, '-') else None
+    trace = tee(json_lines(trace_file) if args.trace else None, profile)
+    tls = TLSSessionCache(cafile=args.cafile, verify=not args.insecure)
     try:
-        print(sender.send_message(args.verbose, args.auth, args.ssh))
-    except SenderException as exc:
-        print(exc.message.strip('\r\n') or 'Unknown error!')
-        exit(1)
+        if args.recipients:
+            return bulk_send(args, host, int(port), trace, tls)
+        sender = SMTPSender(host, args.user_name, args.to, int(port), args.directory, args.subject)
+        sender.chunk_size, sender.trace, sender.tls = args.chunk_size, trace, tls
+        sender.cache = attachment_cache(args)
+        try:
+            print(sender.send_message(args.verbose, args.auth, args.ssh))
+        except SenderException as exc:
+            print(exc.message.strip('\r\n') or 'Unknown error!')
+            exit(1)
+    finally:
+        if trace_file:
+            trace_file.close()
+        if profile:
+            print(profile.table())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import queue
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Optional
+
+from message import Message
+from reply import Reply, ReplyException
+from sender import SMTPSender, SenderException
+
+
+def _dropped(exc: Exception) -> bool:
+    # A closed socket or a 421 reply means the server ended the session, not that the message is bad.
+    if isinstance(exc, OSError):
+        return True
+    return exc.message.startswith('421') or isinstance(exc.__context__, (OSError, ReplyException))
+
+
+class SMTPSession:
+    _sender: SMTPSender
+    _verbose: bool
+    _auth: bool
+    _tls: bool
+    _max_messages: int
+    _connected: bool = False
+    _messages: int = 0
+    connections: int = 0
+    sent: int = 0
+
+    def __init__(self, sender: SMTPSender, auth: bool = False, tls: bool = False, verbose: bool = False,
+                 max_messages: int = 100):
+        self._sender = sender
+        self._auth, self._tls, self._verbose = auth, tls, verbose
+        self._max_messages = max_messages
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    def _connect(self) -> None:
+        self._sender.connect(self._verbose, self._auth, self._tls)
+        self._connected, self._messages = True, 0
+        self.connections += 1
+
+    def _drop(self) -> None:
+        self._connected = False
+        self._sender.close()
+
+    def _prepare(self) -> None:
+        if self._connected and self._messages >= self._max_messages:
+            self.close()
+        if not self._connected:
+            return self._connect()
+        try:
+            self._sender.reset(self._verbose)
+        except (OSError, SenderException) as exc:
+            if not _dropped(exc):
+                raise
+            self._drop()
+            self._connect()
+
+    def send(self, message: Message, recipients: List[str]) -> Dict[str, Reply]:
+        self._prepare()
+        try:
+            results = self._sender.transaction(message, recipients, self._verbose)
+        except (OSError, SenderException) as exc:
+            if _dropped(exc):
+                self._drop()
+            raise
+        self._messages += 1
+        self.sent += 1
+        return results
+
+    def close(self) -> None:
+        if not self._connected:
+            return
+        self._connected = False
+        try:
+            self._sender.quit(self._verbose)
+        except (OSError, SenderException):
+            self._sender.close()
+
+    def __enter__(self) -> 'SMTPSession':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class SessionPool:
+    _factory: Callable[[], SMTPSession]
+    _size: int
+    _idle: queue.LifoQueue
+    _created: int
+    _lock: Lock
+    _sessions: List[SMTPSession]
+
+    def __init__(self, factory: Callable[[], SMTPSession], size: int = 4):
+        self._factory = factory
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+        self._sessions = []
+
+    def _acquire(self, timeout: Optional[float]) -> SMTPSession:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                session = self._factory()
+                self._sessions.append(session)
+                return session
+        return self._idle.get(timeout=timeout)
+
+    @contextmanager
+    def session(self, timeout: float = None) -> Iterator[SMTPSession]:
+        session = self._acquire(timeout)
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def send(self, message: Message, recipients: List[str]) -> Dict[str, Reply]:
+        with self.session() as session:
+            return session.send(message, recipients)
+
+    @property
+    def sessions(self) -> List[SMTPSession]:
+        return list(self._sessions)
+
+    def close(self) -> None:
+        for session in self._sessions:
+            session.close()
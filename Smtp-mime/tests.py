@@ -1,8 +1,27 @@
 import argparse
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+import time
+import tracemalloc
 import unittest
-from unittest import TestCase
+from threading import Lock, Thread
+from unittest import TestCase, mock
 
-from message import ContentMessage, Message
+from bulk import BulkMailer, RetryQueue, read_recipients, reply_code
+from cache import AttachmentCache
+from fake_server import FakeSMTPServer, self_signed, server_context
+from message import ContentMessage, FileContentMessage, Message, encode_base64
+from ratelimit import TokenBucket
+from reply import ReplyException, ReplyParser, ReplyReader
+from sender import SMTPSender, SenderException
+from session import SMTPSession, SessionPool
+from tls import TLSSessionCache
+from tracing import Profile, tee
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
 
 
 class MessageTests(TestCase):
@@ -51,5 +70,557 @@ class MessageTests(TestCase):
         self.assertEqual(result, message.__bytes__())
 
 
+class StreamingTests(TestCase):
+    _headers = {'Content-type': 'image/jpg; name=a.jpg', 'Content-transfer-encoding': 'base64'}
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def _file(self, data: bytes) -> str:
+        path = os.path.join(self.directory, f'{len(data)}.bin')
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def test_identical_to_in_memory_encoder(self):
+        for size in [0, 1, 56, 57, 58, 57 * 4, 57 * 4 + 1, 57 * 1024 * 3 + 5]:
+            data = os.urandom(size)
+            streamed = FileContentMessage(self._headers, self._file(data), block_lines=4)
+            expected = ContentMessage(self._headers, encode_base64(data))
+            self.assertEqual(bytes(expected), bytes(streamed), size)
+
+    def test_line_length(self):
+        body = bytes(FileContentMessage({}, self._file(os.urandom(10000)), block_lines=3))
+        self.assertTrue(all(len(line) <= 76 for line in body.split(b'\n')))
+
+    def test_message_identical(self):
+        data = os.urandom(5000)
+        path = self._file(data)
+        streamed = Message({'From': 'a'}, [FileContentMessage(self._headers, path)] * 2, 'part')
+        expected = Message({'From': 'a'}, [ContentMessage(self._headers, encode_base64(data))] * 2, 'part')
+        self.assertEqual(bytes(expected), b''.join(streamed.chunks()))
+
+    def test_bounded_memory(self):
+        path = self._file(os.urandom(8 * 1024 * 1024))
+        tracemalloc.start()
+        try:
+            for _ in Message({}, [FileContentMessage(self._headers, path)], 'part').chunks():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 1024 * 1024)
+
+
+class ReplyTests(TestCase):
+    def test_multiline_split_across_reads(self):
+        parser = ReplyParser()
+        self.assertEqual([], parser.feed(b'250-smtp.local greets\r\n250-PIPE'))
+        self.assertEqual([], parser.feed(b'LINING\r\n250-SIZE 1000\r\n'))
+        reply, = parser.feed(b'250 AUTH LOGIN PLAIN\r\n')
+        self.assertEqual(250, reply.code)
+        self.assertEqual(['smtp.local greets', 'PIPELINING', 'SIZE 1000', 'AUTH LOGIN PLAIN'], reply.lines)
+        self.assertEqual({'PIPELINING': '', 'SIZE': '1000', 'AUTH': 'LOGIN PLAIN'}, reply.capabilities)
+        self.assertFalse(parser.pending)
+
+    def test_several_replies_in_one_read(self):
+        replies = ReplyParser().feed(b'250 OK\r\n550 No such user\r\n354\r\n')
+        self.assertEqual([250, 550, 354], [reply.code for reply in replies])
+        self.assertEqual('No such user', replies[1].text)
+
+    def test_malformed(self):
+        with self.assertRaises(ReplyException):
+            ReplyParser().feed(b'hello\r\n')
+
+    def test_reader_returns_without_waiting(self):
+        server, client = socket.socketpair()
+        with server, client:
+            client.settimeout(5)
+            server.sendall(b'220-first\r\n220 second\r\n')
+            start = time.perf_counter()
+            self.assertEqual(['first', 'second'], ReplyReader(client).read().lines)
+            self.assertLess(time.perf_counter() - start, 0.1)
+            server.close()
+            with self.assertRaises(ReplyException):
+                ReplyReader(client).read()
+
+
+class SenderTests(TestCase):
+    def setUp(self) -> None:
+        self.server = FakeSMTPServer(reject=['nobody@local']).start()
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), self.directory)
+
+    def tearDown(self) -> None:
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _sender(self, to: str = 'to@local') -> SMTPSender:
+        return SMTPSender('127.0.0.1', 'from@local', to, self.server.port, self.directory, 'Pictures')
+
+    def test_send_is_fast(self):
+        start = time.perf_counter()
+        self.assertEqual('Email sent successfully!', self._sender().send_message(False, False, False))
+        self.assertLess(time.perf_counter() - start, 0.5)
+        message, = self.server.messages
+        self.assertEqual(['<to@local>'], message.rcpt_to)
+        self.assertIn(b'testik.jpg', message.data)
+
+    def test_rejected_recipient(self):
+        with self.assertRaises(SenderException) as context:
+            self._sender('nobody@local').send_message(False, False, False)
+        self.assertIn('550', context.exception.message)
+
+
+class PipeliningTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), self.directory)
+
+    def tearDown(self) -> None:
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _send(self, recipients):
+        sender = SMTPSender('127.0.0.1', 'from@local', ','.join(recipients), self.server.port, self.directory, 'x')
+        sender.timeout = 1
+        sender.connect()
+        try:
+            return sender.capabilities, sender.transaction(sender.create_message(), recipients)
+        finally:
+            sender.quit()
+
+    def test_pipelined_per_recipient_results(self):
+        self.server = FakeSMTPServer(capabilities=['PIPELINING'], reject=['bad@local']).start()
+        capabilities, results = self._send(['a@local', 'bad@local', 'b@local'])
+        self.assertIn('PIPELINING', capabilities)
+        self.assertEqual({'a@local': 250, 'bad@local': 550, 'b@local': 250},
+                         {recipient: reply.code for recipient, reply in results.items()})
+        message, = self.server.messages
+        self.assertEqual(['<a@local>', '<b@local>'], message.rcpt_to)
+
+    def test_lock_step_without_capability(self):
+        self.server = FakeSMTPServer(capabilities=[], reject=['bad@local']).start()
+        capabilities, results = self._send(['bad@local', 'a@local'])
+        self.assertNotIn('PIPELINING', capabilities)
+        self.assertEqual([550, 250], [reply.code for reply in results.values()])
+        self.assertEqual(1, len(self.server.messages))
+
+    def test_all_rejected(self):
+        for capabilities in (['PIPELINING'], []):
+            self.server = FakeSMTPServer(capabilities=capabilities, reject=['x@local', 'y@local']).start()
+            with self.assertRaises(SenderException) as context:
+                self._send(['x@local', 'y@local'])
+            self.assertIn('x@local: 550', context.exception.message)
+            self.assertEqual([], self.server.messages)
+            self.server.close()
+
+    def test_all_rejected_with_data_opened(self):
+        self.server = FakeSMTPServer(capabilities=['PIPELINING'], reject=['x@local', 'y@local'],
+                                     empty_data=True).start()
+        with self.assertRaises(SenderException) as context:
+            self._send(['x@local', 'y@local'])
+        self.assertIn('x@local: 550', context.exception.message)
+        self.assertIn('y@local: 550', context.exception.message)
+        # The dot ended DATA, so QUIT was read as a command again.
+        self.assertEqual([b'DATA', b'QUIT'], self.server.commands[-2:])
+
+
+class ChunkingTests(TestCase):
+    server: FakeSMTPServer = None
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), self.directory)
+        with open(os.path.join(TEST_DIR, 'testik.jpg'), 'rb') as file:
+            self.image = file.read()
+
+    def tearDown(self) -> None:
+        if self.server:
+            self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _send(self, capabilities, chunk_size: int = 4096, cache: AttachmentCache = None):
+        self.server = FakeSMTPServer(capabilities=capabilities).start()
+        sender = SMTPSender('127.0.0.1', 'from@local', 'to@local', self.server.port, self.directory, 'x')
+        sender.timeout, sender.chunk_size, sender.cache = 1, chunk_size, cache
+        sender.send_message(False, False, False)
+        message, = self.server.messages
+        return message, [command for command in self.server.commands if command.startswith(b'BDAT')]
+
+    def test_binary_part(self):
+        path = os.path.join(self.directory, 'testik.jpg')
+        content = FileContentMessage({'Content-transfer-encoding': 'base64'}, path, block_lines=3)
+        body = b''.join(content.chunks(binary=True))
+        self.assertEqual(b'Content-transfer-encoding: binary;\r\n\r\n' + self.image, body)
+
+    def test_bdat(self):
+        for capabilities in (['CHUNKING', 'BINARYMIME'], ['PIPELINING', 'CHUNKING', 'BINARYMIME']):
+            message, bdat = self._send(capabilities)
+            self.assertEqual(['BODY=BINARYMIME'], message.params)
+            self.assertIn(self.image, message.data)
+            # Headers and boundaries around the unchanged image end in CR LF, with no bare LF left.
+            head, tail = message.data.split(self.image)
+            self.assertTrue(head.startswith(b'From: <from@local>\r\n'))
+            self.assertNotIn(b'\n', head.replace(b'\r\n', b'') + tail.replace(b'\r\n', b''))
+            self.assertNotIn(b'DATA', self.server.commands)
+            self.assertEqual(-(-len(message.data) // 4096), len(bdat))
+            self.assertTrue(bdat[-1].endswith(b' LAST'))
+            self.assertLess(len(message.data), len(self.image) * 4 // 3)
+            self.server.close()
+        # The attachments went out as they are, so nothing was base64 encoded for the cache.
+        cache = AttachmentCache()
+        self._send(['CHUNKING', 'BINARYMIME'], cache=cache)
+        self.assertEqual((0, 0), (len(cache), cache.misses))
+
+    def test_data_fallback(self):
+        for capabilities, chunk_size in ((['CHUNKING'], 4096), (['CHUNKING', 'BINARYMIME'], 0)):
+            message, bdat = self._send(capabilities, chunk_size)
+            self.assertEqual([], bdat)
+            self.assertEqual([], message.params)
+            self.assertIn(encode_base64(self.image[:57 * 10]), message.data)
+            self.server.close()
+
+
+class CacheTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(6):
+            self.paths.append(os.path.join(self.directory, f'{i}.jpg'))
+            with open(self.paths[-1], 'wb') as file:
+                file.write(os.urandom(3000 + i))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_identical_to_streaming(self):
+        cache = AttachmentCache(workers=3)
+        self.assertEqual(self.paths, cache.warm(self.paths))
+        self.assertEqual([], cache.warm(self.paths))
+        for path in self.paths:
+            cached = FileContentMessage({'Content-type': 'image/jpg'}, path, cache=cache)
+            self.assertEqual(bytes(FileContentMessage({'Content-type': 'image/jpg'}, path)), bytes(cached))
+        self.assertEqual((6, 0), (cache.hits, cache.misses))
+
+    def test_lru_bound(self):
+        cache = AttachmentCache(max_bytes=4100 * 3)
+        for path in self.paths:
+            with open(path, 'rb') as file:
+                cache.put(path, encode_base64(file.read()))
+        self.assertEqual(3, len(cache))
+        self.assertLessEqual(cache.size, 4100 * 3)
+        self.assertIsNone(cache.get(self.paths[0]))
+        self.assertIsNotNone(cache.get(self.paths[-1]))
+
+    def test_warm_stays_within_bound(self):
+        # Warming past the bound would evict the first files before the send reads them.
+        cache = AttachmentCache(max_bytes=4100 * 3)
+        self.assertEqual(self.paths[:3], cache.warm(self.paths))
+        self.assertEqual([], cache.warm(self.paths))
+        for path in self.paths:
+            cache.get(path)
+        self.assertEqual((3, 3), (cache.hits, cache.misses))
+        self.assertEqual([], AttachmentCache(max_bytes=1000).warm(self.paths))
+        store = os.path.join(self.directory, 'store')
+        cache = AttachmentCache(max_bytes=4100, directory=store)
+        self.assertEqual(self.paths, cache.warm(self.paths))
+        self.assertEqual((1, 6), (len(cache), len(os.listdir(store))))
+
+    def test_changed_file_is_encoded_again(self):
+        cache = AttachmentCache()
+        cache.warm(self.paths[:1])
+        with open(self.paths[0], 'ab') as file:
+            file.write(b'more')
+        self.assertIsNone(cache.get(self.paths[0]))
+        self.assertEqual(self.paths[:1], cache.warm(self.paths[:1]))
+
+    def test_disk_store(self):
+        store = os.path.join(self.directory, 'store')
+        AttachmentCache(directory=store, processes=True).warm(self.paths)
+        cache = AttachmentCache(directory=store)
+        self.assertEqual([], cache.warm(self.paths))
+        with open(self.paths[2], 'rb') as file:
+            self.assertEqual(encode_base64(file.read()), cache.get(self.paths[2]))
+
+    def test_sender_uses_cache(self):
+        sender = SMTPSender('', 'from@local', 'to@local', 0, self.directory, 'x')
+        sender.cache = AttachmentCache()
+        message = sender.create_message()
+        # Nothing is encoded until the message goes out over DATA.
+        self.assertEqual(0, len(sender.cache))
+        first = bytes(message)
+        self.assertEqual(6, len(sender.cache))
+        self.assertEqual(first, bytes(sender.create_message()))
+        self.assertEqual((6, 6), (sender.cache.hits, sender.cache.misses))
+
+    def test_concurrent_sends_encode_once(self):
+        cache = AttachmentCache()
+        with mock.patch('cache._encode_file', side_effect=lambda path: time.sleep(0.05) or b'x') as encode:
+            threads = [Thread(target=cache.encoded, args=(self.paths[0],)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, encode.call_count)
+        self.assertEqual((3, 1), (cache.hits, cache.misses))
+        self.assertIsNone(AttachmentCache(max_bytes=1000).encoded(self.paths[0]))
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is needed for a test certificate')
+class TLSTests(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.cert, key = self_signed(cls.directory)
+        cls.context = server_context(cls.cert, key)
+        shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), cls.directory)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls.directory)
+
+    def setUp(self) -> None:
+        self.server = FakeSMTPServer(tls=self.context).start()
+
+    def tearDown(self) -> None:
+        self.server.close()
+
+    def _sender(self, tls: TLSSessionCache) -> SMTPSender:
+        sender = SMTPSender('127.0.0.1', 'from@local', 'to@local', self.server.port, self.directory, 'x')
+        sender.tls, sender.timeout = tls, 2
+        return sender
+
+    def test_session_resumed(self):
+        tls = TLSSessionCache(cafile=self.cert)
+        resumed = []
+        for _ in range(3):
+            sender = self._sender(tls)
+            sender.connect(tls=True)
+            resumed.append(sender.tls_resumed)
+            sender.transaction(sender.create_message(), ['to@local'])
+            sender.quit()
+        self.assertEqual([False, True, True], resumed)
+        self.assertEqual((3, 2), (tls.handshakes, tls.resumed))
+        self.assertEqual(2, self.server.resumed)
+        self.assertEqual(3, len(self.server.messages))
+
+    def test_context_shared(self):
+        tls = TLSSessionCache(cafile=self.cert)
+        self.assertIs(tls.context, tls.context)
+        self.assertIs(SMTPSender.tls, SMTPSender('', '', '', 0, self.directory, '').tls)
+
+    def test_certificate_verified(self):
+        with self.assertRaises(ssl.SSLError):
+            self._sender(TLSSessionCache()).connect(tls=True)
+        sender = self._sender(TLSSessionCache(verify=False))
+        sender.connect(tls=True)
+        sender.quit()
+
+
+class TracingTests(TestCase):
+    def setUp(self) -> None:
+        self.server = FakeSMTPServer(capabilities=['PIPELINING', 'AUTH LOGIN']).start()
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), self.directory)
+
+    def tearDown(self) -> None:
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_phases(self):
+        events, profile = [], Profile()
+        sender = SMTPSender('127.0.0.1', 'from@local', 'to@local', self.server.port, self.directory, 'x', 'secret')
+        sender.trace = tee(events.append, profile)
+        sender.send_message(False, True, False)
+        phases = [event['phase'] for event in events]
+        self.assertEqual(['tcp', 'greeting'], phases[:2])
+        self.assertEqual(['transaction', 'command', 'send'], phases[-3:])
+        commands = [event['command'] for event in events if event['phase'] == 'command']
+        self.assertEqual(['EHLO', 'AUTH', 'AUTH', 'AUTH', 'PIPELINE', '.', 'QUIT'], commands)
+        data, = (event for event in events if event['phase'] == 'data')
+        self.assertEqual(len(bytes(sender.create_message())), data['bytes'])
+        self.assertAlmostEqual(data['ms'], data['network_ms'] + data['encode_ms'], delta=0.01)
+        self.assertNotIn('secret', repr(events))
+        table = profile.table()
+        self.assertIn('command AUTH', table)
+        self.assertIn('data encode', table)
+        self.assertEqual(3, profile.phases['command AUTH'].count)
+
+
+class SessionTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), self.directory)
+
+    def tearDown(self) -> None:
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _session(self, **kwargs) -> SMTPSession:
+        sender = SMTPSender('127.0.0.1', 'from@local', 'to@local', self.server.port, self.directory, 'Pictures')
+        return SMTPSession(sender, **kwargs)
+
+    def test_many_messages_one_connection(self):
+        self.server = FakeSMTPServer().start()
+        with self._session() as session:
+            sender = session._sender
+            for i in range(3):
+                session.send(sender.create_message(f'{i}@local'), [f'{i}@local', 'copy@local'])
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(3, len(self.server.messages))
+        self.assertEqual(['<2@local>', '<copy@local>'], self.server.messages[2].rcpt_to)
+        self.assertEqual(2, self.server.commands.count(b'RSET'))
+        self.assertEqual(b'QUIT', self.server.commands[-1])
+
+    def test_reconnect_when_dropped(self):
+        self.server = FakeSMTPServer(close_after=2).start()
+        with self._session() as session:
+            for _ in range(5):
+                session.send(session._sender.create_message(), ['to@local'])
+        self.assertEqual(5, len(self.server.messages))
+        self.assertEqual(3, self.server.connections)
+
+    def test_max_messages(self):
+        self.server = FakeSMTPServer().start()
+        with self._session(max_messages=2) as session:
+            for _ in range(5):
+                session.send(session._sender.create_message(), ['to@local'])
+        self.assertEqual(3, session.connections)
+        self.assertEqual(5, session.sent)
+
+    def test_pool(self):
+        self.server = FakeSMTPServer().start()
+        pool = SessionPool(lambda: self._session(max_messages=10), size=2)
+        message = SMTPSender('', 'from@local', 'to@local', 0, self.directory, 'Pictures').create_message()
+        threads = [Thread(target=lambda: [pool.send(message, ['to@local']) for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close()
+        self.assertEqual(20, len(self.server.messages))
+        self.assertLessEqual(len(pool.sessions), 2)
+        self.assertLessEqual(self.server.connections, 4)
+
+
+class BulkTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.queue = RetryQueue(os.path.join(self.directory, 'queue.sqlite3'))
+
+    def tearDown(self) -> None:
+        self.queue.close()
+        shutil.rmtree(self.directory)
+
+    def test_read_recipients(self):
+        csv_path, jsonl_path = os.path.join(self.directory, 'a.csv'), os.path.join(self.directory, 'a.jsonl')
+        with open(csv_path, 'w') as file:
+            file.write('email,name\na@x,Ann\nb@y,Bob\n')
+        with open(jsonl_path, 'w') as file:
+            file.write('{"email": "c@z", "id": 1}\n\n')
+        self.assertEqual([{'email': 'a@x', 'name': 'Ann'}, {'email': 'b@y', 'name': 'Bob'}],
+                         list(read_recipients(csv_path)))
+        self.assertEqual([{'email': 'c@z', 'id': '1'}], list(read_recipients(jsonl_path)))
+
+    def test_reply_code(self):
+        self.assertEqual(550, reply_code('a@x: 550 No such user'))
+        self.assertEqual(421, reply_code('421-busy'))
+        self.assertIsNone(reply_code('Connection closed by server'))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, burst=1)
+        start = time.perf_counter()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertGreaterEqual(time.perf_counter() - start, 0.09)
+
+    def test_concurrency_retries_and_failures(self):
+        rows = [{'email': f'user{i}@d{i % 3}.local'} for i in range(30)] + [{'email': 'bad@d0.local'}]
+        self.assertEqual(31, self.queue.add(rows))
+        self.assertEqual(0, self.queue.add(rows))
+        lock, active, peak, attempts = Lock(), {}, {}, {}
+
+        def deliver(row):
+            domain = row['email'].split('@')[1]
+            with lock:
+                active[domain] = active.get(domain, 0) + 1
+                peak[domain] = max(peak.get(domain, 0), active[domain])
+                attempts[row['email']] = attempts.get(row['email'], 0) + 1
+            try:
+                time.sleep(0.01)
+                if row['email'] == 'bad@d0.local':
+                    raise SenderException('bad@d0.local: 550 No such user')
+                if row['email'] == 'user1@d1.local' and attempts[row['email']] < 3:
+                    raise SenderException('451 Try again later')
+            finally:
+                with lock:
+                    active[domain] -= 1
+
+        report = BulkMailer(self.queue, deliver, workers=6, per_domain=2, backoff=0.01).run()
+        self.assertEqual(30, report['sent'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual(2, report['retried'])
+        self.assertEqual({'sent': 30, 'failed': 1}, report['queue'])
+        self.assertEqual(1, attempts['bad@d0.local'])
+        self.assertTrue(all(value <= 2 for value in peak.values()))
+
+    def test_capped_domain_does_not_block_others(self):
+        self.queue.add({'email': f'user{i}@busy.local'} for i in range(40))
+        self.queue.add({'email': f'user{i}@d{i % 5}.local'} for i in range(10))
+        lock, order = Lock(), []
+
+        def deliver(row):
+            time.sleep(0.01)
+            with lock:
+                order.append(row['email'].split('@')[1])
+
+        report = BulkMailer(self.queue, deliver, workers=8, per_domain=2).run()
+        self.assertEqual(50, report['sent'])
+        # The other domains go out next to the first busy.local sends, not after all forty of them.
+        self.assertLess(max(i for i, domain in enumerate(order) if domain != 'busy.local'), 20)
+
+    def test_claim_skips_domains(self):
+        self.queue.add([{'email': 'a@X.local'}, {'email': '"b@c"@x.local'}, {'email': 'd@y.local'}])
+        self.assertEqual(['d@y.local'], [task.email for task in self.queue.claim(10, skip_domains=['x.local'])])
+        self.assertEqual(2, len(self.queue.claim(10)))
+
+    def test_resume_after_crash(self):
+        self.queue.add([{'email': 'a@x'}, {'email': 'b@x'}])
+        self.queue.claim(1)
+        self.queue.close()
+        self.queue = RetryQueue(os.path.join(self.directory, 'queue.sqlite3'))
+        self.assertEqual({'pending': 2}, self.queue.counts())
+
+    def test_end_to_end(self):
+        server = FakeSMTPServer(reject=['bad@local']).start()
+        # Every file of the directory is attached, so the queue is kept out of it.
+        attachments = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, attachments)
+        try:
+            shutil.copy(os.path.join(TEST_DIR, 'testik.jpg'), attachments)
+            self.queue.add({'email': f'{i}@local'} for i in range(20))
+            self.queue.add([{'email': 'bad@local'}])
+            pool = SessionPool(lambda: SMTPSession(SMTPSender(
+                '127.0.0.1', 'from@local', '', server.port, attachments, 'x'), max_messages=50), size=4)
+            template = SMTPSender('', 'from@local', '', 0, attachments, 'Hello {email}')
+
+            def deliver(row):
+                pool.send(template.create_message(row['email']), [row['email']])
+
+            report = BulkMailer(self.queue, deliver, workers=4).run()
+            pool.close()
+        finally:
+            server.close()
+        self.assertEqual(20, report['sent'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual(20, len(server.messages))
+        self.assertLessEqual(server.connections, 4)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+import socket
+import ssl
+from threading import Lock
+from typing import Dict, Optional
+
+
+def create_context(cafile: str = None, verify: bool = True) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class TLSSessionCache:
+    _context: Optional[ssl.SSLContext]
+    _cafile: Optional[str]
+    _verify: bool
+    _sessions: Dict[str, ssl.SSLSession]
+    _lock: Lock
+    handshakes: int
+    resumed: int
+
+    def __init__(self, context: ssl.SSLContext = None, cafile: str = None, verify: bool = True):
+        self._context = context
+        self._cafile, self._verify = cafile, verify
+        self._sessions = {}
+        self._lock = Lock()
+        self.handshakes = self.resumed = 0
+
+    @property
+    def context(self) -> ssl.SSLContext:
+        # Loading the CA store is the expensive part, so it happens once and only when TLS is used.
+        with self._lock:
+            if self._context is None:
+                self._context = create_context(self._cafile, self._verify)
+            return self._context
+
+    def wrap(self, sock: socket.socket, host: str) -> ssl.SSLSocket:
+        with self._lock:
+            session = self._sessions.get(host)
+        return self.context.wrap_socket(sock, server_hostname=host, session=session)
+
+    def remember(self, host: str, sock: ssl.SSLSocket) -> bool:
+        # With TLS 1.3 the ticket arrives after the handshake, so call this once the server has replied.
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += sock.session_reused
+            if sock.session is not None:
+                self._sessions[host] = sock.session
+        return sock.session_reused
+
+    def forget(self, host: str) -> None:
+        with self._lock:
+            self._sessions.pop(host, None)
@@ -0,0 +1,85 @@
+import json
+import sys
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Dict, IO, List, Optional
+
+Event = Dict[str, object]
+TraceCallback = Callable[[Event], None]
+
+
+def json_lines(file: IO[str] = None) -> TraceCallback:
+    def write(event: Event) -> None:
+        print(json.dumps(event), file=file or sys.stderr, flush=True)
+    return write
+
+
+def tee(*callbacks: Optional[TraceCallback]) -> Optional[TraceCallback]:
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if len(callbacks) < 2:
+        return callbacks[0] if callbacks else None
+
+    def emit(event: Event) -> None:
+        for callback in callbacks:
+            callback(event)
+    return emit
+
+
+@dataclass
+class PhaseStats:
+    count: int = 0
+    total: float = 0.0
+    longest: float = 0.0
+    bytes: int = 0
+
+
+class Profile:
+    _phases: Dict[str, PhaseStats]
+    _lock: Lock
+
+    def __init__(self):
+        self._phases = {}
+        self._lock = Lock()
+
+    def _add(self, name: str, ms: float, size: int = 0) -> None:
+        stats = self._phases.setdefault(name, PhaseStats())
+        stats.count += 1
+        stats.total += ms
+        stats.longest = max(stats.longest, ms)
+        stats.bytes += size
+
+    def __call__(self, event: Event) -> None:
+        name = str(event['phase'])
+        if event.get('command'):
+            name = f'{name} {event["command"]}'
+        with self._lock:
+            self._add(name, event['ms'], event.get('bytes', 0))
+            # Split timings such as data network_ms/encode_ms get rows of their own.
+            for key, value in event.items():
+                if key.endswith('_ms'):
+                    self._add(f'{name} {key[:-3]}', value)
+
+    @property
+    def phases(self) -> Dict[str, PhaseStats]:
+        with self._lock:
+            return dict(self._phases)
+
+    def table(self) -> str:
+        rows: List[List[str]] = [['phase', 'count', 'total ms', 'mean ms', 'max ms', 'bytes', 'MB/s']]
+        for name, stats in self.phases.items():
+            rate = stats.bytes / stats.total * 1000 / 1024 / 1024 if stats.bytes and stats.total else 0
+            rows.append([
+                name, str(stats.count), f'{stats.total:.2f}', f'{stats.total / stats.count:.2f}',
+                f'{stats.longest:.2f}', str(stats.bytes or ''), f'{rate:.1f}' if rate else ''
+            ])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join(
+            '  '.join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in
+                      enumerate(zip(row, widths)))
+            for row in rows
+        )
+
+
+def elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 3)
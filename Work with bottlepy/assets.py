@@ -0,0 +1,208 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from bottle import HTTPError, HTTPResponse, http_date, parse_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE = re.compile(r'^(text/|application/(javascript|json|xml)|image/svg)')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+@dataclass
+class Variant:
+    path: str
+    size: int
+    etag: str
+
+
+@dataclass
+class Asset:
+    name: str
+    path: str
+    size: int
+    mtime: float
+    etag: str
+    content_type: str
+    variants: Dict[str, Variant] = field(default_factory=dict)
+
+
+def _digest(path: str) -> str:
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()[:20]
+
+
+class FileRange:
+    _file = None
+    _remaining: int
+
+    def __init__(self, path: str, start: int, length: int):
+        # Positioned at the first byte, so a sendfile server can take offset and fileno from it.
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        size = self._remaining if size < 0 else min(size, self._remaining)
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class AssetIndex:
+    _directory: str
+    _assets: Dict[str, Asset]
+
+    def __init__(self, directory: str):
+        self._directory = os.path.abspath(directory)
+        self._assets = {}
+        self.reload()
+
+    def reload(self) -> None:
+        assets: Dict[str, Asset] = {}
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(tuple(ENCODINGS.values())) and os.path.exists(path.rsplit('.', 1)[0]):
+                    continue
+                stat = os.stat(path)
+                relative = os.path.relpath(path, self._directory).replace(os.sep, '/')
+                digest = _digest(path)
+                asset = Asset(relative, path, stat.st_size, stat.st_mtime, f'"{digest}"',
+                              mimetypes.guess_type(name)[0] or 'application/octet-stream')
+                for encoding, suffix in ENCODINGS.items():
+                    if os.path.exists(path + suffix):
+                        asset.variants[encoding] = Variant(path + suffix, os.path.getsize(path + suffix),
+                                                           f'"{digest}-{encoding}"')
+                assets[relative] = asset
+        self._assets = assets
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __contains__(self, name: str):
+        return name in self._assets
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self._assets.get(name)
+
+    def response(self, name: str, environ: dict) -> HTTPResponse:
+        asset = self._assets.get(name)
+        if asset is None:
+            return HTTPError(404, 'File does not exist.')
+        path, size, etag = asset.path, asset.size, asset.etag
+        headers = {'Content-Type': asset.content_type, 'Accept-Ranges': 'bytes',
+                   'Cache-Control': 'public, max-age=0, must-revalidate'}
+        if asset.variants:
+            headers['Vary'] = 'Accept-Encoding'
+        encoding = self._negotiate(asset, environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding:
+            variant = asset.variants[encoding]
+            path, size, etag = variant.path, variant.size, variant.etag
+            headers['Content-Encoding'] = encoding
+        headers['ETag'], headers['Last-Modified'] = etag, http_date(asset.mtime)
+        if self._matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            return HTTPResponse(status=304, headers=headers)
+        if 'HTTP_IF_NONE_MATCH' not in environ and self._unmodified(environ.get('HTTP_IF_MODIFIED_SINCE'), asset):
+            return HTTPResponse(status=304, headers=headers)
+        byte_range = None
+        if not encoding and environ.get('HTTP_RANGE') and environ.get('HTTP_IF_RANGE', etag) == etag:
+            byte_range = self._range(environ['HTTP_RANGE'], size)
+            if byte_range is None:
+                headers['Content-Range'] = f'bytes */{size}'
+                return HTTPResponse(status=416, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+            headers['Content-Length'] = str(end - start)
+            return HTTPResponse(FileRange(path, start, end - start), status=206, headers=headers)
+        headers['Content-Length'] = str(size)
+        return HTTPResponse(open(path, 'rb'), headers=headers)
+
+    @staticmethod
+    def _negotiate(asset: Asset, accept_encoding: str) -> Optional[str]:
+        accepted = set()
+        for item in accept_encoding.split(','):
+            coding, _, quality = item.strip().partition(';')
+            if quality.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(coding.strip().lower())
+        for encoding in ENCODINGS:
+            if encoding in asset.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return None
+
+    @staticmethod
+    def _matches(if_none_match: Optional[str], etag: str) -> bool:
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # If-None-Match uses the weak comparison.
+        return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+    @staticmethod
+    def _unmodified(if_modified_since: Optional[str], asset: Asset) -> bool:
+        # HTTP dates have whole seconds; If-None-Match, when sent, takes precedence (RFC 7232 3.3).
+        since = parse_date(if_modified_since) if if_modified_since else None
+        return since is not None and int(asset.mtime) <= since
+
+    @staticmethod
+    def _range(header: str, size: int) -> Optional[Tuple[int, ...]]:
+        match = RANGE.match(header.strip())
+        if not match or not any(match.groups()):
+            # Several ranges or another unit: the whole file is a valid answer.
+            return ()
+        first, last = match.groups()
+        if first and last and int(last) < int(first):
+            # RFC 7233 2.1: an invalid range is ignored, not refused.
+            return ()
+        if not first:
+            start, end = max(0, size - int(last)), size
+        else:
+            start, end = int(first), min(size, int(last) + 1) if last else size
+        if start >= end:
+            return None
+        return start, end
+
+
+def precompress(directory: str, minimum: int = 1024) -> int:
+    created = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            content_type = mimetypes.guess_type(name)[0] or ''
+            if name.endswith(tuple(ENCODINGS.values())) or not COMPRESSIBLE.match(content_type):
+                continue
+            if os.path.getsize(path) < minimum:
+                continue
+            with open(path, 'rb') as file:
+                data = file.read()
+            compressors = {'.gz': lambda raw: gzip.compress(raw, 9, mtime=0)}
+            if brotli is not None:
+                compressors['.br'] = lambda raw: brotli.compress(raw, quality=11)
+            for suffix, compress in compressors.items():
+                if os.path.exists(path + suffix):
+                    continue
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    with open(path + suffix, 'wb') as file:
+                        file.write(compressed)
+                    created += 1
+    return created
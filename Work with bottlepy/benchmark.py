@@ -0,0 +1,222 @@
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from threading import Event, Thread
+from typing import Dict, List
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from bottle import Bottle, request, static_file
+
+from assets import AssetIndex
+from sendfile import SendfileRequestHandler
+
+ROUTES = [
+    ('/', 'GET', '/', None),
+    ('/second?name=', 'GET', '/second?name=bench', None),
+    ('/second/<id>', 'GET', '/second/42', None),
+    ('POST /login', 'POST', '/login', 'username=admin&password=admin'),
+]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs) -> None:
+        pass
+
+
+def make_app(mode: str, directory: str) -> Bottle:
+    app = Bottle()
+    if mode == 'static_file':
+        app.route('/static/<name:path>', callback=lambda name: static_file(name, directory))
+    else:
+        index = AssetIndex(directory)
+        app.route('/static/<name:path>', callback=lambda name: index.response(name, request.environ))
+    return app
+
+
+def fetch(port: int, path: str, count: int) -> int:
+    received = 0
+    for _ in range(count):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        connection.request('GET', path)
+        response = connection.getresponse()
+        while True:
+            chunk = response.read(1024 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+        connection.close()
+    return received
+
+
+def bench(mode: str, directory: str, name: str, clients: int, requests: int) -> Dict[str, float]:
+    handler = SendfileRequestHandler if mode == 'sendfile' else QuietHandler
+    server = make_server('127.0.0.1', 0, make_app(mode, directory), ThreadingWSGIServer, handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            received = sum(pool.map(fetch, [server.server_port] * clients, [f'/static/{name}'] * clients,
+                                    [requests] * clients))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {'requests_per_second': round(clients * requests / elapsed, 1),
+            'mb_per_second': round(received / elapsed / 1024 / 1024, 1)}
+
+
+def percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))] * 1000, 2)
+
+
+def route_client(port: int, first: int, stop: Event) -> Dict[str, List[float]]:
+    latencies: Dict[str, List[float]] = {name: [] for name, _, _, _ in ROUTES}
+    latencies['errors'] = []
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    index = first
+    while not stop.is_set():
+        name, method, path, body = ROUTES[index % len(ROUTES)]
+        index += 1
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body, headers)
+            connection.getresponse().read()
+        except (OSError, http.client.HTTPException):
+            latencies['errors'].append(time.perf_counter() - start)
+            connection.close()
+            continue
+        latencies[name].append(time.perf_counter() - start)
+    connection.close()
+    return latencies
+
+
+def slow_download(port: int, stop: Event) -> None:
+    # Reads /picture at a trickle, so a server that runs one request at a time is stuck behind it.
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('127.0.0.1', port))
+    sock.sendall(b'GET /picture HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    while not stop.wait(0.05) and sock.recv(4096):
+        pass
+    sock.close()
+
+
+def start_server(backend: str, port: int, assets: str, processes: int) -> subprocess.Popen:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.py')
+    process = subprocess.Popen([sys.executable, script, '--host', '127.0.0.1', '-p', str(port), '-b', backend,
+                                '-w', str(processes)], env={**os.environ, 'ASSETS_DIR': assets},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{backend} server did not start')
+
+
+def bench_routes(backend: str, assets: str, clients: int, duration: float, slow: int,
+                 processes: int) -> Dict[str, object]:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = start_server(backend, port, assets, processes)
+    stop = Event()
+    try:
+        downloads = [Thread(target=slow_download, args=(port, stop), daemon=True) for _ in range(slow)]
+        for thread in downloads:
+            thread.start()
+        time.sleep(0.2)
+        with ThreadPoolExecutor(clients) as pool:
+            futures = [pool.submit(route_client, port, first, stop) for first in range(clients)]
+            start = time.perf_counter()
+            time.sleep(duration)
+            stop.set()
+            results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    report: Dict[str, object] = {}
+    every: List[float] = []
+    for name, _, _, _ in ROUTES:
+        values = [value for result in results for value in result[name]]
+        every += values
+        if values:
+            report[name] = {'requests': len(values), 'p50_ms': percentile(values, 50),
+                            'p90_ms': percentile(values, 90), 'p99_ms': percentile(values, 99)}
+    report['requests_per_second'] = round(len(every) / elapsed, 1)
+    report['errors'] = sum(len(result['errors']) for result in results)
+    if every:
+        report['p99_ms'] = percentile(every, 99)
+    return report
+
+
+def main_routes(args) -> None:
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'testik.jpg'), 'wb') as file:
+            file.write(os.urandom(args.picture))
+        results = {backend: bench_routes(backend, directory, args.clients, args.duration, args.slow, args.processes)
+                   for backend in args.backends.split(',')}
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Static asset and route benchmark')
+    parser.add_argument('-b', '--bench', choices=['static', 'routes'], default='static')
+    parser.add_argument('-c', '--clients', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=200, help='Requests per client for the small asset')
+    parser.add_argument('--small', type=int, default=1024, help='Small asset size in bytes')
+    parser.add_argument('--large', type=int, default=16 * 1024 * 1024, help='Large asset size in bytes')
+    parser.add_argument('--backends', default='wsgiref,threaded,prefork', help='Comma separated, for routes')
+    parser.add_argument('-d', '--duration', type=float, default=5, help='Seconds per backend, for routes')
+    parser.add_argument('--slow', type=int, default=1, help='Slow /picture downloads running alongside')
+    parser.add_argument('--picture', type=int, default=4 * 1024 * 1024, help='/picture size in bytes')
+    parser.add_argument('-w', '--processes', type=int, default=2, help='Pre-forked processes')
+    args = parser.parse_args()
+    if args.bench == 'routes':
+        main_routes(args)
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        for name, size in (('small.bin', args.small), ('large.bin', args.large)):
+            with open(os.path.join(directory, name), 'wb') as file:
+                file.write(os.urandom(size))
+        results = {}
+        for mode in ('static_file', 'wsgiref', 'sendfile'):
+            results[mode] = {
+                'small': bench(mode, directory, 'small.bin', args.clients, args.requests),
+                'large': bench(mode, directory, 'large.bin', args.clients, max(1, args.requests // 50)),
+            }
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import socket
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler
+
+
+class SendfileServerHandler(ServerHandler):
+    connection: socket.socket = None
+
+    def sendfile(self) -> bool:
+        filelike = self.result.filelike
+        if self.connection is None or not hasattr(filelike, 'fileno') or 'Content-Length' not in self.headers:
+            return False
+        try:
+            fileno = filelike.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        # The file is already positioned at the first byte (a Range response starts mid-file).
+        offset = os.lseek(fileno, 0, os.SEEK_CUR)
+        remaining = int(self.headers['Content-Length'])
+        if not self.headers_sent:
+            self.bytes_sent = remaining
+            self.send_headers()
+        self._flush()
+        if remaining > 0:
+            # socket.sendfile waits for the socket itself when it has a timeout (keep-alive connections do).
+            self.connection.sendfile(filelike, offset, remaining)
+        return True
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    def address_string(self) -> str:
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs) -> None:
+        pass
+
+    def handle(self) -> None:
+        # Same as WSGIRequestHandler.handle, with a handler that can hand file bodies to os.sendfile.
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        self.make_handler(self.rfile).run(self.server.get_app())
+
+    def make_handler(self, stdin) -> SendfileServerHandler:
+        handler = SendfileServerHandler(stdin, self.wfile, self.get_stderr(), self.get_environ(), multithread=False)
+        handler.connection = self.connection
+        handler.request_handler = self
+        return handler
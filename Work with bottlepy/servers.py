@@ -0,0 +1,375 @@
+import os
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Set
+from wsgiref.simple_server import WSGIServer
+
+from bottle import ServerAdapter, load_app
+
+from sendfile import SendfileRequestHandler, SendfileServerHandler
+
+BODYLESS = {204, 304}
+
+
+class RequestBody:
+    _file = None
+    _remaining: int
+
+    def __init__(self, file, length: int):
+        # Stops the app at the end of the body, so the next request on the connection is left intact.
+        self._file = file
+        self._remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        size = self._remaining if size < 0 else min(size, self._remaining)
+        data = self._file.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        size = self._remaining if size < 0 else min(size, self._remaining)
+        data = self._file.readline(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def drain(self, limit: int) -> bool:
+        while 0 < self._remaining <= limit:
+            if not self.read(65536):
+                return False
+        return self._remaining == 0
+
+
+class KeepAliveServerHandler(SendfileServerHandler):
+    def cleanup_headers(self) -> None:
+        super().cleanup_headers()
+        request_handler = self.request_handler
+        bodyless = int(self.status[:3]) in BODYLESS or self.environ['REQUEST_METHOD'] == 'HEAD'
+        if 'Content-Length' not in self.headers and not bodyless:
+            # No length and no chunked encoding in wsgiref: the end of the body is the end of the connection.
+            request_handler.close_connection = True
+        if request_handler.close_connection or request_handler.server.draining:
+            request_handler.close_connection = True
+            self.headers['Connection'] = 'close'
+        elif request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+
+class KeepAliveRequestHandler(SendfileRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # wsgiref writes the headers and the body separately; on a kept-alive connection Nagle would hold the body back.
+    disable_nagle_algorithm = True
+    max_drained_body = 1024 * 1024
+
+    def setup(self) -> None:
+        self.timeout = self.server.keepalive
+        super().setup()
+
+    def handle(self) -> None:
+        self.handle_one_request()
+        # Between requests the connection is idle, and a draining server may close it.
+        while not self.close_connection and self.server.wait_idle(self.connection, True):
+            self.handle_one_request()
+
+    def handle_one_request(self) -> None:
+        self.close_connection = True
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except OSError:
+            # Keep-alive timeout, reset by the client or shut down by a draining server.
+            return
+        finally:
+            self.server.wait_idle(self.connection, False)
+        if not self.raw_requestline:
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        if self.headers.get('Transfer-Encoding', '').lower() not in ('', 'identity'):
+            # The app decodes a chunked body itself, so where it ends is unknown here.
+            self.close_connection = True
+            self.make_handler(self.rfile).run(self.server.get_app())
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, 'Bad Content-Length')
+            return
+        body = RequestBody(self.rfile, length)
+        self.make_handler(body).run(self.server.get_app())
+        if not body.drain(self.max_drained_body):
+            self.close_connection = True
+
+    def make_handler(self, stdin) -> KeepAliveServerHandler:
+        handler = KeepAliveServerHandler(stdin, self.wfile, self.get_stderr(), self.get_environ(), multithread=True,
+                                         multiprocess=self.server.multiprocess)
+        if self.request_version == 'HTTP/1.1':
+            handler.http_version = '1.1'
+        handler.connection = self.connection
+        handler.request_handler = self
+        return handler
+
+
+class ThreadPoolServer(WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+    _threads: List[Thread]
+    _queue: Queue
+    _idle: Set[socket.socket]
+    _lock: Lock
+    threads: int
+    keepalive: float
+    draining: bool
+    multiprocess: bool = False
+
+    def __init__(self, address, handler_class=KeepAliveRequestHandler, threads: int = 16, keepalive: float = 5,
+                 bind_and_activate: bool = True):
+        self.threads, self.keepalive = threads, keepalive
+        self._threads, self._queue, self._idle, self._lock = [], Queue(), set(), Lock()
+        self.draining = False
+        super().__init__(address, handler_class, bind_and_activate)
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        # Threads start here and not in __init__, so every pre-forked worker gets its own pool.
+        while len(self._threads) < self.threads:
+            thread = Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address) -> None:
+        self._queue.put((request, client_address))
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def wait_idle(self, connection: socket.socket, idle: bool) -> bool:
+        with self._lock:
+            if idle and self.draining:
+                return False
+            if idle:
+                self._idle.add(connection)
+            else:
+                self._idle.discard(connection)
+            return True
+
+    def drain(self, timeout: float = 30) -> bool:
+        # Call after shutdown(): connections already accepted are answered, idle keep-alive ones are closed.
+        with self._lock:
+            self.draining = True
+            for connection in self._idle:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._threads)
+
+
+def _wait_for_interrupt(thread: Thread) -> None:
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_until_signal(server: ThreadPoolServer, grace: float = 30,
+                       signals=(signal.SIGTERM, signal.SIGINT)) -> None:
+    # Without sigwait (Windows) only Ctrl-C stops the server, still gracefully.
+    waits = hasattr(signal, 'pthread_sigmask') and hasattr(signal, 'sigwait')
+    if waits:
+        # Blocked before any thread starts, so only sigwait below ever receives them.
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    try:
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        if waits:
+            signal.sigwait(signals)
+        else:
+            _wait_for_interrupt(thread)
+        server.shutdown()
+        server.drain(grace)
+    finally:
+        server.server_close()
+        if waits:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+
+
+class PreforkMaster:
+    _server: ThreadPoolServer
+    _target: Optional[str]
+    _workers: Dict[int, int]
+    _generation: int
+    _respawn_after: float
+    _wakeup: List[int]
+    processes: int
+    grace: float
+
+    def __init__(self, server: ThreadPoolServer, processes: int = 4, target: str = None, grace: float = 30):
+        self._server = server
+        self._server.multiprocess = processes > 1
+        self._target = target
+        self._workers = {}
+        self._generation = 0
+        self._respawn_after = 0.0
+        self._wakeup = []
+        self.processes, self.grace = processes, grace
+
+    @property
+    def workers(self) -> List[int]:
+        return list(self._workers)
+
+    def serve(self) -> None:
+        # SIGHUP starts a new generation of workers and retires the old one; SIGTERM or SIGINT stops everything.
+        self._wakeup = list(os.pipe())
+        os.set_blocking(self._wakeup[1], False)
+        handled = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD)
+        previous = {signum: signal.signal(signum, lambda *_: None) for signum in handled}
+        previous_fd = signal.set_wakeup_fd(self._wakeup[1])
+        try:
+            while True:
+                self._reap()
+                if time.monotonic() >= self._respawn_after:
+                    while len(self._current()) < self.processes:
+                        self._spawn()
+                ready, _, _ = select.select([self._wakeup[0]], [], [], 1.0)
+                signums = set(os.read(self._wakeup[0], 1024)) if ready else set()
+                if signums & {signal.SIGTERM, signal.SIGINT}:
+                    break
+                if signal.SIGHUP in signums:
+                    self.reload()
+        finally:
+            signal.set_wakeup_fd(previous_fd)
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self.stop()
+            for fd in self._wakeup:
+                os.close(fd)
+            self._server.server_close()
+
+    def reload(self) -> None:
+        # The listening socket stays open in the master, so no connection is refused while workers change.
+        old = self._current()
+        self._generation += 1
+        for _ in range(self.processes):
+            self._spawn()
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+
+    def stop(self) -> None:
+        for pid in self._workers:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.grace
+        while self._workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for pid in self._workers:
+            self._signal(pid, signal.SIGKILL)
+        while self._workers:
+            self._reap(block=True)
+
+    def _current(self) -> List[int]:
+        return [pid for pid, generation in self._workers.items() if generation == self._generation]
+
+    @staticmethod
+    def _signal(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self, block: bool = False) -> None:
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self._workers.clear()
+                return
+            if not pid:
+                return
+            generation = self._workers.pop(pid, None)
+            if generation == self._generation and status:
+                # A worker that fails to start would otherwise be forked again in a tight loop.
+                self._respawn_after = time.monotonic() + 1
+            if block:
+                return
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = self._generation
+            return
+        status = 0
+        try:
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+            signal.set_wakeup_fd(-1)
+            for fd in self._wakeup:
+                os.close(fd)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group; the master decides how workers stop.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self._work()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _work(self) -> None:
+        server = self._server
+        if self._target:
+            # Imported after the fork, so a reload serves the code as it is on disk now.
+            server.set_app(load_app(self._target))
+        # Every worker waits on the same socket: the ones that lose the accept race must not block in it.
+        server.socket.setblocking(False)
+        serve_until_signal(server, self.grace, (signal.SIGTERM,))
+
+
+class ThreadPoolAdapter(ServerAdapter):
+    def run(self, handler) -> None:
+        server = ThreadPoolServer((self.host, self.port), threads=self.options.get('threads', 16),
+                                  keepalive=self.options.get('keepalive', 5))
+        server.set_app(handler)
+        serve_until_signal(server, self.options.get('grace', 30))
+
+
+class PreforkAdapter(ServerAdapter):
+    def run(self, handler) -> None:
+        server = ThreadPoolServer((self.host, self.port), threads=self.options.get('threads', 4),
+                                  keepalive=self.options.get('keepalive', 5))
+        server.set_app(handler)
+        PreforkMaster(server, self.options.get('processes', os.cpu_count() or 1), self.options.get('target'),
+                      self.options.get('grace', 30)).serve()
+
+
+BACKENDS = {'threaded': ThreadPoolAdapter}
+if hasattr(os, 'fork'):
+    BACKENDS['prefork'] = PreforkAdapter
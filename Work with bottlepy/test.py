@@ -1,4 +1,13 @@
-from bottle import route, run, request, static_file, error, get, post, response, template
+import argparse
+import os
+
+from bottle import route, run, request, error, get, post, response, template
+
+from assets import AssetIndex
+from sendfile import SendfileRequestHandler
+from servers import BACKENDS
+
+ASSETS = AssetIndex(os.environ.get('ASSETS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')))
 
 
 @route('/')
@@ -12,7 +21,11 @@ def second():
 
 @route('/picture')
 def second():
-    return static_file('testik.jpg', 'C:\\Users\\Кирилл Кравченя\\Desktop\\test')
+    return ASSETS.response('testik.jpg', request.environ)
+
+@route('/static/<name:path>')
+def static(name):
+    return ASSETS.response(name, request.environ)
 
 # @route('/second/<name>')
 # def second(name):
@@ -47,4 +60,21 @@ def do_login():
 def error404(error):
     return "Page not found!"
 
-run(host='localhost', port=8080)
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='test.py', description='Bottle test app')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-b', '--backend', choices=['wsgiref', *BACKENDS], default='threaded',
+                        help='wsgiref serves one request at a time')
+    parser.add_argument('-t', '--threads', type=int, help='Threads per process (16 threaded, 4 prefork)')
+    parser.add_argument('-w', '--processes', type=int, default=os.cpu_count() or 1, help='Pre-forked processes')
+    parser.add_argument('--keepalive', type=float, default=5, help='Idle keep-alive timeout in seconds')
+    parser.add_argument('--grace', type=float, default=30, help='Seconds to finish requests on stop or reload')
+    args = parser.parse_args()
+    if args.backend == 'wsgiref':
+        run(host=args.host, port=args.port, handler_class=SendfileRequestHandler)
+    else:
+        # Pre-forked workers import this module again, so SIGHUP reloads the code; SIGTERM stops gracefully.
+        options = {'threads': args.threads} if args.threads else {}
+        run(server=BACKENDS[args.backend], host=args.host, port=args.port, processes=args.processes,
+            keepalive=args.keepalive, grace=args.grace, target='test', **options)
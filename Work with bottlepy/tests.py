@@ -0,0 +1,276 @@
+import gzip
+import http.client
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+from email.utils import parsedate_to_datetime
+from threading import Thread
+from unittest import TestCase, mock
+from wsgiref.simple_server import WSGIServer, make_server
+
+from bottle import Bottle, http_date, request
+
+import sendfile
+from assets import AssetIndex, precompress
+from sendfile import SendfileRequestHandler
+from servers import PreforkMaster, ThreadPoolServer, serve_until_signal
+
+
+class AssetTests(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.directory, 'css'))
+        cls.style = b'body { color: red; }\n' * 200
+        cls.image = os.urandom(300000)
+        with open(os.path.join(cls.directory, 'css', 'site.css'), 'wb') as file:
+            file.write(cls.style)
+        with open(os.path.join(cls.directory, 'image.jpg'), 'wb') as file:
+            file.write(cls.image)
+        precompress(cls.directory)
+        cls.index = AssetIndex(cls.directory)
+        app = Bottle()
+        app.route('/static/<name:path>', callback=lambda name: cls.index.response(name, request.environ))
+        cls.server = make_server('127.0.0.1', 0, app, WSGIServer, SendfileRequestHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.directory)
+
+    def _get(self, path: str, **headers) -> http.client.HTTPResponse:
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+        connection.request('GET', path, headers={key.replace('_', '-'): value for key, value in headers.items()})
+        response = connection.getresponse()
+        response.body = response.read()
+        connection.close()
+        return response
+
+    def test_index(self):
+        self.assertEqual(2, len(self.index))
+        asset = self.index.get('css/site.css')
+        self.assertEqual((len(self.style), 'text/css'), (asset.size, asset.content_type))
+        self.assertEqual(['gzip'], list(asset.variants))
+        self.assertNotIn('css/site.css.gz', self.index)
+
+    def test_full_body_with_sendfile(self):
+        with mock.patch.object(sendfile.os, 'sendfile', wraps=os.sendfile) as patched:
+            response = self._get('/static/image.jpg')
+        self.assertEqual(200, response.status)
+        self.assertEqual(self.image, response.body)
+        self.assertEqual('image/jpeg', response.getheader('Content-Type'))
+        self.assertTrue(patched.called)
+
+    def test_not_modified(self):
+        etag = self._get('/static/image.jpg').getheader('ETag')
+        response = self._get('/static/image.jpg', If_None_Match=f'"other", {etag}')
+        self.assertEqual((304, b''), (response.status, response.body))
+        self.assertEqual(200, self._get('/static/image.jpg', If_None_Match='"other"').status)
+
+    def test_not_modified_since(self):
+        response = self._get('/static/image.jpg')
+        modified = response.getheader('Last-Modified')
+        self.assertEqual(int(self.index.get('image.jpg').mtime), parsedate_to_datetime(modified).timestamp())
+        response = self._get('/static/image.jpg', If_Modified_Since=modified)
+        self.assertEqual((304, b''), (response.status, response.body))
+        self.assertEqual(200, self._get('/static/image.jpg', If_Modified_Since=http_date(0)).status)
+        self.assertEqual(200, self._get('/static/image.jpg', If_Modified_Since='not a date').status)
+        # A validator that does not match wins over the date.
+        response = self._get('/static/image.jpg', If_Modified_Since=modified, If_None_Match='"other"')
+        self.assertEqual(200, response.status)
+
+    def test_ranges(self):
+        response = self._get('/static/image.jpg', Range='bytes=100-199')
+        self.assertEqual(206, response.status)
+        self.assertEqual(self.image[100:200], response.body)
+        self.assertEqual(f'bytes 100-199/{len(self.image)}', response.getheader('Content-Range'))
+        self.assertEqual(self.image[-10:], self._get('/static/image.jpg', Range='bytes=-10').body)
+        self.assertEqual(self.image[299990:], self._get('/static/image.jpg', Range='bytes=299990-').body)
+        self.assertEqual(416, self._get('/static/image.jpg', Range='bytes=400000-').status)
+        self.assertEqual(200, self._get('/static/image.jpg', Range='bytes=0-1,5-6').status)
+        invalid = self._get('/static/image.jpg', Range='bytes=5-3')
+        self.assertEqual((200, self.image), (invalid.status, invalid.body))
+        self.assertEqual(200, self._get('/static/image.jpg', Range='bytes=0-1', If_Range='"stale"').status)
+
+    def test_precompressed(self):
+        response = self._get('/static/css/site.css', Accept_Encoding='br;q=1.0, gzip')
+        self.assertEqual('gzip', response.getheader('Content-Encoding'))
+        self.assertEqual('Accept-Encoding', response.getheader('Vary'))
+        self.assertEqual(self.style, gzip.decompress(response.body))
+        plain = self._get('/static/css/site.css', Accept_Encoding='gzip;q=0')
+        self.assertIsNone(plain.getheader('Content-Encoding'))
+        self.assertEqual(self.style, plain.body)
+        self.assertNotEqual(response.getheader('ETag'), plain.getheader('ETag'))
+
+    def test_missing(self):
+        self.assertEqual(404, self._get('/static/nothing.txt').status)
+
+
+def make_app() -> Bottle:
+    app = Bottle()
+    app.route('/', ['GET', 'POST'], callback=lambda: 'fast')
+    app.route('/slow', callback=lambda: time.sleep(0.5) or 'slow')
+    app.route('/pid', callback=lambda: str(os.getpid()))
+    app.route('/stream', callback=lambda: iter([b'a', b'b']))
+    app.route('/login', 'POST', callback=lambda: request.forms.get('username'))
+    return app
+
+
+class ServerTests(TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadPoolServer(('127.0.0.1', 0), threads=4, keepalive=2)
+        self.server.set_app(make_app())
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.drain(5)
+        self.server.server_close()
+
+    def _request(self, connection: http.client.HTTPConnection, method: str, path: str, body: str = None) -> str:
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+        connection.request(method, path, body, headers)
+        return connection.getresponse().read().decode()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_slow_request_does_not_block(self):
+        slow = Thread(target=self._request, args=(self._connection(), 'GET', '/slow'))
+        slow.start()
+        time.sleep(0.05)
+        start = time.perf_counter()
+        self.assertEqual('fast', self._request(self._connection(), 'GET', '/'))
+        self.assertLess(time.perf_counter() - start, 0.3)
+        slow.join()
+
+    def test_keep_alive(self):
+        connection = self._connection()
+        self.assertEqual('fast', self._request(connection, 'GET', '/'))
+        sock = connection.sock
+        self.assertEqual('admin', self._request(connection, 'POST', '/login', 'username=admin&password=x'))
+        # The body of a request the app ignores is skipped, not read as the next request.
+        self.assertEqual('fast', self._request(connection, 'POST', '/', 'ignored=' + 'x' * 10000))
+        self.assertEqual('fast', self._request(connection, 'GET', '/'))
+        self.assertIs(sock, connection.sock)
+        connection.request('GET', '/stream')
+        response = connection.getresponse()
+        self.assertEqual(('close', b'ab'), (response.getheader('Connection'), response.read()))
+
+    def test_graceful_drain(self):
+        idle = self._connection()
+        self.assertEqual('fast', self._request(idle, 'GET', '/'))
+        results = []
+        slow = Thread(target=lambda: results.append(self._request(self._connection(), 'GET', '/slow')))
+        slow.start()
+        time.sleep(0.1)
+        start = time.perf_counter()
+        self.server.shutdown()
+        self.assertTrue(self.server.drain(5))
+        slow.join()
+        self.assertEqual(['slow'], results)
+        # The idle keep-alive connection is closed right away instead of waiting for its timeout.
+        self.assertLess(time.perf_counter() - start, 1.5)
+        with self.assertRaises((OSError, http.client.HTTPException)):
+            self._request(idle, 'GET', '/')
+
+    def test_serve_without_sigwait(self):
+        # Windows has no sigwait: the server runs until Ctrl-C interrupts the wait, then drains as usual.
+        server = ThreadPoolServer(('127.0.0.1', 0), threads=2)
+        server.set_app(make_app())
+        results = []
+
+        def interrupted(thread: Thread) -> None:
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+            self.addCleanup(connection.close)
+            results.append(self._request(connection, 'GET', '/'))
+
+        with mock.patch.dict(signal.__dict__), mock.patch('servers._wait_for_interrupt', interrupted):
+            del signal.__dict__['sigwait']
+            serve_until_signal(server, 5)
+        self.assertEqual(['fast'], results)
+        self.assertEqual(-1, server.socket.fileno())
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'pre-forking needs os.fork')
+class PreforkTests(TestCase):
+    def setUp(self) -> None:
+        server = ThreadPoolServer(('127.0.0.1', 0), threads=2, keepalive=1)
+        server.set_app(make_app())
+        self.port = server.server_port
+        self.master = os.fork()
+        if not self.master:
+            status = 0
+            try:
+                PreforkMaster(server, processes=2, grace=5).serve()
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        server.server_close()
+
+    def tearDown(self) -> None:
+        if self.master:
+            os.kill(self.master, signal.SIGTERM)
+            os.waitpid(self.master, 0)
+
+    def _pids(self, count: int) -> set:
+        pids = set()
+        for _ in range(count):
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+            connection.request('GET', '/pid')
+            pids.add(connection.getresponse().read().decode())
+            connection.close()
+        return pids
+
+    def _wait_for(self, pids: set, count: int) -> set:
+        deadline = time.monotonic() + 10
+        seen = set()
+        while len(seen - pids) < count and time.monotonic() < deadline:
+            seen |= self._pids(10)
+        return seen - pids
+
+    def test_workers_and_reload(self):
+        old = self._wait_for(set(), 2)
+        self.assertEqual(2, len(old))
+        self.assertNotIn(str(os.getpid()), old)
+        results = []
+        slow = Thread(target=lambda: results.append(self._slow()))
+        slow.start()
+        time.sleep(0.1)
+        os.kill(self.master, signal.SIGHUP)
+        new = self._wait_for(old, 2)
+        self.assertEqual(2, len(new))
+        slow.join()
+        # A request in flight in a retired worker still gets its answer.
+        self.assertEqual(['slow'], results)
+        time.sleep(1.5)
+        self.assertFalse(self._pids(10) & old)
+        os.kill(self.master, signal.SIGTERM)
+        _, status = os.waitpid(self.master, 0)
+        self.master = None
+        self.assertEqual(0, status)
+        with self.assertRaises(OSError):
+            socket.create_connection(('127.0.0.1', self.port), timeout=1)
+
+    def _slow(self) -> str:
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        connection.request('GET', '/slow')
+        try:
+            return connection.getresponse().read().decode()
+        finally:
+            connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()